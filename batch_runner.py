@@ -0,0 +1,248 @@
+import argparse
+import csv
+import os
+import time as timer
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from binning import bin_light_curve
+from bls_cache import CACHE_DIR
+from detrend import DEFAULT_WINDOW, detrend, transit_mask
+from eclipse_search import search_secondary_eclipse
+from lc_loader import load_light_curve
+from period_grid import adaptive_bls
+from profiling import profiler, stage
+from transit_timing import fit_ephemeris, measure_duration, measure_transit_times
+
+# Catalog columns; the ones with a default are optional
+CATALOG_DEFAULTS = {
+    'name': None,
+    'tic_id': '',
+    'dir_path': '',
+    'stellar_radius': None,
+    'stellar_mass': 1.0,
+    'stellar_temperature': None,
+    'min_period': 0.5,
+    'max_period': 10.0,
+}
+
+RESULT_COLUMNS = ['name', 'tic_id', 'status', 'error', 'n_points', 'period', 't0', 'duration',
+                  'transit_depth', 'planet_radius', 'secondary_phase', 'secondary_depth',
+                  'secondary_depth_err', 'dayside_temperature',
+                  'phase_curve_amplitude', 'n_transits', 'timing_period', 'timing_period_err', 'timing_t0',
+                  'timing_t0_err', 'timing_chi2', 'elapsed']
+
+
+def read_catalog(path, download_dir=None):
+    '''
+    Parameters
+    ----------
+    path : str
+        A CSV file with one target per row and the columns name, tic_id, dir_path,
+        stellar_radius (solar radii), stellar_mass (solar masses), stellar_temperature
+        (K), min_period and max_period (days). tic_id, dir_path, stellar_mass and the
+        period range are optional.
+    download_dir : str, optional
+        The primary directory Bulk_TESS_lc_Query downloaded into. Targets without a
+        dir_path are looked up in download_dir/name.
+
+    Returns
+    -------
+    targets : list of dict
+        One dict per target, with numeric columns converted to float.
+    '''
+    targets = []
+    with open(path, newline='') as handle:
+        for row in csv.DictReader(handle):
+            target = {}
+            for column, default in CATALOG_DEFAULTS.items():
+                value = (row.get(column) or '').strip()
+                if not value and default is None:
+                    raise ValueError(f'Catalog row {row} has no {column}')
+                target[column] = value or default
+            for column in ('stellar_radius', 'stellar_mass', 'stellar_temperature',
+                           'min_period', 'max_period'):
+                target[column] = float(target[column])
+            if not target['dir_path']:
+                target['dir_path'] = os.path.join(download_dir or '.', target['name'])
+            targets.append(target)
+    return targets
+
+
+def analyze_target(target, n_bins=200, detrend_window=DEFAULT_WINDOW):
+    '''
+    Parameters
+    ----------
+    target : dict
+        One catalog row, as returned by read_catalog.
+    n_bins : int, optional
+        The number of phase bins used for the transit depth and phase curve.
+    detrend_window : float, optional
+        The biweight window, in days, the flux is detrended with before the BLS and
+        the depth measurements. 0 turns detrending off. The phase curve is always
+        measured on the flux before detrending.
+
+    Returns
+    -------
+    results : dict
+        The ingest, BLS, folding, secondary-eclipse, phase-curve and transit-timing
+        measurements of the target, keyed by RESULT_COLUMNS. The timing columns are the
+        linear ephemeris fitted to every individually timed transit; they are NaN when
+        fewer than two transits are covered.
+    '''
+    # Ingest
+    time, flux = load_light_curve(target['dir_path'], cadence='lc')
+    time_offset = np.min(time)
+    time = time - time_offset
+    raw_flux = flux
+    if detrend_window:
+        flux, _ = detrend(time, raw_flux, detrend_window)
+
+    # BLS
+    _, _, bls_result = adaptive_bls(time, flux, target['min_period'], target['max_period'],
+                                    target['stellar_radius'], target['stellar_mass'],
+                                    cache_dir=os.path.join(target['dir_path'], CACHE_DIR))
+    index = np.argmax(bls_result.power)
+    period = bls_result.period[index]
+    t0 = bls_result.transit_time[index]
+    duration = bls_result.duration[index]
+    # The grid duration can be shorter than the transit, so use the one measured from the
+    # stacked transits, as steps 4-6 and pipeline.py do
+    measured = measure_duration(time, flux, period, t0, 0.25 * period)
+    if np.isfinite(measured):
+        duration = max(measured, duration)
+
+    # Fold, with the primary transit at phase 0
+    with stage('fold', n_points=time.size):
+        phase = (time - t0) / period
+        phase = phase - np.floor(phase + 0.5)
+    half_width = 0.5 * duration / period
+
+    # Detrend again with the transits and the eclipses half an orbit later masked
+    if detrend_window:
+        mask_width = max(1.5 * duration, 0.1)
+        masked = transit_mask(time, period, t0, mask_width)
+        masked |= transit_mask(time, period, t0 + 0.5 * period, mask_width)
+        flux, _ = detrend(time, raw_flux, detrend_window, mask=masked)
+
+    # Every transit timed on its own, and the ephemeris they give
+    times = measure_transit_times(time, flux, period, t0, duration)
+    try:
+        ephemeris = fit_ephemeris(times)
+    except ValueError:
+        ephemeris = None
+
+    # Primary transit
+    binned = bin_light_curve(phase, flux, bins=n_bins, range=(-0.5, 0.5))
+    transit_depth = 1 - np.nanmin(binned.mean)
+    planet_radius = target['stellar_radius'] * transit_depth ** 0.5
+
+    # Secondary eclipse, searched over the whole orbit, and day-side temperature. The
+    # primary is masked a little wider than the transit duration so its ingress and egress
+    # cannot pass for an eclipse next to it
+    eclipse = search_secondary_eclipse(phase, flux, duration / period * np.array([0.5, 0.75, 1.0, 1.25, 1.5]),
+                                       primary_width=3 * half_width)
+    secondary_depth = eclipse.depth
+    if secondary_depth > 0 and transit_depth > 0:
+        dayside_temperature = target['stellar_temperature'] * transit_depth ** -0.5 * secondary_depth ** (6 / 13)
+    else:
+        dayside_temperature = np.nan
+
+    # Phase curve: peak-to-peak of the binned flux outside transit and eclipse
+    if detrend_window:
+        binned = bin_light_curve(phase, raw_flux, bins=n_bins, range=(-0.5, 0.5))
+    out_of_eclipse = np.abs(binned.centers) > half_width
+    out_of_eclipse &= np.abs((binned.centers - eclipse.phase + 0.5) % 1 - 0.5) > 0.5 * eclipse.duration
+    phase_curve_amplitude = np.nanmax(binned.mean[out_of_eclipse]) - np.nanmin(binned.mean[out_of_eclipse])
+
+    return {
+        'n_points': time.size,
+        'period': period,
+        't0': t0 + time_offset,
+        'duration': duration,
+        'transit_depth': transit_depth,
+        'planet_radius': planet_radius,
+        'secondary_phase': eclipse.phase,
+        'secondary_depth': secondary_depth,
+        'secondary_depth_err': eclipse.depth_err,
+        'dayside_temperature': dayside_temperature,
+        'phase_curve_amplitude': phase_curve_amplitude,
+        'n_transits': times.epoch.size,
+        'timing_period': ephemeris.period if ephemeris else np.nan,
+        'timing_period_err': ephemeris.period_err if ephemeris else np.nan,
+        'timing_t0': ephemeris.t0 + time_offset if ephemeris else np.nan,
+        'timing_t0_err': ephemeris.t0_err if ephemeris else np.nan,
+        'timing_chi2': ephemeris.reduced_chi2 if ephemeris else np.nan,
+    }
+
+
+def _run_target(target, profile=False, detrend_window=DEFAULT_WINDOW):
+    # A worker's stages are sent back with its results so the parent writes one trace
+    if profile:
+        profiler.enable()
+    first_event = len(profiler.events)
+    start = timer.perf_counter()
+    with stage('analyze_target', target=target['name']):
+        results = analyze_target(target, detrend_window=detrend_window)
+    results['elapsed'] = timer.perf_counter() - start
+    return results, profiler.events[first_event:]
+
+
+def run_batch(targets, results_path, max_workers=4, detrend_window=DEFAULT_WINDOW):
+    '''
+    Parameters
+    ----------
+    targets : list of dict
+        The targets to analyze, as returned by read_catalog.
+    results_path : str
+        The CSV file the results table is written to, one row per target in catalog
+        order.
+    max_workers : int, optional
+        The number of targets analyzed at once, each in its own process.
+    detrend_window : float, optional
+        Passed on to analyze_target.
+
+    Returns
+    -------
+    rows : list of dict
+        The rows written to results_path. A target that raised has status 'failed'
+        and the exception in its error column; the other targets are unaffected.
+    '''
+    rows = []
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_run_target, target, profiler.enabled, detrend_window) for target in targets]
+        for target, future in zip(targets, futures):
+            row = {'name': target['name'], 'tic_id': target['tic_id'], 'status': 'ok', 'error': ''}
+            try:
+                results, events = future.result()
+                row.update(results)
+                profiler.extend(events)
+            except Exception as error:
+                row.update(status='failed', error=f'{type(error).__name__}: {error}')
+                print(f'{target["name"]} failed: {row["error"]}')
+            rows.append(row)
+
+    with open(results_path, 'w', newline='') as handle:
+        writer = csv.DictWriter(handle, fieldnames=RESULT_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the step 2-6 analysis on every target of a catalog.')
+    parser.add_argument('catalog', help='CSV target catalog, see read_catalog')
+    parser.add_argument('results', help='CSV results table to write')
+    parser.add_argument('--download-dir', help='Directory holding one folder per target name')
+    parser.add_argument('--workers', type=int, default=4, help='Targets analyzed at once')
+    parser.add_argument('--profile', metavar='PATH', help='Write a trace of every stage, see profiling.py')
+    parser.add_argument('--detrend-window', type=float, default=DEFAULT_WINDOW,
+                        help='Biweight detrending window, in days; 0 turns it off')
+    args = parser.parse_args()
+    if args.profile:
+        profiler.enable(args.profile)
+
+    rows = run_batch(read_catalog(args.catalog, args.download_dir), args.results, args.workers, args.detrend_window)
+    failed = [row['name'] for row in rows if row['status'] != 'ok']
+    print(f'{len(rows) - len(failed)} of {len(rows)} targets analyzed. Failed: {failed}')
@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time as timer
+import tracemalloc
+
+import numpy as np
+from astropy.io import fits
+
+from binning import bin_light_curve
+from detrend import detrend
+from eclipse_search import search_secondary_eclipse
+from folding import fold
+from harmonics import harmonic_periodogram
+from lc_loader import load_light_curve
+from lc_store import STORE_DIR, LightCurveStore
+from period_grid import adaptive_bls
+from transit_timing import fit_ephemeris, measure_transit_times
+
+# Input sizes: WASP-18's own 120 s sectors, and a 20 s target observed for two years
+PRESETS = {
+    'wasp18': {'sectors': (2, 3, 29, 30, 69), 'cadence': 120},
+    'large': {'sectors': tuple(range(1, 27)), 'cadence': 20},
+}
+
+# The injected system, close to WASP-18 b, and the search it is recovered with
+SYSTEM = {
+    'period': 0.94145,
+    't0': 1354.4575,
+    'duration': 0.09,
+    'depth': 0.0095,
+    'eclipse_depth': 0.00035,
+    'phase_amplitude': 0.0002,
+    'stellar_radius': 1.319,
+    'stellar_mass': 1.22,
+    'min_period': 0.5,
+    'max_period': 10.0,
+}
+
+STAGES = ('ingest', 'mask_normalize', 'harmonics', 'detrend', 'bls', 'timing', 'fold', 'bin', 'secondary')
+
+# Start of sector 1 and the length of a sector, in BTJD days
+SECTOR_ZERO = 1325.3
+SECTOR_DAYS = 27.4
+
+
+def write_synthetic_target(dir_path, sectors=(2, 3), cadence=120, gap_days=1.0, n_points=None,
+                           noise=1e-3, bad_fraction=0.02, seed=0, tic_id=100100827, **system):
+    '''
+    Parameters
+    ----------
+    dir_path : str
+        The directory the .fits files are written to.
+    sectors : tuple of int, optional
+        The TESS sectors observed. Sectors far apart leave the multi-year gaps of a
+        real target.
+    cadence : float, optional
+        The exposure cadence, in seconds; below 120 s the files are fast products.
+    gap_days : float, optional
+        The data-downlink gap in the middle of every sector, in days.
+    n_points : int, optional
+        The total number of cadences, split evenly over the sectors. Defaults to full
+        sectors at the given cadence.
+    noise : float, optional
+        The relative white noise per cadence.
+    bad_fraction : float, optional
+        The fraction of cadences flagged in QUALITY, and separately with NaN flux.
+    seed : int, optional
+        Seed of the random noise and flags.
+    **system
+        Overrides of SYSTEM: period, t0, duration, depth, eclipse_depth and
+        phase_amplitude.
+
+    Returns
+    -------
+    paths : list of str
+        The SPOC-named light-curve files written, one per sector.
+    '''
+    system = {**SYSTEM, **system}
+    rng = np.random.default_rng(seed)
+    os.makedirs(dir_path, exist_ok=True)
+    step = cadence / 86400
+    per_sector = n_points // len(sectors) if n_points else int((SECTOR_DAYS - gap_days) / step)
+    product = 's_lc' if cadence >= 120 else 'a_fast-lc'
+
+    paths = []
+    for sector in sectors:
+        # Two orbits per sector with the downlink gap between them
+        start = SECTOR_ZERO + (sector - 1) * SECTOR_DAYS
+        time = start + np.arange(per_sector) * step
+        time[per_sector // 2:] += gap_days
+
+        phase = (time - system['t0']) / system['period']
+        phase -= np.floor(phase + 0.5)
+        flux = 1 - 0.5 * system['phase_amplitude'] * np.cos(2 * np.pi * phase)
+        flux[np.abs(phase) < 0.5 * system['duration'] / system['period']] -= system['depth']
+        flux[np.abs(phase) > 0.5 - 0.5 * system['duration'] / system['period']] -= system['eclipse_depth']
+        flux = (flux + rng.normal(0, noise, time.size)) * 5e4
+        flux[rng.random(time.size) < bad_fraction] = np.nan
+        quality = np.where(rng.random(time.size) < bad_fraction, 32, 0)
+
+        columns = [
+            fits.Column('TIME', 'D', array=time),
+            fits.Column('TIMECORR', 'E', array=np.zeros(time.size)),
+            fits.Column('CADENCENO', 'J', array=np.arange(time.size)),
+            fits.Column('SAP_FLUX', 'E', array=flux),
+            fits.Column('SAP_FLUX_ERR', 'E', array=np.full(time.size, noise * 5e4)),
+            fits.Column('PDCSAP_FLUX', 'E', array=flux),
+            fits.Column('PDCSAP_FLUX_ERR', 'E', array=np.full(time.size, noise * 5e4)),
+            fits.Column('QUALITY', 'J', array=quality),
+        ]
+        name = f'tess2018206045859-s{sector:04d}-{tic_id:016d}-0120-{product}.fits'
+        path = os.path.join(dir_path, name)
+        fits.HDUList([fits.PrimaryHDU(),
+                      fits.BinTableHDU.from_columns(columns, name='LIGHTCURVE')]).writeto(path, overwrite=True)
+        paths.append(path)
+    return paths
+
+
+def _measure(function):
+    # Wall time and the peak of memory traced while function runs
+    tracemalloc.reset_peak()
+    start = timer.perf_counter()
+    value = function()
+    elapsed = timer.perf_counter() - start
+    return value, elapsed, tracemalloc.get_traced_memory()[1]
+
+
+def run_benchmark(dir_path, repeat=1, n_workers=None, skip=()):
+    '''
+    Parameters
+    ----------
+    dir_path : str
+        A target directory, e.g. one written by write_synthetic_target.
+    repeat : int, optional
+        The number of times each stage is run; the fastest run is reported.
+    n_workers : int, optional
+        The number of BLS processes. Defaults to the number of CPUs.
+    skip : tuple of str, optional
+        Stages not to run. Without the bls stage the injected period is folded on.
+
+    Returns
+    -------
+    stages : dict
+        Per stage run, its fastest time in seconds, every run's time and the peak
+        memory, in MB, allocated by this process while it ran. Work done by BLS
+        worker processes is not included in the memory.
+    recovered : dict
+        The period, transit depth and secondary depth found, to check that a faster
+        stage still gets the same answer.
+    '''
+    stages = {}
+    state = {}
+
+    def stage(name, function, setup=None):
+        if name in skip:
+            return
+        runs, peak = [], 0
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+            state[name], elapsed, run_peak = _measure(function)
+            runs.append(elapsed)
+            peak = max(peak, run_peak)
+        stages[name] = {'seconds': min(runs), 'runs': runs, 'peak_mb': peak / 2 ** 20}
+
+    tracemalloc.start()
+    try:
+        # Ingest reads the .fits files into the store; the store is removed before every run
+        stage('ingest', lambda: LightCurveStore.open(dir_path),
+              setup=lambda: shutil.rmtree(os.path.join(dir_path, STORE_DIR), ignore_errors=True))
+        LightCurveStore.open(dir_path)
+        stage('mask_normalize', lambda: load_light_curve(dir_path, use_cache=False, cadence='lc'))
+        time, flux = state.get('mask_normalize') or load_light_curve(dir_path, use_cache=False, cadence='lc')
+        stage('harmonics', lambda: harmonic_periodogram(time, flux))
+        stage('detrend', lambda: detrend(time, flux))
+        if 'detrend' in state:
+            flux = state['detrend'][0]
+
+        stage('bls', lambda: adaptive_bls(time, flux, SYSTEM['min_period'], SYSTEM['max_period'],
+                                          SYSTEM['stellar_radius'], SYSTEM['stellar_mass'],
+                                          n_workers=n_workers))
+        if 'bls' in state:
+            bls_result = state['bls'][2]
+            index = np.argmax(bls_result.power)
+            period, t0 = bls_result.period[index], bls_result.transit_time[index]
+            duration = bls_result.duration[index]
+        else:
+            period, t0, duration = SYSTEM['period'], SYSTEM['t0'], SYSTEM['duration']
+
+        stage('timing', lambda: measure_transit_times(time, flux, period, t0, duration))
+        stage('fold', lambda: fold(time, flux, period, t0))
+        folded = state['fold'] if 'fold' in state else fold(time, flux, period, t0)
+        phase, flux = folded.cycles, folded.flux
+        stage('bin', lambda: bin_light_curve(phase, flux, bins=200, range=(-0.5, 0.5), presorted=True))
+        stage('secondary', lambda: search_secondary_eclipse(
+            phase, flux, duration / period * np.array([0.5, 0.75, 1.0, 1.25, 1.5]),
+            primary_width=1.5 * duration / period))
+    finally:
+        tracemalloc.stop()
+
+    recovered = {'n_points': int(time.size), 'period': float(period)}
+    if 'timing' in state and state['timing'].epoch.size > 1:
+        recovered['timing_period'] = float(fit_ephemeris(state['timing']).period)
+    if 'bin' in state:
+        recovered['transit_depth'] = float(1 - np.nanmin(state['bin'].mean))
+    if 'secondary' in state:
+        recovered['secondary_depth'] = float(state['secondary'].depth)
+    return stages, recovered
+
+
+def compare(result, baseline, tolerance=1.25, min_seconds=0.01):
+    '''
+    Parameters
+    ----------
+    result, baseline : dict
+        Benchmark runs of the same preset, as written by the command line.
+    tolerance : float, optional
+        A stage regresses when it takes more than tolerance times its baseline time,
+        or allocates more than tolerance times its baseline peak memory.
+    min_seconds : float, optional
+        Baseline times below this are raised to it, so timer noise on very fast
+        stages is not reported as a regression.
+
+    Returns
+    -------
+    regressions : list of str
+        One message per regressed stage. Every stage of result also gets threshold_s,
+        threshold_mb and speedup entries, in place.
+    '''
+    regressions = []
+    for name, stage in result['stages'].items():
+        reference = baseline['stages'].get(name)
+        if reference is None:
+            continue
+        stage['threshold_s'] = tolerance * max(reference['seconds'], min_seconds)
+        stage['threshold_mb'] = tolerance * reference['peak_mb']
+        stage['speedup'] = reference['seconds'] / stage['seconds'] if stage['seconds'] else np.inf
+        if stage['seconds'] > stage['threshold_s']:
+            regressions.append(f"{result['name']}/{name}: {stage['seconds']:.3f} s, "
+                               f"threshold {stage['threshold_s']:.3f} s")
+        if stage['peak_mb'] > stage['threshold_mb'] > 0:
+            regressions.append(f"{result['name']}/{name}: {stage['peak_mb']:.1f} MB, "
+                               f"threshold {stage['threshold_mb']:.1f} MB")
+    return regressions
+
+
+def _environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'cpus': os.cpu_count()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time every pipeline stage on synthetic TESS light curves.')
+    parser.add_argument('--preset', nargs='+', default=['wasp18'], choices=sorted(PRESETS),
+                        help='Input sizes to run')
+    parser.add_argument('--sectors', type=int, nargs='+', help='Override the sectors observed')
+    parser.add_argument('--cadence', type=float, help='Override the cadence, in seconds')
+    parser.add_argument('--points', type=int, help='Total number of cadences, split over the sectors')
+    parser.add_argument('--gap-days', type=float, default=1.0, help='Mid-sector downlink gap, in days')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per stage; the fastest is reported')
+    parser.add_argument('--workers', type=int, help='BLS processes')
+    parser.add_argument('--skip', nargs='+', default=[], choices=STAGES, help='Stages not to run')
+    parser.add_argument('--output', default='benchmark.json', help='JSON results file to write')
+    parser.add_argument('--baseline', help='Earlier JSON results to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='Allowed slowdown over the baseline')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as handle:
+            baseline = {run['name']: run for run in json.load(handle)['runs']}
+
+    runs, regressions = [], []
+    for name in args.preset:
+        config = dict(PRESETS[name], gap_days=args.gap_days, n_points=args.points)
+        if args.sectors:
+            config['sectors'] = tuple(args.sectors)
+        if args.cadence:
+            config['cadence'] = args.cadence
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            write_synthetic_target(dir_path, **config)
+            stages, recovered = run_benchmark(dir_path, args.repeat, args.workers, tuple(args.skip))
+        run = {'name': name, 'config': config, 'recovered': recovered, 'stages': stages}
+        if name in baseline:
+            regressions += compare(run, baseline[name], args.tolerance)
+        runs.append(run)
+
+        print(f'{name}: ' + ', '.join(f'{key} {value:.6g}' for key, value in recovered.items()))
+        for stage, values in stages.items():
+            speedup = f", {values['speedup']:.2f}x baseline" if 'speedup' in values else ''
+            print(f"  {stage:15s}{values['seconds']:9.3f} s{values['peak_mb']:9.1f} MB{speedup}")
+
+    with open(args.output, 'w') as handle:
+        json.dump({'environment': _environment(), 'tolerance': args.tolerance, 'runs': runs}, handle, indent=2)
+
+    for message in regressions:
+        print('Regression:', message)
+    raise SystemExit(1 if regressions else 0)
@@ -0,0 +1,171 @@
+from collections import namedtuple
+
+import numpy as np
+
+from profiling import stage
+
+BinnedLightCurve = namedtuple('BinnedLightCurve',
+                              ['edges', 'centers', 'mean', 'median', 'std', 'stderr', 'count'])
+
+
+def _bin_index(x, edges, equal_width=False):
+    # The bin of every x, or -1 / len(edges) - 1 outside the edges; NaN is never binned
+    n_bins = edges.size - 1
+    if equal_width:
+        # Compute the bin directly, then undo any rounding at the edges
+        with np.errstate(invalid='ignore'):
+            scaled = (x - edges[0]) * (n_bins / (edges[-1] - edges[0]))
+        inside = (x >= edges[0]) & (x <= edges[-1])
+        index = np.where(inside, np.clip(scaled, 0, n_bins - 1), -1).astype(np.intp)
+        index[inside & (x < edges[np.maximum(index, 0)])] -= 1
+        index[inside & (index < n_bins - 1) & (x >= edges[np.minimum(index + 1, n_bins)])] += 1
+    else:
+        index = np.searchsorted(edges, x, side='right') - 1
+        index[x == edges[-1]] = n_bins - 1
+    return index
+
+
+def bin_light_curve(x, y, bins=500, weights=None, range=None, presorted=False):
+    '''
+    Parameters
+    ----------
+    x : array-like
+        The values that are binned, e.g. phase or time.
+    y : array-like
+        The values that are averaged, e.g. flux.
+    bins : int or array-like, optional
+        The number of equal-width bins, or the bin edges, as for numpy.histogram.
+        Every bin is closed on the left and the last one on the right too.
+    weights : array-like, optional
+        Weights of the y values, e.g. inverse flux variances. The median and count
+        are not weighted.
+    range : (float, float), optional
+        The range of x covered by equal-width bins. Defaults to the range of x.
+    presorted : bool, optional
+        Whether x is already sorted, e.g. the phase from folding.fold. Each bin is then
+        a run of x found by bisecting the edges, instead of placing every point.
+
+    Returns
+    -------
+    binned : BinnedLightCurve
+        The bin edges and centers, and per bin the mean, median, standard deviation,
+        standard error of the mean and number of points. Empty bins have a count of 0
+        and NaN statistics.
+    '''
+    with stage('bin_light_curve', n_points=np.size(x)) as record:
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        finite = np.isfinite(x)
+        if range is None and np.ndim(bins) == 0 and finite.any() and not finite.all():
+            range = (x[finite].min(), x[finite].max())
+        edges = np.histogram_bin_edges(x, bins, range)
+        n_bins = edges.size - 1
+        record.set(n_bins=n_bins)
+
+        if presorted:
+            # NaN sorts to the end, past the last edge, so it is never binned
+            bounds = np.searchsorted(x, edges)
+            bounds[-1] = np.searchsorted(x, edges[-1], side='right')
+            index = np.full(x.size, -1, dtype=np.intp)
+            index[bounds[0]:bounds[-1]] = np.repeat(np.arange(n_bins), np.diff(bounds))
+        else:
+            index = _bin_index(x, edges, equal_width=np.ndim(bins) == 0)
+        keep = (index >= 0) & (index < n_bins) & np.isfinite(y)
+        index, y = index[keep], y[keep]
+        w = np.ones_like(y) if weights is None else np.asarray(weights, dtype=float)[keep]
+
+        count = np.bincount(index, minlength=n_bins)
+        sum_w = np.bincount(index, w, n_bins)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(index, w * y, n_bins) / sum_w
+            std = np.sqrt(np.bincount(index, w * (y - mean[index]) ** 2, n_bins) / sum_w)
+            # Kish's effective sample size reduces to the count for equal weights
+            n_eff = sum_w ** 2 / np.bincount(index, w * w, n_bins)
+            stderr = std / np.sqrt(n_eff)
+
+        # Sort by y, then stably by bin, so every bin's values sit in order next to each
+        # other; the stable pass is a radix sort when the bin numbers fit in 16 bits
+        order = np.argsort(y)
+        keys = index[order].astype(np.int16 if n_bins <= np.iinfo(np.int16).max else np.int64)
+        sorted_y = y[order[np.argsort(keys, kind='stable')]]
+        starts = np.concatenate(([0], np.cumsum(count)[:-1]))
+        median = np.full(n_bins, np.nan)
+        filled = count > 0
+        low = starts[filled] + (count[filled] - 1) // 2
+        high = starts[filled] + count[filled] // 2
+        median[filled] = 0.5 * (sorted_y[low] + sorted_y[high])
+
+        centers = 0.5 * (edges[:-1] + edges[1:])
+        return BinnedLightCurve(edges, centers, mean, median, std, stderr, count)
+
+
+class BinAccumulator:
+    '''
+    Binned mean, standard deviation, standard error and count built up one chunk at a
+    time, e.g. one sector at a time from lc_loader.iter_sectors, so the whole light
+    curve never has to be in memory. Medians need every point and are not kept.
+    '''
+
+    def __init__(self, bins, range=None):
+        '''
+        Parameters
+        ----------
+        bins : int or array-like
+            The number of equal-width bins over range, or the bin edges.
+        range : (float, float), optional
+            The range covered by equal-width bins. Required when bins is an int.
+        '''
+        self.equal_width = np.ndim(bins) == 0
+        if self.equal_width and range is None:
+            raise ValueError('range is required when bins is a number of bins')
+        self.edges = np.histogram_bin_edges([], bins, range)
+        n_bins = self.edges.size - 1
+        self.count = np.zeros(n_bins, dtype=np.intp)
+        # Sums of w, w*d, w*d**2 and w**2 with d = y - shift, which keeps the variance
+        # free of cancellation when y is close to 1
+        self.sums = np.zeros((4, n_bins))
+        self.shift = None
+
+    def add(self, x, y, weights=None):
+        '''
+        Parameters
+        ----------
+        x, y : array-like
+            The binned values and the values that are averaged.
+        weights : array-like, optional
+            Weights of the y values.
+        '''
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        n_bins = self.count.size
+        index = _bin_index(x, self.edges, self.equal_width)
+        keep = (index >= 0) & (index < n_bins) & np.isfinite(y)
+        index, y = index[keep], y[keep]
+        if not y.size:
+            return
+        w = np.ones_like(y) if weights is None else np.asarray(weights, dtype=float)[keep]
+        if self.shift is None:
+            self.shift = float(np.mean(y))
+        d = y - self.shift
+
+        self.count += np.bincount(index, minlength=n_bins)
+        for row, values in zip(self.sums, (w, w * d, w * d * d, w * w)):
+            row += np.bincount(index, values, n_bins)
+
+    def result(self):
+        '''
+        Returns
+        -------
+        binned : BinnedLightCurve
+            The statistics of everything added so far, as bin_light_curve would return
+            them for the concatenated chunks, except that the median is NaN.
+        '''
+        sum_w, sum_d, sum_dd, sum_ww = self.sums
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_d = sum_d / sum_w
+            std = np.sqrt(np.maximum(sum_dd / sum_w - mean_d ** 2, 0))
+            stderr = std / np.sqrt(sum_w ** 2 / sum_ww)
+        mean = mean_d + (self.shift or 0.0)
+        median = np.full(self.count.size, np.nan)
+        centers = 0.5 * (self.edges[:-1] + self.edges[1:])
+        return BinnedLightCurve(self.edges, centers, mean, median, std, stderr, self.count.copy())
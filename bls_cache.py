@@ -0,0 +1,106 @@
+import hashlib
+import os
+
+import numpy as np
+from astropy.timeseries import BoxLeastSquaresResults
+
+from parallel_bls import RESULT_FIELDS, parallel_bls_power
+from profiling import stage
+
+# Cache folder created inside each target directory
+CACHE_DIR = '.bls_cache'
+
+# Periodograms kept per cache folder; the least recently used ones beyond this are removed
+MAX_ENTRIES = 16
+
+
+def bls_key(time, flux, periods, durations, dy=None, **kwargs):
+    '''
+    Parameters
+    ----------
+    time, flux : array-like
+        The light curve.
+    periods, durations : float or array-like
+        The BLS period and duration grids.
+    dy : array-like, optional
+        The flux uncertainties.
+    **kwargs
+        Any other BoxLeastSquares.power arguments, e.g. objective or oversample.
+
+    Returns
+    -------
+    key : str
+        A hex digest identifying the periodogram computed from these inputs.
+    '''
+    digest = hashlib.sha1()
+    for array in (time, flux, periods, durations, dy):
+        if array is None:
+            digest.update(b'none;')
+            continue
+        array = np.ascontiguousarray(array)
+        digest.update(f'{array.dtype.str}{array.shape};'.encode())
+        digest.update(array.tobytes())
+    digest.update(repr(sorted(kwargs.items())).encode())
+    return digest.hexdigest()
+
+
+def _prune_cache(cache_dir, max_entries=MAX_ENTRIES):
+    # Every new light curve or grid adds a periodogram, so only the most recently used
+    # ones are kept. Reads touch their file, so the modification time orders them by use
+    entries = [entry for entry in os.scandir(cache_dir)
+               if entry.name.endswith('.npz') and len(entry.name) == 44]
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in entries[max_entries:]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def bls_power(time, flux, periods, durations, dy=None, cache_dir=None, n_workers=1, **kwargs):
+    '''
+    Parameters
+    ----------
+    time, flux : array-like
+        The light curve.
+    periods, durations : float or array-like
+        The BLS period and duration grids, as passed to BoxLeastSquares.power.
+    dy : array-like, optional
+        The flux uncertainties.
+    cache_dir : str, optional
+        The directory periodograms are cached in. Usually the target directory joined
+        with CACHE_DIR. If None, nothing is cached.
+    n_workers : int, optional
+        The number of processes the periodogram is computed on. None uses every CPU.
+    **kwargs
+        Passed on to BoxLeastSquares.power.
+
+    Returns
+    -------
+    bls_result : astropy.timeseries.BoxLeastSquaresResults
+        The periodogram, read from the cache if the same light curve and grids were
+        searched before. At most MAX_ENTRIES periodograms are kept in cache_dir.
+    '''
+    sizes = {'n_points': np.size(time), 'n_periods': np.size(periods), 'n_durations': np.size(durations)}
+    if cache_dir is None:
+        with stage('bls_power', cached=False, **sizes):
+            return parallel_bls_power(time, flux, periods, durations, dy, n_workers, **kwargs)
+
+    cache_path = os.path.join(cache_dir, bls_key(time, flux, periods, durations, dy, **kwargs) + '.npz')
+    if os.path.exists(cache_path):
+        os.utime(cache_path)
+        with stage('bls_power', cached=True, **sizes), np.load(cache_path) as data:
+            return BoxLeastSquaresResults(str(data['objective']),
+                                          *[data[field] for field in RESULT_FIELDS[1:]])
+
+    with stage('bls_power', cached=False, **sizes):
+        bls_result = parallel_bls_power(time, flux, periods, durations, dy, n_workers, **kwargs)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write next to the final name and swap it in so a crash never leaves a partial cache
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as handle:
+        np.savez(handle, **{field: bls_result[field] for field in RESULT_FIELDS})
+    os.replace(tmp_path, cache_path)
+    _prune_cache(cache_dir)
+    return bls_result
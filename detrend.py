@@ -0,0 +1,185 @@
+import numpy as np
+
+from period_grid import split_segments
+from profiling import stage
+
+METHODS = ('median', 'biweight')
+
+# detrend is not a true sliding filter: the window location is computed exactly only at
+# knots spaced window / oversample apart (0.05 days by default) and the trend is
+# interpolated linearly between them. It therefore matches a point-by-point running
+# median or biweight where the trend is close to linear over a knot spacing, but does not
+# follow features shorter than about two knot spacings, which the window mostly smooths
+# out anyway. Raise oversample to tighten this at a proportional cost
+
+# The window width, in days: several transit durations of a hot Jupiter, and short
+# enough to follow TESS's orbit-scale ramps and stellar variability
+DEFAULT_WINDOW = 0.5
+
+# The biweight's rejection threshold, in median absolute deviations
+BIWEIGHT_C = 5.0
+
+# Elements of the (window, point) matrix built at once
+CHUNK_SIZE = 2 ** 22
+
+
+def transit_mask(time, period, t0, duration):
+    '''
+    Parameters
+    ----------
+    time : array-like
+        The observation times, in days.
+    period, t0, duration : float
+        The transit ephemeris, in days. Widen the duration to mask ingress and egress
+        generously.
+
+    Returns
+    -------
+    mask : numpy.ndarray
+        True for the points within half a duration of a transit.
+    '''
+    phase = (np.asarray(time, dtype=float) - t0) / period
+    return np.abs(phase - np.floor(phase + 0.5)) < 0.5 * duration / period
+
+
+def _window_rows(values, lo, count):
+    # One row per window, padded with -inf before and +inf after its values so that
+    # its lower and upper median sit in columns middle and middle + 1 whatever its
+    # count, where np.partition finds them in linear time
+    width = count.max() + 2
+    middle = (width - 1) // 2
+    before = middle - (count - 1) // 2
+    column = np.arange(width)
+    inside = (column >= before[:, None]) & (column < (before + count)[:, None])
+    index = np.clip(lo[:, None] + column - before[:, None], 0, max(values.size - 1, 0))
+    rows = np.where(inside, values[index], np.where(column < before[:, None], -np.inf, np.inf))
+    return rows, inside, middle
+
+
+def _median(rows, count, middle):
+    part = np.partition(rows, [middle, middle + 1], axis=1)
+    # Empty windows give -inf + inf; they are dropped by min_points
+    with np.errstate(invalid='ignore'):
+        return np.where(count % 2 == 1, part[:, middle], 0.5 * (part[:, middle] + part[:, middle + 1]))
+
+
+def _window_location(values, lo, count, method, max_iterations=10):
+    # The median or biweight location of values[lo:lo + count] for every window
+    rows, inside, middle = _window_rows(values, lo, count)
+    location = _median(rows, count, middle)
+    if method == 'median':
+        return location
+
+    # Tukey's biweight, from the median and the median absolute deviation
+    scale = BIWEIGHT_C * _median(np.where(inside, np.abs(rows - location[:, None]), rows), count, middle)
+    scale[scale <= 0] = np.inf
+    rows = np.where(inside, rows, 0.0)
+    for _ in range(max_iterations):
+        residual = rows - location[:, None]
+        u = residual / scale[:, None]
+        weight = np.where(inside & (np.abs(u) < 1), (1 - u ** 2) ** 2, 0.0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            step = np.sum(weight * residual, axis=1) / np.sum(weight, axis=1)
+        step[~np.isfinite(step)] = 0.0
+        location += step
+        if np.all(np.abs(step) <= 1e-3 * scale):
+            break
+    return location
+
+
+def detrend(time, flux, window=DEFAULT_WINDOW, method='biweight', mask=None, max_gap=0.5, oversample=10,
+            min_points=10):
+    '''
+    Parameters
+    ----------
+    time, flux : array-like
+        The light curve.
+    window : float, optional
+        The full width of the window, in days.
+    method : {'median', 'biweight'}, optional
+        The robust location taken in each window: the median, or Tukey's
+        biweight, which follows trends more closely while still ignoring outliers.
+    mask : array-like of bool, optional
+        True for points left out of every window, e.g. transits and eclipses from
+        transit_mask. They are still divided by the trend.
+    max_gap : float, optional
+        Gaps longer than this, in days, e.g. between orbits and sectors, split the
+        light curve into segments that are detrended separately.
+    oversample : int, optional
+        The number of window locations computed per window width. The trend is
+        interpolated linearly between them, so it resolves nothing shorter than about
+        2 * window / oversample.
+    min_points : int, optional
+        Windows with fewer unmasked points are skipped and interpolated over.
+
+    Returns
+    -------
+    flattened, trend : numpy.ndarray
+        flux / trend, and the trend. It approximates a sliding filter from the
+        locations at the knots; every point is in roughly oversample windows, so the
+        cost grows as N * oversample, not N * points per window.
+    '''
+    if method not in METHODS:
+        raise ValueError(f'method must be one of {METHODS}, not {method!r}')
+    time = np.asarray(time, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    use = np.isfinite(time) & np.isfinite(flux)
+    if mask is not None:
+        use &= ~np.asarray(mask, dtype=bool)
+
+    original = flux
+    order = None
+    if np.any(np.diff(time) < 0):
+        order = np.argsort(time, kind='stable')
+        time, flux, use = time[order], flux[order], use[order]
+
+    trend = np.full(flux.shape, np.nan)
+    segments = split_segments(time, max_gap) if time.size else []
+    with stage('detrend', n_points=time.size, n_segments=len(segments), method=method, window=window):
+        for segment in segments:
+            t, f = time[segment][use[segment]], flux[segment][use[segment]]
+            if t.size == 0:
+                # Nothing left to follow: fall back on the segment's median
+                finite = flux[segment][np.isfinite(flux[segment])]
+                trend[segment] = np.median(finite) if finite.size else np.nan
+                continue
+            n_knots = int(np.ceil((t[-1] - t[0]) * oversample / window)) + 1
+            knots = np.linspace(t[0], t[-1], n_knots)
+            lo = np.searchsorted(t, knots - 0.5 * window)
+            count = np.searchsorted(t, knots + 0.5 * window, side='right') - lo
+
+            location = np.empty(n_knots)
+            chunk = max(CHUNK_SIZE // (count.max() + 2), 1)
+            for start in range(0, n_knots, chunk):
+                part = slice(start, start + chunk)
+                location[part] = _window_location(f, lo[part], count[part], method)
+
+            good = count >= min_points
+            if np.any(good):
+                trend[segment] = np.interp(time[segment], knots[good], location[good])
+            else:
+                trend[segment] = np.median(f)
+
+    if order is not None:
+        unsorted = np.empty_like(trend)
+        unsorted[order] = trend
+        trend = unsorted
+    return original / trend, trend
+
+
+def flatten_sector(sector, **kwargs):
+    '''
+    Parameters
+    ----------
+    sector : lc_loader.Sector
+        A cleaned light curve of one file.
+    **kwargs
+        Passed on to detrend.
+
+    Returns
+    -------
+    sector : lc_loader.Sector
+        The same sector with its flux and flux errors divided by the trend.
+    '''
+    flux, trend = detrend(sector.time, sector.flux, **kwargs)
+    return sector._replace(flux=flux, flux_err=sector.flux_err / trend)
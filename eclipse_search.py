@@ -0,0 +1,111 @@
+from collections import namedtuple
+
+import numpy as np
+
+from profiling import stage
+
+SecondaryEclipse = namedtuple('SecondaryEclipse',
+                              ['phase', 'duration', 'depth', 'depth_err', 'snr',
+                               'offsets', 'durations', 'depth_grid', 'snr_grid'])
+
+
+def search_secondary_eclipse(phase, flux, durations, offsets=None, flux_err=None, primary_width=0.0,
+                             min_points=10, oversample=4, min_coverage=0.5):
+    '''
+    Parameters
+    ----------
+    phase : array-like
+        The orbital phase of every point, in cycles, with the primary transit at 0.
+        Any range works, e.g. -0.5 to 0.5; phases are wrapped onto 0 to 1.
+    flux : array-like
+        The normalized flux.
+    durations : float or array-like
+        The eclipse durations searched, in cycles, e.g. duration / period.
+    offsets : array-like, optional
+        The eclipse phases searched, in cycles. Defaults to the whole orbit, sampled
+        oversample times per shortest duration, so eccentric orbits are covered too.
+    flux_err : array-like, optional
+        The flux uncertainties. Without them every point has equal weight and the
+        scatter outside each window sets the depth uncertainty.
+    primary_width : float, optional
+        The full width, in cycles, of the primary transit. It is masked before the
+        search, and windows reaching into it are not searched, so leftover ingress
+        or egress cannot pass for an eclipse. Pass the width already removed if the
+        primary has been cut out, rather than 0.
+    min_points : int, optional
+        Windows holding fewer points are not searched.
+    oversample : int, optional
+        Offsets per shortest duration when offsets is not given.
+    min_coverage : float, optional
+        Windows holding fewer points than this fraction of the typical number, the
+        median over windows of the shortest duration across the searched orbit, are
+        not searched, e.g. those straddling a gap in the phase coverage.
+
+    Returns
+    -------
+    eclipse : SecondaryEclipse
+        The phase, duration, depth (1 - in-eclipse / out-of-eclipse flux), depth
+        uncertainty and signal-to-noise of the window with the highest signal-to-noise,
+        and the depth and signal-to-noise of every (offset, duration) window.
+    '''
+    with stage('secondary_search', n_points=np.size(phase), n_durations=np.size(durations)) as record:
+        phase = np.mod(np.asarray(phase, dtype=float), 1.0)
+        flux = np.asarray(flux, dtype=float)
+        w = np.ones_like(flux) if flux_err is None else np.asarray(flux_err, dtype=float) ** -2.0
+        keep = np.isfinite(phase) & np.isfinite(flux) & np.isfinite(w)
+        keep &= np.minimum(phase, 1 - phase) >= 0.5 * primary_width
+        phase, flux, w = phase[keep], flux[keep], w[keep]
+
+        # Sort by phase once and repeat the orbit, so every window, including those that
+        # wrap past phase 1, is a contiguous range of the prefix sums
+        order = np.argsort(phase, kind='stable')
+        phase, flux, w = phase[order], flux[order], w[order]
+        extended = np.concatenate((phase, phase + 1))
+        sums = [np.concatenate(([0.0], np.cumsum(np.tile(values, 2))))
+                for values in (np.ones_like(w), w, w * flux, w * flux * flux)]
+
+        durations = np.atleast_1d(np.asarray(durations, dtype=float))
+        if offsets is None:
+            offsets = np.arange(0, 1, durations.min() / oversample)
+        offsets = np.atleast_1d(np.asarray(offsets, dtype=float))
+        record.set(n_offsets=offsets.size)
+
+        # Every (offset, duration) window at once: its index range in the sorted data
+        start = np.mod(offsets[:, None] - 0.5 * durations[None, :], 1.0)
+        lo = np.searchsorted(extended, start)
+        hi = np.searchsorted(extended, start + durations[None, :])
+        count, sum_w, sum_wf, sum_wff = [total[hi] - total[lo] for total in sums]
+        n_total, w_total, wf_total, wff_total = [total[phase.size] for total in sums]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_in = sum_wf / sum_w
+            w_out = w_total - sum_w
+            mean_out = (wf_total - sum_wf) / w_out
+            if flux_err is None:
+                variance = np.maximum((wff_total - sum_wff) / w_out - mean_out ** 2, 0)
+                variance *= (n_total - count) / np.maximum(n_total - count - 1, 1)
+            else:
+                variance = 1.0
+            depth = 1 - mean_in / mean_out
+            depth_err = np.sqrt(variance * (1 / sum_w + 1 / w_out)) / mean_out
+            snr = depth / depth_err
+        valid = (count >= min_points) & (n_total - count >= min_points)
+
+        # Windows that reach into the primary, or hold far fewer points than usual
+        if primary_width > 0:
+            wrapped = np.mod(offsets, 1.0)[:, None]
+            valid &= np.minimum(wrapped, 1 - wrapped) - 0.5 * durations[None, :] >= 0.5 * primary_width
+        n_cells = max(int(round(1 / durations.min())), 1)
+        cells = np.histogram(phase, bins=n_cells, range=(0, 1))[0]
+        centers = (np.arange(n_cells) + 0.5) / n_cells
+        outside = np.minimum(centers, 1 - centers) > 0.5 * primary_width + 1 / n_cells
+        density = np.median(cells[outside] if np.any(outside) else cells) * n_cells
+        valid &= count >= min_coverage * density * durations[None, :]
+        snr = np.where(valid, snr, np.nan)
+        depth = np.where(valid, depth, np.nan)
+
+        if not np.any(np.isfinite(snr)):
+            raise ValueError('No eclipse window holds enough points to search')
+        i, j = np.unravel_index(np.nanargmax(snr), snr.shape)
+        return SecondaryEclipse(offsets[i], durations[j], depth[i, j], depth_err[i, j], snr[i, j],
+                                offsets, durations, depth, snr)
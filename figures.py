@@ -0,0 +1,195 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+import numpy as np
+from matplotlib.figure import Figure
+
+from parallel_bls import mp_context
+from profiling import stage
+
+# Set WASP18_HEADLESS=1 to write PNGs instead of opening windows
+HEADLESS_ENV = 'WASP18_HEADLESS'
+# Directory the PNGs are written to in headless mode
+FIGURE_DIR_ENV = 'WASP18_FIGURE_DIR'
+
+DEFAULT_FIGSIZE = (6.4, 4.8)
+DEFAULT_DPI = 100
+
+Layer = namedtuple('Layer', ['kind', 'x', 'y', 'kwargs'])
+FigureSpec = namedtuple('FigureSpec', ['filename', 'layers', 'figsize', 'legend', 'axes'])
+
+
+def scatter(x, y, **kwargs):
+    '''
+    Returns
+    -------
+    layer : Layer
+        A scatter layer for FigureSet.add; kwargs are passed on to Axes.scatter.
+    '''
+    return Layer('scatter', x, y, kwargs)
+
+
+def line(x, y, **kwargs):
+    '''
+    Returns
+    -------
+    layer : Layer
+        A line layer for FigureSet.add; kwargs are passed on to Axes.plot.
+    '''
+    return Layer('plot', x, y, kwargs)
+
+
+def is_headless():
+    '''
+    Returns
+    -------
+    headless : bool
+        True if WASP18_HEADLESS is set to a true value or matplotlib has a
+        non-interactive backend.
+    '''
+    if os.environ.get(HEADLESS_ENV, '').lower() in ('1', 'true', 'yes'):
+        return True
+    return matplotlib.get_backend().lower() in ('agg', 'pdf', 'ps', 'svg', 'cairo', 'template')
+
+
+def decimate(x, y, xlim, ylim, width, height):
+    '''
+    Parameters
+    ----------
+    x, y : numpy.ndarray
+        The points of a scatter plot.
+    xlim, ylim : (float, float)
+        The axis limits.
+    width, height : int
+        The size, in pixels, of the area the axes are drawn on.
+
+    Returns
+    -------
+    keep : numpy.ndarray
+        Indices of one point per occupied pixel, in their original order. Points
+        outside the limits are dropped, since they would not be drawn.
+    '''
+    with np.errstate(invalid='ignore', divide='ignore'):
+        column = np.floor((x - xlim[0]) / (xlim[1] - xlim[0]) * width)
+        row = np.floor((y - ylim[0]) / (ylim[1] - ylim[0]) * height)
+    visible = (column >= 0) & (column <= width) & (row >= 0) & (row <= height)
+    candidates = np.flatnonzero(visible)
+    pixel = column[candidates].astype(np.int64) * (height + 1) + row[candidates].astype(np.int64)
+    _, first = np.unique(pixel, return_index=True)
+    return candidates[np.sort(first)]
+
+
+def _limits(values, margin=0.05):
+    values = values[np.isfinite(values)]
+    if not values.size:
+        return (0.0, 1.0)
+    lo, hi = float(values.min()), float(values.max())
+    pad = margin * (hi - lo) if hi > lo else 0.5
+    return (lo - pad, hi + pad)
+
+
+def _draw(ax, spec):
+    for layer in spec.layers:
+        getattr(ax, layer.kind)(layer.x, layer.y, **layer.kwargs)
+    for name, value in spec.axes.items():
+        getattr(ax, 'set_' + name)(value)
+    if spec.legend:
+        ax.legend()
+
+
+def _render(spec, path, dpi):
+    # A bare Figure needs no pyplot state, so workers can render independently
+    figure = Figure(figsize=spec.figsize)
+    _draw(figure.add_subplot(), spec)
+    figure.savefig(path, dpi=dpi)
+    return path
+
+
+class FigureSet:
+    '''
+    The figures of one step. In interactive mode they are drawn with pyplot and shown
+    together; in headless mode dense scatters are decimated to the pixel grid and
+    rasterized, and every figure is written to a PNG by parallel worker processes.
+    '''
+
+    def __init__(self, out_dir=None, headless=None, dpi=DEFAULT_DPI, max_workers=None):
+        '''
+        Parameters
+        ----------
+        out_dir : str, optional
+            The directory PNGs are written to. Defaults to WASP18_FIGURE_DIR, or the
+            working directory.
+        headless : bool, optional
+            Whether to write PNGs instead of showing windows. Defaults to is_headless().
+        dpi : int, optional
+            The resolution of the PNGs.
+        max_workers : int, optional
+            The number of figures rendered at once. Defaults to the number of CPUs.
+        '''
+        self.out_dir = out_dir or os.environ.get(FIGURE_DIR_ENV, '.')
+        self.headless = is_headless() if headless is None else headless
+        self.dpi = dpi
+        self.max_workers = max_workers
+        self.specs = []
+
+    def add(self, filename, layers, figsize=None, legend=False, **axes):
+        '''
+        Parameters
+        ----------
+        filename : str
+            The PNG name used in headless mode, e.g. 'Figure 1.png'.
+        layers : list of Layer
+            The scatter and line layers, drawn in order.
+        figsize : (float, float), optional
+            The figure size in inches.
+        legend : bool, optional
+            Whether to draw a legend.
+        **axes
+            Axes properties such as xlabel, ylabel, title, xlim and ylim.
+
+        The data are copied (or decimated) here, so arrays changed afterwards by the
+        step do not change the figure.
+        '''
+        figsize = figsize or DEFAULT_FIGSIZE
+        kept = []
+        for layer in layers:
+            x, y = np.asarray(layer.x), np.asarray(layer.y)
+            kwargs = dict(layer.kwargs)
+            if self.headless and layer.kind == 'scatter':
+                xlim = axes.get('xlim') or _limits(x)
+                ylim = axes.get('ylim') or _limits(y)
+                keep = decimate(x, y, xlim, ylim, int(figsize[0] * self.dpi), int(figsize[1] * self.dpi))
+                x, y = x[keep], y[keep]
+                kwargs.setdefault('rasterized', True)
+            else:
+                x, y = x.copy(), y.copy()
+            kept.append(Layer(layer.kind, x, y, kwargs))
+        self.specs.append(FigureSpec(filename, kept, figsize, legend, axes))
+
+    def render(self):
+        '''
+        Returns
+        -------
+        paths : list of str
+            The PNGs written in headless mode. In interactive mode the figures are
+            shown instead and the list is empty.
+        '''
+        specs, self.specs = self.specs, []
+        n_points = sum(layer.x.size for spec in specs for layer in spec.layers)
+        if not self.headless:
+            import matplotlib.pyplot as plt
+            with stage('draw_figures', n_figures=len(specs), n_points=n_points):
+                for spec in specs:
+                    _draw(plt.figure(figsize=spec.figsize).add_subplot(), spec)
+            plt.show()
+            return []
+
+        os.makedirs(self.out_dir, exist_ok=True)
+        paths = [os.path.join(self.out_dir, spec.filename) for spec in specs]
+        with stage('render_figures', n_figures=len(specs), n_points=n_points):
+            if len(specs) < 2 or self.max_workers == 1:
+                return [_render(spec, path, self.dpi) for spec, path in zip(specs, paths)]
+            with ProcessPoolExecutor(max_workers=self.max_workers, mp_context=mp_context()) as pool:
+                return list(pool.map(_render, specs, paths, [self.dpi] * len(specs)))
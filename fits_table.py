@@ -0,0 +1,160 @@
+import mmap
+import re
+
+import numpy as np
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+# TFORM type code -> (big-endian dtype, bytes per element)
+TFORM_TYPES = {
+    'L': ('S1', 1),
+    'B': ('u1', 1),
+    'I': ('>i2', 2),
+    'J': ('>i4', 4),
+    'K': ('>i8', 8),
+    'A': ('S1', 1),
+    'E': ('>f4', 4),
+    'D': ('>f8', 8),
+    'C': ('>c8', 8),
+    'M': ('>c16', 16),
+    # Bit arrays and variable-length descriptors are only ever skipped over
+    'X': (None, None),
+    'P': (None, 8),
+    'Q': (None, 16),
+}
+
+# Only these header cards are parsed; every other card is skipped unread
+_KEYWORD = re.compile(r'(SIMPLE|XTENSION|BITPIX|NAXIS\d*|PCOUNT|GCOUNT|TFIELDS|'
+                      r'TTYPE\d+|TFORM\d+|TSCAL\d+|TZERO\d+)$')
+_TFORM = re.compile(r'\s*(\d*)([A-Z])')
+
+
+def _parse_value(text):
+    text = text.strip()
+    if text.startswith("'"):
+        # Quotes inside a string are doubled; trailing blanks are not significant
+        end = 1
+        while True:
+            end = text.index("'", end)
+            if text[end + 1:end + 2] != "'":
+                break
+            end += 2
+        return text[1:end].replace("''", "'").rstrip()
+    text = text.split('/', 1)[0].strip()
+    if text in ('T', 'F'):
+        return text == 'T'
+    try:
+        return int(text)
+    except ValueError:
+        return float(text.replace('D', 'E'))
+
+
+def _read_header(handle):
+    # The cards of one HDU header, and the file offset its data starts at
+    cards = {}
+    while True:
+        block = handle.read(BLOCK_SIZE)
+        if len(block) < BLOCK_SIZE:
+            raise ValueError(f'{handle.name} ends inside a FITS header')
+        for start in range(0, BLOCK_SIZE, CARD_SIZE):
+            card = block[start:start + CARD_SIZE].decode('ascii', 'replace')
+            keyword = card[:8].rstrip()
+            if keyword == 'END':
+                return cards, handle.tell()
+            if card[8:10] == '= ' and _KEYWORD.match(keyword):
+                cards[keyword] = _parse_value(card[10:])
+
+
+def _data_size(cards):
+    if cards.get('NAXIS', 0) == 0:
+        return 0
+    n_elements = 1
+    for axis in range(1, cards['NAXIS'] + 1):
+        n_elements *= cards[f'NAXIS{axis}']
+    n_bytes = abs(cards['BITPIX']) // 8 * cards.get('GCOUNT', 1) * (cards.get('PCOUNT', 0) + n_elements)
+    return -(-n_bytes // BLOCK_SIZE) * BLOCK_SIZE
+
+
+def _column_layout(cards):
+    # TTYPE -> (byte offset in the row, big-endian dtype, type code, TSCAL, TZERO)
+    layout = {}
+    offset = 0
+    for number in range(1, cards['TFIELDS'] + 1):
+        match = _TFORM.match(cards[f'TFORM{number}'])
+        if not match or match.group(2) not in TFORM_TYPES:
+            raise ValueError(f'Unsupported TFORM{number} {cards[f"TFORM{number}"]!r}')
+        repeat = int(match.group(1) or 1)
+        dtype, size = TFORM_TYPES[match.group(2)]
+        width = -(-repeat // 8) if match.group(2) == 'X' else repeat * size
+        if dtype is not None and repeat > 0:
+            if match.group(2) == 'A':
+                dtype = f'S{repeat}'
+            elif repeat > 1:
+                dtype = (dtype, (repeat,))
+            layout[cards.get(f'TTYPE{number}', '').strip()] = (
+                offset, dtype, match.group(2),
+                cards.get(f'TSCAL{number}', 1), cards.get(f'TZERO{number}', 0))
+        offset += width
+    return layout
+
+
+def read_bintable(path, names, ext=1):
+    '''
+    Parameters
+    ----------
+    path : str
+        A .fits file.
+    names : list of str
+        The TTYPE names of the columns to read, e.g. ['TIME', 'PDCSAP_FLUX'].
+    ext : int, optional
+        The HDU holding the binary table; 1 for TESS light curves.
+
+    Returns
+    -------
+    columns : list of numpy.ndarray
+        The columns in the order of names, as native-endian copies with any TSCAL and
+        TZERO applied, logical columns as bool and strings as bytes. Only the headers up to ext are
+        parsed, and only the requested columns are read from the memory-mapped table;
+        the other columns, the rest of the header and any later HDUs are never touched.
+    '''
+    with open(path, 'rb') as handle:
+        for _ in range(ext):
+            cards, data_start = _read_header(handle)
+            handle.seek(data_start + _data_size(cards))
+        cards, data_start = _read_header(handle)
+        if cards.get('XTENSION') != 'BINTABLE':
+            raise ValueError(f'HDU {ext} of {path} is not a binary table')
+
+        layout = _column_layout(cards)
+        missing = [name for name in names if name not in layout]
+        if missing:
+            raise KeyError(f'{path} has no column(s) {missing}')
+
+        # A row dtype holding only the requested fields, at their offsets in the row
+        row = np.dtype({'names': list(names),
+                        'formats': [layout[name][1] for name in names],
+                        'offsets': [layout[name][0] for name in names],
+                        'itemsize': cards['NAXIS1']})
+        n_rows = cards['NAXIS2']
+        if n_rows == 0:
+            columns = [np.empty((0,) + row[name].shape, row[name].base.newbyteorder('='))
+                       for name in names]
+        else:
+            with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                table = np.ndarray((n_rows,), dtype=row, buffer=buffer, offset=data_start)
+                columns = [table[name].astype(row[name].base.newbyteorder('=')) for name in names]
+                # The memory map cannot close while a view into it is alive
+                del table
+
+    for i, name in enumerate(names):
+        _, _, code, scale, zero = layout[name]
+        if code == 'L':
+            columns[i] = columns[i] == b'T'
+        elif scale == 1 and isinstance(zero, int) and columns[i].dtype.kind in 'iu':
+            # e.g. unsigned integers, stored as signed with TZERO = 2**31
+            if zero != 0:
+                columns[i] = columns[i].astype(np.int64) + zero
+        elif scale != 1 or zero != 0:
+            columns[i] = columns[i] * scale + zero
+    return columns
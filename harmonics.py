@@ -0,0 +1,182 @@
+from collections import namedtuple
+
+import numpy as np
+
+from profiling import stage
+
+# Lagrange order of the extirpolation and FFT grid points per highest frequency
+# index; together they keep the trigonometric sums within ~1e-3 of their scale
+EXTIRPOLATION_ORDER = 6
+GRID_FACTOR = 4
+
+# Harmonic k of the fit is offset * (cos[k - 1] cos(2 pi k phase) + sin[k - 1] sin(2 pi k
+# phase)), with phase in cycles from t0, and amplitude[k - 1] = hypot(cos, sin). The
+# coefficients are fractions of offset. chi2 is that of the fit with its weights
+HarmonicFit = namedtuple('HarmonicFit', ['period', 'offset', 'cos', 'sin', 'cos_err', 'sin_err', 'amplitude',
+                                         'amplitude_err', 'chi2'])
+
+
+def _prepare(time, flux, flux_err, mask):
+    time = np.asarray(time, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    w = np.ones_like(flux) if flux_err is None else np.asarray(flux_err, dtype=float) ** -2.0
+    keep = np.isfinite(time) & np.isfinite(flux) & np.isfinite(w) & (w > 0)
+    if mask is not None:
+        keep &= ~np.asarray(mask, dtype=bool)
+    return time[keep], flux[keep], w[keep]
+
+
+def trig_sums(time, weights, df, n_frequencies, order=EXTIRPOLATION_ORDER, grid_factor=GRID_FACTOR):
+    '''
+    Parameters
+    ----------
+    time : numpy.ndarray
+        The observation times, in days.
+    weights : numpy.ndarray
+        The value summed at each time, e.g. weights or weighted flux.
+    df : float
+        The frequency step, in 1 / day. 1 / df must exceed the baseline.
+    n_frequencies : int
+        The number of frequencies q * df, from q = 0, summed at.
+
+    Returns
+    -------
+    sums : numpy.ndarray
+        sum(weights * exp(2j pi q df (time - time.min()))) for every q, complex. The
+        weights are extirpolated onto a regular grid (Press & Rybicki 1989) and
+        transformed with one FFT, so the cost is O(N + M log M) rather than
+        O(N * n_frequencies).
+    '''
+    n_grid = 1 << int(np.ceil(np.log2(max(grid_factor * n_frequencies, order + 1))))
+    x = (time - time.min()) * df * n_grid
+
+    # Every point is spread over the order nearest grid nodes with Lagrange weights
+    first = np.floor(x).astype(np.int64) - (order // 2 - 1)
+    u = x - first
+    grid = np.zeros(n_grid)
+    for j in range(order):
+        coefficient = np.ones_like(u)
+        for other in range(order):
+            if other != j:
+                coefficient *= (u - other) / (j - other)
+        grid += np.bincount((first + j) % n_grid, weights * coefficient, n_grid)
+    return np.conj(np.fft.fft(grid)[:n_frequencies])
+
+
+def harmonic_periodogram(time, flux, flux_err=None, min_period=0.2, max_period=10.0, n_terms=2, oversample=5,
+                         mask=None):
+    '''
+    Parameters
+    ----------
+    time, flux : array-like
+        The light curve, in days. Do not detrend it with a window shorter than the
+        modulations searched.
+    flux_err : array-like, optional
+        The flux uncertainties. Without them every point has equal weight.
+    min_period, max_period : float, optional
+        The period range, in days.
+    n_terms : int, optional
+        The number of harmonics fitted jointly at each trial frequency, so a signal at
+        P and P / 2, like ellipsoidal variation with beaming, peaks at P.
+    oversample : int, optional
+        Frequency steps per 1 / baseline.
+    mask : array-like of bool, optional
+        True for points left out, e.g. transits and eclipses from detrend.transit_mask.
+
+    Returns
+    -------
+    periods, power : numpy.ndarray
+        The trial periods, longest first, and the fraction of the variance about the
+        weighted mean explained by the n_terms-harmonic model at each. Every sum over
+        the points comes from trig_sums, so the cost grows as N + F log F.
+    '''
+    time, flux, w = _prepare(time, flux, flux_err, mask)
+    baseline = time.max() - time.min()
+    df = 1 / (oversample * baseline)
+    start = max(int(np.ceil(1 / (max_period * df))), 1)
+    stop = int(np.floor(1 / (min_period * df)))
+    q = np.arange(start, stop + 1)
+    # Products of harmonics up to n_terms reach 2 * n_terms times the highest frequency
+    n_frequencies = 2 * n_terms * stop + 1
+
+    with stage('harmonic_periodogram', n_points=time.size, n_frequencies=q.size, n_terms=n_terms):
+        y = flux - np.average(flux, weights=w)
+        sums_w = trig_sums(time, w, df, n_frequencies)
+        sums_wy = trig_sums(time, w * y, df, n_frequencies)
+
+        # Normal equations of [1, cos(k w t), sin(k w t) for k = 1..n_terms] at every
+        # frequency, from cos a cos b = (cos(a - b) + cos(a + b)) / 2 and the like
+        def sum_w(k):
+            return sums_w[np.abs(k) * q] if k >= 0 else np.conj(sums_w[-k * q])
+
+        n_basis = 2 * n_terms + 1
+        normal = np.empty((q.size, n_basis, n_basis))
+        projection = np.empty((q.size, n_basis))
+        normal[:, 0, 0] = sums_w[0].real
+        projection[:, 0] = sums_wy[0].real
+        for a in range(1, n_terms + 1):
+            c, s = 2 * a - 1, 2 * a
+            normal[:, 0, c] = normal[:, c, 0] = sum_w(a).real
+            normal[:, 0, s] = normal[:, s, 0] = sum_w(a).imag
+            projection[:, c] = sums_wy[a * q].real
+            projection[:, s] = sums_wy[a * q].imag
+            for b in range(1, n_terms + 1):
+                difference, total = sum_w(a - b), sum_w(a + b)
+                normal[:, c, 2 * b - 1] = 0.5 * (difference.real + total.real)
+                normal[:, s, 2 * b] = 0.5 * (difference.real - total.real)
+                normal[:, s, 2 * b - 1] = 0.5 * (difference.imag + total.imag)
+                normal[:, c, 2 * b] = 0.5 * (total.imag - difference.imag)
+
+        coefficients = np.linalg.solve(normal, projection[..., None])[..., 0]
+        power = np.sum(coefficients * projection, axis=1) / np.sum(w * y ** 2)
+    return 1 / (q * df), power
+
+
+def fit_harmonics(time, flux, period, t0=0.0, n_harmonics=3, flux_err=None, mask=None):
+    '''
+    Parameters
+    ----------
+    time, flux : array-like
+        The light curve, in days.
+    period, t0 : float
+        The orbital period and a mid-transit time, in days.
+    n_harmonics : int, optional
+        The number of orbital harmonics fitted jointly, at period / k for k = 1 to
+        n_harmonics.
+    flux_err : array-like, optional
+        The flux uncertainties. Without them the errors are scaled by the scatter
+        about the fit.
+    mask : array-like of bool, optional
+        True for points left out, e.g. transits and eclipses.
+
+    Returns
+    -------
+    fit : HarmonicFit
+        The weighted least-squares coefficients. For a transit at phase 0, beaming is
+        a positive sin[0], ellipsoidal variation a negative cos[1] and reflected or
+        thermal light a negative cos[0].
+    '''
+    time, flux, w = _prepare(time, flux, flux_err, mask)
+    phase = 2 * np.pi * (time - t0) / period
+    k = np.arange(1, n_harmonics + 1)
+    design = np.empty((time.size, 2 * n_harmonics + 1))
+    design[:, 0] = 1.0
+    design[:, 1::2] = np.cos(phase[:, None] * k)
+    design[:, 2::2] = np.sin(phase[:, None] * k)
+
+    with stage('fit_harmonics', n_points=time.size, n_harmonics=n_harmonics):
+        normal = design.T @ (w[:, None] * design)
+        coefficients = np.linalg.solve(normal, design.T @ (w * flux))
+        covariance = np.linalg.inv(normal)
+        chi2 = float(np.sum(w * (flux - design @ coefficients) ** 2))
+    if flux_err is None:
+        covariance *= chi2 / max(time.size - design.shape[1], 1)
+
+    offset = coefficients[0]
+    cos, sin = coefficients[1::2] / offset, coefficients[2::2] / offset
+    cos_err = np.sqrt(np.diag(covariance)[1::2]) / abs(offset)
+    sin_err = np.sqrt(np.diag(covariance)[2::2]) / abs(offset)
+    amplitude = np.hypot(cos, sin)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        amplitude_err = np.hypot(cos * cos_err, sin * sin_err) / amplitude
+    return HarmonicFit(period, offset, cos, sin, cos_err, sin_err, amplitude, amplitude_err, chi2)
@@ -0,0 +1,491 @@
+import copy
+import hashlib
+import os
+from collections import namedtuple
+
+import numpy as np
+from astropy.timeseries import BoxLeastSquaresResults
+
+from detrend import transit_mask
+from period_grid import split_segments
+from profiling import stage
+from transit_timing import measure_duration
+
+# Elements of the (period, point) phase array built at once while adding data
+CHUNK_SIZE = 2 ** 22
+
+# One signal of iterative_bls_search: the periodogram peak it was found at, with the
+# duration measured from the stacked transits rather than the grid's, the number of
+# points its transits masked, and the periodogram it was the peak of
+Signal = namedtuple('Signal', ['period', 'transit_time', 'duration', 'depth', 'depth_snr', 'power', 'n_masked',
+                               'bls_result'])
+
+
+def accumulator_key(periods, durations, oversample=10, weighted=False):
+    '''
+    Returns
+    -------
+    key : str
+        A hex digest of the period and duration grids and the binning, which is all
+        an accumulator depends on besides the data added to it.
+    '''
+    digest = hashlib.sha1(f'{int(oversample)}:{bool(weighted)};'.encode())
+    for array in (periods, durations):
+        digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def sector_id(sector, weighted=False):
+    '''
+    Parameters
+    ----------
+    sector : lc_loader.Sector
+        A cleaned light curve of one file.
+
+    Returns
+    -------
+    source : str
+        The file name and a digest of its data, so a rewritten file counts as new.
+    '''
+    digest = hashlib.sha1()
+    for array in (sector.time, sector.flux, sector.flux_err if weighted else None):
+        if array is not None:
+            digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    return f'{sector.file}:{digest.hexdigest()}'
+
+
+class PeriodogramAccumulator:
+    '''
+    The weighted sums behind a box least-squares periodogram: for every trial period,
+    the sum of weights and of weighted flux in each phase bin, plus the totals over the
+    whole light curve. The sums are additive, so a new sector is folded in, or masked
+    points taken out, at a cost proportional to those points alone, and the periodogram
+    is then recomputed from the bins, without the light curve.
+
+    Each period's orbit is cut into equal phase bins no wider than the shortest
+    duration / oversample, as BoxLeastSquares does, and every duration is rounded to a
+    whole number of bins. Phases are taken from a fixed reference time, so sectors can
+    be added in any order.
+    '''
+
+    def __init__(self, periods, durations, oversample=10, reference_time=None):
+        '''
+        Parameters
+        ----------
+        periods, durations : float or array-like
+            The period and duration grids, in days. Every duration is tried at every
+            period, as in BoxLeastSquares.power.
+        oversample : int, optional
+            Phase bins per shortest duration.
+        reference_time : float, optional
+            The time of phase 0. Defaults to the first time added.
+        '''
+        self.periods = np.atleast_1d(np.asarray(periods, dtype=float))
+        self.durations = np.sort(np.atleast_1d(np.asarray(durations, dtype=float)))
+        if self.durations[0] <= 0 or self.durations[-1] >= self.periods.min():
+            raise ValueError('Durations must be positive and shorter than the shortest period')
+        self.oversample = int(oversample)
+        self.reference_time = reference_time
+
+        self.n_bins = np.ceil(self.periods * self.oversample / self.durations[0]).astype(np.intp)
+        self.offsets = np.concatenate(([0], np.cumsum(self.n_bins)))
+        self.sum_w = np.zeros(self.offsets[-1])
+        self.sum_wy = np.zeros(self.offsets[-1])
+        self.total_w = 0.0
+        self.total_wy = 0.0
+        self.shift = None
+        self.n_points = 0
+        self.sources = []
+
+    def _weights(self, time, flux, flux_err):
+        time = np.asarray(time, dtype=float)
+        flux = np.asarray(flux, dtype=float)
+        w = np.ones_like(flux) if flux_err is None else np.asarray(flux_err, dtype=float) ** -2.0
+        keep = np.isfinite(time) & np.isfinite(flux) & np.isfinite(w) & (w > 0)
+        return time[keep], flux[keep], w[keep]
+
+    def _accumulate(self, time, flux, w, weighted, sign):
+        wy = w * (flux - self.shift)
+
+        # Periods in chunks, so the (period, point) bin index array stays small
+        chunk = max(CHUNK_SIZE // time.size, 1)
+        for start in range(0, self.periods.size, chunk):
+            stop = min(start + chunk, self.periods.size)
+            lo, hi = self.offsets[start], self.offsets[stop]
+            # In place, and floor rather than np.mod, which is several times slower
+            phase = (time - self.reference_time)[None, :] / self.periods[start:stop, None]
+            phase -= np.floor(phase)
+            phase *= self.n_bins[start:stop, None]
+            index = phase.astype(np.intp)
+            np.minimum(index, self.n_bins[start:stop, None] - 1, out=index)
+            index += self.offsets[start:stop, None] - lo
+            index = index.ravel()
+            if weighted:
+                self.sum_w[lo:hi] += sign * np.bincount(index, np.tile(w, stop - start), hi - lo)
+            else:
+                self.sum_w[lo:hi] += sign * np.bincount(index, minlength=hi - lo)
+            self.sum_wy[lo:hi] += sign * np.bincount(index, np.tile(wy, stop - start), hi - lo)
+
+        self.total_w += sign * float(np.sum(w))
+        self.total_wy += sign * float(np.sum(wy))
+        self.n_points += int(sign) * time.size
+
+    def add(self, time, flux, flux_err=None, source=None):
+        '''
+        Parameters
+        ----------
+        time, flux : array-like
+            Points not added before, e.g. one new sector.
+        flux_err : array-like, optional
+            The flux uncertainties, giving weights 1 / flux_err**2. Without them every
+            point has weight 1; do not mix the two in one accumulator.
+        source : str, optional
+            A name recorded in sources, e.g. from sector_id.
+        '''
+        time, flux, w = self._weights(time, flux, flux_err)
+        if source is not None:
+            self.sources.append(source)
+        if time.size == 0:
+            return
+
+        with stage('bls_accumulate', n_points=time.size, n_periods=self.periods.size):
+            if self.reference_time is None:
+                self.reference_time = float(time.min())
+            # Sums are taken about the first mean flux so they do not cancel
+            if self.shift is None:
+                self.shift = float(np.average(flux, weights=w))
+            self._accumulate(time, flux, w, flux_err is not None, 1.0)
+
+    def remove(self, time, flux, flux_err=None):
+        '''
+        Parameters
+        ----------
+        time, flux, flux_err : array-like
+            Points added before, e.g. the in-transit points of a signal already found,
+            with the same flux errors, or none, as when they were added.
+
+        The points are taken back out of the sums, so the periodogram of the rest costs
+        a pass over the removed points only.
+        '''
+        time, flux, w = self._weights(time, flux, flux_err)
+        if time.size == 0:
+            return
+        if self.shift is None:
+            raise ValueError('Nothing has been added to remove points from')
+        with stage('bls_remove', n_points=time.size, n_periods=self.periods.size):
+            self._accumulate(time, flux, w, flux_err is not None, -1.0)
+
+    def copy(self):
+        '''
+        Returns
+        -------
+        accumulator : PeriodogramAccumulator
+            An independent copy, e.g. to remove points from while keeping the original.
+        '''
+        accumulator = copy.copy(self)
+        accumulator.sum_w = self.sum_w.copy()
+        accumulator.sum_wy = self.sum_wy.copy()
+        accumulator.sources = list(self.sources)
+        return accumulator
+
+    def power(self, objective='likelihood'):
+        '''
+        Parameters
+        ----------
+        objective : {'likelihood', 'snr'}, optional
+            The quantity maximized over transit time and duration at each period, as in
+            BoxLeastSquares.power.
+
+        Returns
+        -------
+        bls_result : astropy.timeseries.BoxLeastSquaresResults
+            The periodogram of every point added so far. Periods where no window holds
+            points both in and out of transit have power -inf.
+        '''
+        if objective not in ('likelihood', 'snr'):
+            raise ValueError(f"objective must be 'likelihood' or 'snr', not {objective!r}")
+        n_periods = self.periods.size
+        best = np.full(n_periods, -np.inf)
+        fields = {name: np.full(n_periods, np.nan)
+                  for name in ('depth', 'depth_err', 'duration', 'transit_time', 'depth_snr', 'log_likelihood')}
+
+        with stage('bls_accumulated_power', n_periods=n_periods, n_bins=self.sum_w.size):
+            # Periods with the same number of bins are searched together
+            for n_bins in np.unique(self.n_bins):
+                rows = np.flatnonzero(self.n_bins == n_bins)
+                width = self.periods[rows] / n_bins
+                # The durations of each period, as whole numbers of its bins
+                widths = np.unique(np.round(self.durations[None, :] / width[:, None]))
+                lo = np.searchsorted(self.durations, (widths[None, :] - 0.5) * width[:, None])
+                hi = np.searchsorted(self.durations, (widths[None, :] + 0.5) * width[:, None])
+                tried = hi > lo
+                widths = widths.astype(np.intp)
+
+                # Wrap the first bins past the end so windows across phase 1 are contiguous
+                index = self.offsets[rows, None] + np.arange(n_bins)
+                index = np.concatenate((index, index[:, :widths.max()]), axis=1)
+                zero = np.zeros((rows.size, 1))
+                cum_w = np.concatenate((zero, np.cumsum(self.sum_w[index], axis=1)), axis=1)
+                cum_wy = np.concatenate((zero, np.cumsum(self.sum_wy[index], axis=1)), axis=1)
+
+                for j, k in enumerate(widths):
+                    w_in = cum_w[:, k:k + n_bins] - cum_w[:, :n_bins]
+                    w_out = self.total_w - w_in
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        y_in = (cum_wy[:, k:k + n_bins] - cum_wy[:, :n_bins]) / w_in
+                        y_out = (self.total_wy - y_in * w_in) / w_out
+                        depth = y_out - y_in
+                        depth_err = np.sqrt(1 / w_in + 1 / w_out)
+                        log_likelihood = 0.5 * w_in * depth ** 2
+                        value = log_likelihood if objective == 'likelihood' else depth / depth_err
+                    valid = (w_in > np.finfo(float).eps) & (w_out > np.finfo(float).eps) & (depth >= 0)
+                    value = np.where(valid & tried[:, j, None], value, -np.inf)
+
+                    start = np.argmax(value, axis=1)
+                    pick = (np.arange(rows.size), start)
+                    better = value[pick] > best[rows]
+                    if not np.any(better):
+                        continue
+                    update = rows[better]
+                    best[update] = value[pick][better]
+                    fields['depth'][update] = depth[pick][better]
+                    fields['depth_err'][update] = depth_err[pick][better]
+                    fields['depth_snr'][update] = (depth / depth_err)[pick][better]
+                    fields['log_likelihood'][update] = log_likelihood[pick][better]
+                    fields['duration'][update] = k * width[better]
+                    fields['transit_time'][update] = self.reference_time + np.mod(
+                        (start[better] + 0.5 * k) * width[better], self.periods[update])
+
+        return BoxLeastSquaresResults(objective, self.periods, best, fields['depth'], fields['depth_err'],
+                                      fields['duration'], fields['transit_time'], fields['depth_snr'],
+                                      fields['log_likelihood'])
+
+    def save(self, path):
+        '''
+        Parameters
+        ----------
+        path : str
+            The .npz file to write. It is written next to its final name and swapped in,
+            so a crash never leaves a partial file.
+        '''
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as handle:
+            np.savez(handle, periods=self.periods, durations=self.durations, sum_w=self.sum_w,
+                     sum_wy=self.sum_wy, sources=np.array(self.sources, dtype=str),
+                     state=np.array([self.oversample, np.nan if self.reference_time is None else self.reference_time,
+                                     np.nan if self.shift is None else self.shift, self.total_w, self.total_wy,
+                                     self.n_points]))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Parameters
+        ----------
+        path : str
+            A file written by save.
+
+        Returns
+        -------
+        accumulator : PeriodogramAccumulator
+            The accumulator as it was saved.
+        '''
+        with np.load(path) as data:
+            oversample, reference_time, shift, total_w, total_wy, n_points = data['state']
+            accumulator = cls(data['periods'], data['durations'], int(oversample),
+                              None if np.isnan(reference_time) else float(reference_time))
+            accumulator.sum_w = data['sum_w']
+            accumulator.sum_wy = data['sum_wy']
+            accumulator.sources = [str(source) for source in data['sources']]
+        accumulator.shift = None if np.isnan(shift) else float(shift)
+        accumulator.total_w = float(total_w)
+        accumulator.total_wy = float(total_wy)
+        accumulator.n_points = int(n_points)
+        return accumulator
+
+
+def _points_path(points_dir, source):
+    # One file per sector, named from its source so a rewritten file gets a new one
+    return os.path.join(points_dir, hashlib.sha1(source.encode()).hexdigest() + '.npy')
+
+
+def accumulate_sectors(sectors, periods, durations, use_errors=False, oversample=10, cache_dir=None):
+    '''
+    Parameters
+    ----------
+    sectors : iterable of lc_loader.Sector
+        Every sector of the target, read one at a time, e.g. a generator over
+        iter_sectors(dir_path, cadence='lc').
+    periods, durations : float or array-like
+        The period and duration grids, in days. They have to stay the same from run to
+        run for the saved sums to be reused.
+    use_errors : bool, optional
+        Whether to weight points by their flux errors.
+    oversample : int, optional
+        Phase bins per shortest duration.
+    cache_dir : str, optional
+        The directory the sums are kept in, usually the target directory joined with
+        bls_cache.CACHE_DIR. If None, nothing is kept.
+
+    Returns
+    -------
+    accumulator : PeriodogramAccumulator
+        The sums of every sector. Only sectors not in the saved sums are added to them,
+        and only one sector is held in memory at a time. The points of every sector are
+        kept next to the sums, so a sector in the sums that is gone or has changed is
+        taken back out of them from its saved points once all sectors have been read.
+    '''
+    path = points_dir = None
+    accumulator = None
+    if cache_dir is not None:
+        key = accumulator_key(periods, durations, oversample, use_errors)
+        path = os.path.join(cache_dir, f'accumulator_{key}.npz')
+        points_dir = os.path.join(cache_dir, f'accumulator_{key}_sectors')
+        if os.path.exists(path):
+            accumulator = PeriodogramAccumulator.load(path)
+            # Sums without the points of a sector could not drop it, so they are rebuilt
+            if not all(os.path.exists(_points_path(points_dir, source)) for source in accumulator.sources):
+                accumulator = None
+
+    with stage('incremental_bls', n_periods=np.size(periods)) as record:
+        if accumulator is None:
+            accumulator = PeriodogramAccumulator(periods, durations, oversample)
+        seen = set()
+        n_new = 0
+        for sector in sectors:
+            source = sector_id(sector, use_errors)
+            seen.add(source)
+            if source in accumulator.sources:
+                continue
+            flux_err = sector.flux_err if use_errors else None
+            accumulator.add(sector.time, sector.flux, flux_err, source)
+            n_new += 1
+            if points_dir is not None:
+                os.makedirs(points_dir, exist_ok=True)
+                points_path = _points_path(points_dir, source)
+                with open(points_path + '.tmp', 'wb') as handle:
+                    np.save(handle, np.array([sector.time, sector.flux] + ([flux_err] if use_errors else [])))
+                os.replace(points_path + '.tmp', points_path)
+
+        stale = [source for source in accumulator.sources if source not in seen]
+        for source in stale:
+            points = np.load(_points_path(points_dir, source))
+            accumulator.remove(points[0], points[1], points[2] if use_errors else None)
+            accumulator.sources.remove(source)
+        record.set(n_sectors=len(seen), n_new_sectors=n_new, n_stale_sectors=len(stale))
+
+        if (n_new or stale) and path is not None:
+            accumulator.save(path)
+            # Only once the sums no longer hold them
+            for source in stale:
+                os.remove(_points_path(points_dir, source))
+    return accumulator
+
+
+def incremental_bls_power(sectors, periods, durations, use_errors=False, oversample=10,
+                          objective='likelihood', cache_dir=None):
+    '''
+    Parameters
+    ----------
+    sectors, periods, durations, use_errors, oversample, cache_dir
+        Passed on to accumulate_sectors.
+    objective : {'likelihood', 'snr'}, optional
+        Passed on to PeriodogramAccumulator.power.
+
+    Returns
+    -------
+    bls_result : astropy.timeseries.BoxLeastSquaresResults
+        The periodogram of every sector, with transit times in the sectors' time
+        system.
+    '''
+    return accumulate_sectors(sectors, periods, durations, use_errors, oversample, cache_dir).power(objective)
+
+
+def _alias_mask(periods, signal, baseline, max_harmonic):
+    # Periods within two peak widths of n / m times a found period, n, m <= max_harmonic.
+    # The width is that of one observing season, so the aliases between seasons are
+    # skipped too
+    ratios = np.unique([n / m for n in range(1, max_harmonic + 1) for m in range(1, max_harmonic + 1)])
+    aliases = signal.period * ratios
+    tolerance = 2 * signal.duration * aliases / baseline
+    return np.any(np.abs(periods[:, None] - aliases) < tolerance, axis=1)
+
+
+def iterative_bls_search(accumulator, time, flux, flux_err=None, n_signals=3, mask_width=1.5,
+                         min_mask_width=0.1, max_harmonic=4, objective='likelihood', min_snr=None):
+    '''
+    Parameters
+    ----------
+    accumulator : PeriodogramAccumulator
+        The sums of exactly the points given, e.g. from accumulate_sectors. It is not
+        changed; a copy is searched.
+    time, flux : array-like
+        The light curve the sums were built from.
+    flux_err : array-like, optional
+        The flux errors, if the sums were built with them.
+    n_signals : int, optional
+        The largest number of signals found.
+    mask_width : float, optional
+        The width of the window masked around each transit of a signal found, in
+        units of its duration. The duration is measured from the stacked transits with
+        transit_timing.measure_duration, since the grid duration of a BLS can be far
+        shorter than the transit, and is never taken shorter than the grid's.
+    min_mask_width : float, optional
+        The narrowest window masked, in days.
+    max_harmonic : int, optional
+        Later searches skip the periods n / m times a period already found, for n and
+        m up to max_harmonic, so a signal is not found again at an alias.
+    objective : {'likelihood', 'snr'}, optional
+        Passed on to PeriodogramAccumulator.power.
+    min_snr : float, optional
+        The search stops at the first peak with a lower depth SNR. Without flux errors
+        the SNR is taken against the scatter of the points not yet masked.
+
+    Returns
+    -------
+    signals : list of Signal
+        The strongest signal, then the strongest once its transits are masked, and so
+        on. The sums, the period grid and the phase bins are built once; each further
+        signal costs removing its in-transit points from the bins and recomputing the
+        periodogram from them, rather than a new BLS over the whole light curve.
+    '''
+    accumulator = accumulator.copy()
+    time = np.asarray(time, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    flux_err = None if flux_err is None else np.asarray(flux_err, dtype=float)
+    masked = np.zeros(time.size, dtype=bool)
+    signals = []
+    sorted_time = np.sort(time)
+    baseline = max([sorted_time[segment][-1] - sorted_time[segment][0]
+                    for segment in split_segments(sorted_time) if segment.stop > segment.start] or [1.0])
+    excluded = None
+
+    with stage('iterative_bls', n_points=time.size, n_signals=n_signals) as record:
+        for _ in range(n_signals):
+            bls_result = accumulator.power(objective)
+            if excluded is None:
+                excluded = np.zeros(bls_result.period.size, dtype=bool)
+            power = np.where(excluded, -np.inf, bls_result.power)
+            index = np.argmax(power)
+            if not np.isfinite(power[index]):
+                break
+            # Without flux errors the sums assume unit noise, so scale by the actual scatter
+            noise = 1.0 if flux_err is not None else np.nanstd(flux[~masked])
+            depth_snr = bls_result.depth_snr[index] / noise
+            if min_snr is not None and depth_snr < min_snr:
+                break
+            period = bls_result.period[index]
+            transit_time = bls_result.transit_time[index]
+            duration = bls_result.duration[index]
+            measured = measure_duration(time[~masked], flux[~masked], period, transit_time, 0.25 * period)
+            if np.isfinite(measured):
+                duration = max(duration, measured)
+            new = transit_mask(time, period, transit_time, max(mask_width * duration, min_mask_width)) & ~masked
+            signal = Signal(period, transit_time, duration, bls_result.depth[index], depth_snr,
+                            bls_result.power[index], int(np.sum(new)), bls_result)
+            signals.append(signal)
+            accumulator.remove(time[new], flux[new], None if flux_err is None else flux_err[new])
+            masked |= new
+            excluded |= _alias_mask(bls_result.period, signal, baseline, max_harmonic)
+        record.set(n_found=len(signals))
+    return signals
@@ -0,0 +1,238 @@
+import hashlib
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from lc_store import LightCurveStore, parse_product, parse_sector, read_columns
+from profiling import stage
+
+# TESS QUALITY bits treated as bad data by every step
+QUALITY_MASK = 0b0101001010111111
+
+# Cache folder created inside each target directory
+CACHE_DIR = '.lc_cache'
+
+# How sectors with both a 120 s and a 20 s product are read:
+# None keeps every file, 'lc' and 'fast' keep one product per sector (preferring 120 s
+# or 20 s), and 'coadd' averages the 20 s data onto the 120 s time grid
+CADENCES = (None, 'lc', 'fast', 'coadd')
+
+# The 120 s cadence, in days
+LC_CADENCE = 120 / 86400
+
+Sector = namedtuple('Sector', ['file', 'sector', 'time', 'flux', 'flux_err'])
+
+
+def list_fits_files(dir_path):
+    '''
+    Parameters
+    ----------
+    dir_path : str
+        The directory holding the .fits files of one target.
+
+    Returns
+    -------
+    files : list
+        The .fits file names in the directory, sorted so sectors come in order.
+    '''
+    return sorted(f for f in os.listdir(dir_path) if f.endswith('.fits'))
+
+
+def _cache_key(dir_path, files, quality_mask, cadence):
+    # The key changes whenever a file is added, removed or rewritten, or the options change
+    digest = hashlib.sha1(f'{int(quality_mask)}:{cadence}'.encode())
+    for name in files:
+        stat = os.stat(os.path.join(dir_path, name))
+        digest.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return digest.hexdigest()
+
+
+def _prune_cache(cache_dir, prefix, keep):
+    # Only the newest light curve of a cadence is ever read again, so older ones go
+    for name in os.listdir(cache_dir):
+        if name.startswith(prefix) and name.endswith('.npy') and name != keep:
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+
+def _clean_sector(name, time, flux, flux_err, quality, quality_mask):
+    # Masking bad data
+    valid_indices = np.isfinite(time) & (~np.isnan(flux)) & (np.bitwise_and(quality, quality_mask) == 0)
+    masked_flux = flux[valid_indices].astype(float)
+    masked_err = flux_err[valid_indices].astype(float)
+
+    if masked_flux.size > 0:  # Check for valid flux data
+        median = np.median(masked_flux)
+        masked_flux /= median
+        masked_err /= median
+    return Sector(name, parse_sector(name), time[valid_indices].astype(float), masked_flux, masked_err)
+
+
+def coadd(sector, grid_time=None, cadence=LC_CADENCE, min_count=3):
+    '''
+    Parameters
+    ----------
+    sector : Sector
+        A cleaned 20 s light curve.
+    grid_time : numpy.ndarray, optional
+        The mid-exposure times of the 120 s product of the same sector. The co-added
+        bins are centered on this grid; without it they start at the first 20 s point.
+    cadence : float, optional
+        The width, in days, of the co-added bins.
+    min_count : int, optional
+        Bins with fewer valid 20 s points are dropped.
+
+    Returns
+    -------
+    coadded : Sector
+        The mean flux in each bin, with its error propagated from the 20 s errors as
+        sqrt(sum(err**2)) / n.
+    '''
+    if grid_time is not None and grid_time.size:
+        # Anchor on the grid point nearest the data so long gaps do not shift the bins
+        anchor = grid_time[np.argmin(np.abs(grid_time - sector.time[0]))] - 0.5 * cadence
+        anchor -= np.ceil((anchor - sector.time[0]) / cadence) * cadence
+    else:
+        anchor = sector.time[0]
+    index = np.floor((sector.time - anchor) / cadence).astype(np.intp)
+    n_bins = index.max() + 1
+
+    count = np.bincount(index, minlength=n_bins)
+    keep = count >= min_count
+    with np.errstate(invalid='ignore', divide='ignore'):
+        flux = np.bincount(index, sector.flux, n_bins)[keep] / count[keep]
+        flux_err = np.sqrt(np.bincount(index, sector.flux_err ** 2, n_bins)[keep]) / count[keep]
+    time = anchor + (np.flatnonzero(keep) + 0.5) * cadence
+    return Sector(sector.file, sector.sector, time, flux, flux_err)
+
+
+def _plan(files, cadence):
+    # Group the files of each sector, keeping the sectors in file order
+    if cadence not in CADENCES:
+        raise ValueError(f'cadence must be one of {CADENCES}, not {cadence!r}')
+    if cadence is None:
+        return [(name, None) for name in files]
+
+    groups = {}
+    for name in files:
+        key = parse_sector(name)
+        groups.setdefault(name if key is None else key, {})[parse_product(name)] = name
+
+    plan = []
+    for products in groups.values():
+        if cadence == 'coadd' and 'fast' in products:
+            plan.append((products['fast'], products.get('lc', '')))
+        elif (cadence == 'fast' and 'fast' in products) or 'lc' not in products:
+            plan.append((products['fast'], None))
+        else:
+            plan.append((products['lc'], None))
+    return plan
+
+
+def iter_sectors(dir_path, quality_mask=QUALITY_MASK, cadence=None):
+    '''
+    Parameters
+    ----------
+    dir_path : str
+        The directory holding the .fits files of one target.
+    quality_mask : int, optional
+        QUALITY bits that flag a cadence as bad data.
+    cadence : {None, 'lc', 'fast', 'coadd'}, optional
+        How sectors with both a 120 s and a 20 s product are read. None yields every
+        file, so the same photons appear twice. 'lc' and 'fast' yield one product per
+        sector, preferring the 120 s or the 20 s one. 'coadd' averages the 20 s data
+        onto the 120 s time grid and yields that instead of the 120 s product.
+
+    Yields
+    ------
+    sector : Sector
+        The quality-masked light curve of one file, normalized by its median flux, in
+        file order. Files without valid data are skipped. Only one file is held in
+        memory at a time: it comes from the store when that is current, and is read
+        from its .fits file otherwise.
+    '''
+    store = LightCurveStore.open(dir_path, refresh=False)
+    entries = {entry['file']: entry for entry in store.entries} if store.is_current() else None
+
+    def read(name):
+        if entries is not None:
+            return store.read(entries[name])
+        return read_columns(os.path.join(dir_path, name))
+
+    for name, grid_name in _plan(list_fits_files(dir_path), cadence):
+        sector = _clean_sector(name, *read(name), quality_mask)
+        if sector.time.size > 0 and grid_name is not None:
+            sector = coadd(sector, read(grid_name).time if grid_name else None)
+        if sector.time.size > 0:
+            yield sector
+
+
+def _read_store(dir_path, quality_mask, cadence):
+    # Size the output once from the store instead of growing it per sector
+    data = np.empty((2, len(LightCurveStore.open(dir_path))))
+    n_valid = 0
+
+    for sector in iter_sectors(dir_path, quality_mask, cadence):
+        end = n_valid + sector.time.size
+        data[0, n_valid:end] = sector.time
+        data[1, n_valid:end] = sector.flux
+        n_valid = end
+    data = data[:, :n_valid]
+
+    if cadence is not None:
+        # One product per sector: sort across sectors and drop repeated timestamps
+        if np.any(np.diff(data[0]) < 0):
+            data = data[:, np.argsort(data[0], kind='stable')]
+        data = data[:, np.concatenate(([True], np.diff(data[0]) > 0))]
+
+    return np.ascontiguousarray(data)
+
+
+def load_light_curve(dir_path, quality_mask=QUALITY_MASK, use_cache=True, cadence=None):
+    '''
+    Parameters
+    ----------
+    dir_path : str
+        The directory holding the .fits files of one target.
+    quality_mask : int, optional
+        QUALITY bits that flag a cadence as bad data.
+    use_cache : bool, optional
+        Whether to read from and write to the on-disk cache in dir_path.
+    cadence : {None, 'lc', 'fast', 'coadd'}, optional
+        How sectors with both a 120 s and a 20 s product are read, see iter_sectors.
+
+    Returns
+    -------
+    time, flux : numpy.ndarray
+        The quality-masked light curve of every sector, each sector normalized by its
+        median flux, concatenated in sector order. With a cadence other than None the
+        result is also sorted by time and free of duplicate timestamps.
+    '''
+    files = list_fits_files(dir_path)
+    prefix = f'{cadence}-'
+    cache_path = os.path.join(dir_path, CACHE_DIR,
+                              prefix + _cache_key(dir_path, files, quality_mask, cadence) + '.npy')
+
+    with stage('load_light_curve', n_files=len(files), cadence=str(cadence)) as record:
+        if use_cache and os.path.exists(cache_path):
+            data = np.load(cache_path)
+            record.set(n_points=data.shape[1], cached=True)
+            return data[0], data[1]
+
+        with stage('read_store', n_files=len(files)):
+            data = _read_store(dir_path, quality_mask, cadence)
+        record.set(n_points=data.shape[1], cached=False)
+
+        if use_cache:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            # Write next to the final name and swap it in so a crash never leaves a partial cache
+            tmp_path = cache_path + '.tmp'
+            with open(tmp_path, 'wb') as handle:
+                np.save(handle, data)
+            os.replace(tmp_path, cache_path)
+            _prune_cache(os.path.dirname(cache_path), prefix, os.path.basename(cache_path))
+
+    return data[0], data[1]
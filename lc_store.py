@@ -0,0 +1,275 @@
+import json
+import os
+import re
+from collections import namedtuple
+
+import numpy as np
+
+from fits_table import read_bintable
+from profiling import stage
+
+# Store folder created inside each target directory, next to the downloaded .fits files
+STORE_DIR = '.lc_store'
+
+# FITS column -> (store column, native dtype)
+COLUMNS = {
+    'TIME': ('time', np.float64),
+    'PDCSAP_FLUX': ('flux', np.float32),
+    'PDCSAP_FLUX_ERR': ('flux_err', np.float32),
+    'QUALITY': ('quality', np.int32),
+}
+
+INDEX_VERSION = 1
+
+SectorColumns = namedtuple('SectorColumns', ['time', 'flux', 'flux_err', 'quality'])
+
+
+def parse_sector(filename):
+    '''
+    Parameters
+    ----------
+    filename : str
+        A SPOC light-curve file name, e.g. tess2020238165205-s0029-0000000100100827-0193-s_lc.fits.
+
+    Returns
+    -------
+    sector : int or None
+        The TESS sector encoded in the name, or None if it has no -sNNNN- field.
+    '''
+    match = re.search(r'-s(\d{4})-', filename)
+    return int(match.group(1)) if match else None
+
+
+def parse_product(filename):
+    '''
+    Returns
+    -------
+    product : {'lc', 'fast'}
+        'fast' for a 20 s a_fast-lc.fits product, 'lc' otherwise.
+    '''
+    return 'fast' if filename.endswith('a_fast-lc.fits') else 'lc'
+
+
+def _file_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def read_columns(path):
+    '''
+    Parameters
+    ----------
+    path : str
+        A light-curve .fits file.
+
+    Returns
+    -------
+    columns : SectorColumns
+        The stored columns as native-endian arrays, read without building the full
+        table. Only rows with a finite TIME are kept, so every sector is sorted and
+        searchable.
+    '''
+    columns = read_bintable(path, list(COLUMNS))
+    columns = [column.astype(dtype, copy=False) for column, (_, dtype) in zip(columns, COLUMNS.values())]
+    keep = np.isfinite(columns[0])
+    return SectorColumns(*[column[keep] for column in columns])
+
+
+class LightCurveStore:
+    '''
+    Memory-mapped, columnar copy of every light-curve file of one target.
+
+    Each column is one contiguous .npy file holding all sectors back to back; index.json
+    records the row range and time range of every file. Sector and time-window reads
+    return views into the memory maps, so nothing is copied until the data is touched.
+    '''
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        self.store_path = os.path.join(dir_path, STORE_DIR)
+        self.entries = []
+        self._columns = None
+
+    def __len__(self):
+        return self.entries[-1]['stop'] if self.entries else 0
+
+    @classmethod
+    def open(cls, dir_path, refresh=True):
+        '''
+        Parameters
+        ----------
+        dir_path : str
+            The directory holding the .fits files of one target.
+        refresh : bool, optional
+            Whether to check the .fits files against the index and rebuild the store if
+            any were added, removed or rewritten.
+
+        Returns
+        -------
+        store : LightCurveStore
+        '''
+        store = cls(dir_path)
+        store._load_index()
+        if refresh and not store.is_current():
+            store.build()
+        return store
+
+    def _load_index(self):
+        index_path = os.path.join(self.store_path, 'index.json')
+        try:
+            with open(index_path) as handle:
+                index = json.load(handle)
+        except (OSError, ValueError):
+            return
+        if index.get('version') == INDEX_VERSION:
+            self.entries = index['files']
+
+    def _fits_files(self):
+        return sorted(f for f in os.listdir(self.dir_path) if f.endswith('.fits'))
+
+    def is_current(self):
+        '''
+        Returns
+        -------
+        current : bool
+            True if the index covers exactly the .fits files on disk, unchanged.
+        '''
+        files = self._fits_files()
+        if [entry['file'] for entry in self.entries] != files:
+            return False
+        return all(entry['stamp'] == _file_stamp(os.path.join(self.dir_path, entry['file']))
+                   for entry in self.entries)
+
+    def build(self):
+        '''
+        Rewrite the store from the .fits files. Files that are unchanged since the last
+        build are copied over from the existing memory maps instead of being re-parsed.
+        '''
+        files = self._fits_files()
+        previous = {entry['file']: entry for entry in self.entries}
+        try:
+            old_columns = self.columns() if self.entries else None
+        except OSError:
+            old_columns = None
+
+        parts, entries, offset = [], [], 0
+        for name in files:
+            path = os.path.join(self.dir_path, name)
+            stamp = _file_stamp(path)
+            old = previous.get(name)
+            if old is not None and old['stamp'] == stamp and old_columns is not None:
+                columns = [column[old['start']:old['stop']] for column in old_columns]
+            else:
+                with stage('read_fits', file=name) as record:
+                    columns = read_columns(path)
+                    record.set(n_points=columns[0].size)
+            n_rows = columns[0].size
+            entries.append({
+                'file': name,
+                'sector': parse_sector(name),
+                'product': parse_product(name),
+                'start': offset,
+                'stop': offset + n_rows,
+                'tmin': float(columns[0][0]) if n_rows else None,
+                'tmax': float(columns[0][-1]) if n_rows else None,
+                'stamp': stamp,
+            })
+            parts.append(columns)
+            offset += n_rows
+
+        os.makedirs(self.store_path, exist_ok=True)
+        # Write every column under a temporary name first; the index is swapped in last
+        with stage('write_store', n_files=len(files), n_points=offset):
+            for position, (name, dtype) in enumerate(COLUMNS.values()):
+                tmp_path = os.path.join(self.store_path, name + '.npy.tmp')
+                out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(offset,))
+                for entry, columns in zip(entries, parts):
+                    out[entry['start']:entry['stop']] = columns[position]
+                out.flush()
+                del out
+        # Drop the old maps before the column files they point at are replaced
+        self._columns = None
+        del old_columns, parts
+        for name, _ in COLUMNS.values():
+            os.replace(os.path.join(self.store_path, name + '.npy.tmp'),
+                       os.path.join(self.store_path, name + '.npy'))
+
+        tmp_index = os.path.join(self.store_path, 'index.json.tmp')
+        with open(tmp_index, 'w') as handle:
+            json.dump({'version': INDEX_VERSION, 'files': entries}, handle, indent=1)
+        os.replace(tmp_index, os.path.join(self.store_path, 'index.json'))
+        self.entries = entries
+
+    def columns(self):
+        '''
+        Returns
+        -------
+        columns : SectorColumns
+            Read-only memory maps of every column over all sectors.
+        '''
+        if self._columns is None:
+            if not self.entries:
+                empty = [np.empty(0, dtype) for _, dtype in COLUMNS.values()]
+                return SectorColumns(*empty)
+            self._columns = SectorColumns(*[
+                np.load(os.path.join(self.store_path, name + '.npy'), mmap_mode='r')
+                for name, _ in COLUMNS.values()])
+        return self._columns
+
+    def select(self, sector=None, product=None):
+        '''
+        Parameters
+        ----------
+        sector : int, optional
+            Only return files of this TESS sector.
+        product : {'lc', 'fast'}, optional
+            Only return 120 s ('lc') or 20 s ('fast') products.
+
+        Returns
+        -------
+        entries : list of dict
+            The matching index entries, in file order.
+        '''
+        return [entry for entry in self.entries
+                if (sector is None or entry['sector'] == sector)
+                and (product is None or entry['product'] == product)]
+
+    def read(self, entry, tmin=None, tmax=None):
+        '''
+        Parameters
+        ----------
+        entry : dict
+            An index entry returned by select.
+        tmin, tmax : float, optional
+            Restrict the rows to tmin <= TIME <= tmax.
+
+        Returns
+        -------
+        columns : SectorColumns
+            Zero-copy views of the requested rows.
+        '''
+        start, stop = entry['start'], entry['stop']
+        columns = self.columns()
+        if tmin is not None or tmax is not None:
+            time = columns.time[start:stop]
+            lo = 0 if tmin is None else int(np.searchsorted(time, tmin, side='left'))
+            hi = time.size if tmax is None else int(np.searchsorted(time, tmax, side='right'))
+            start, stop = start + lo, start + hi
+        return SectorColumns(*[column[start:stop] for column in columns])
+
+    def window(self, tmin, tmax, product=None):
+        '''
+        Parameters
+        ----------
+        tmin, tmax : float
+            The time range to read, in the units of the TIME column.
+        product : {'lc', 'fast'}, optional
+            Only read 120 s ('lc') or 20 s ('fast') products.
+
+        Returns
+        -------
+        windows : list of (dict, SectorColumns)
+            The index entry and zero-copy column views of every file overlapping the range.
+        '''
+        return [(entry, self.read(entry, tmin, tmax)) for entry in self.select(product=product)
+                if entry['tmin'] is not None and entry['tmax'] >= tmin and entry['tmin'] <= tmax]
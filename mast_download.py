@@ -0,0 +1,195 @@
+import hashlib
+import http.client
+import os
+import time
+import urllib.error
+import urllib.request
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from astropy.io import fits
+
+from mast_manifest import parse_product_filename
+
+# MAST serves any product through this endpoint given its dataURI
+MAST_DOWNLOAD_URL = 'https://mast.stsci.edu/api/v0.1/Download/file?uri='
+
+# HTTP statuses worth retrying; anything else in the 4xx range is a real error
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+CHUNK_SIZE = 1 << 20
+
+DownloadJob = namedtuple('DownloadJob', ['url', 'filename', 'size', 'md5'], defaults=(None, None))
+
+
+def tess_lc_jobs(data_products, tic_id, base_url=MAST_DOWNLOAD_URL):
+    '''
+    Parameters
+    ----------
+    data_products : astropy.table.Table
+        A product list returned by Observations.get_product_list or
+        mast_manifest.query_products.
+    tic_id : int or str
+        The TESS Input Catalog value of the target.
+    base_url : str, optional
+        The URL prefix each product dataURI is appended to.
+
+    Returns
+    -------
+    jobs : list of DownloadJob
+        One job per unique light-curve product of the target.
+    '''
+    jobs = {}
+    for row in data_products:
+        name = str(row['productFilename'])
+        product = parse_product_filename(name)
+        if product is not None and product.tic_id == int(tic_id) and name not in jobs:
+            size = row['size'] if 'size' in data_products.colnames else None
+            jobs[name] = DownloadJob(base_url + str(row['dataURI']), name,
+                                     int(size) if size else None)
+    return list(jobs.values())
+
+
+def verify_file(path, size=None, md5=None):
+    '''
+    Parameters
+    ----------
+    path : str
+        The file to check.
+    size : int, optional
+        The expected size in bytes.
+    md5 : str, optional
+        The expected MD5 hex digest.
+
+    Returns
+    -------
+    valid : bool
+        True if the file exists, matches the size and digest when given, and, for .fits
+        files, passes the CHECKSUM/DATASUM keywords of every HDU that carries them.
+    '''
+    if not os.path.isfile(path):
+        return False
+    if size is not None and os.path.getsize(path) != size:
+        return False
+
+    if md5 is not None:
+        digest = hashlib.md5()
+        with open(path, 'rb') as handle:
+            for chunk in iter(lambda: handle.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        if digest.hexdigest() != md5.lower():
+            return False
+
+    if path.endswith('.fits'):
+        try:
+            with fits.open(path, memmap=True) as hdul:
+                # verify_* return 0 on a mismatch and 2 when the keyword is absent
+                for hdu in hdul:
+                    if hdu.verify_checksum() == 0 or hdu.verify_datasum() == 0:
+                        return False
+        except (OSError, ValueError):
+            return False
+
+    return True
+
+
+def _is_transient(error):
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code in RETRY_STATUSES
+    # A connection dropped mid-body surfaces as IncompleteRead or ConnectionResetError
+    return isinstance(error, (urllib.error.URLError, http.client.IncompleteRead, ConnectionResetError,
+                              ConnectionError, TimeoutError))
+
+
+def _fetch(job, path, timeout):
+    # Resume a partial download when the server honours byte ranges
+    part_path = path + '.part'
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    request = urllib.request.Request(job.url)
+    if offset:
+        request.add_header('Range', f'bytes={offset}-')
+
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        mode = 'ab' if offset and response.status == 206 else 'wb'
+        expected = response.headers.get('Content-Length')
+        received = 0
+        with open(part_path, mode) as handle:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                handle.write(chunk)
+                received += len(chunk)
+
+    if expected is not None and received < int(expected):
+        # read() ends quietly when the connection drops; the .part file is kept so the
+        # retry resumes from it
+        raise http.client.IncompleteRead(b'', int(expected) - received)
+    os.replace(part_path, path)
+    if not verify_file(path, job.size, job.md5):
+        # A corrupt transfer is treated like a dropped connection so it gets retried
+        os.remove(path)
+        raise ConnectionError(f'{job.filename} failed size or checksum verification')
+
+
+def download_job(job, target_dir, retries=3, backoff=1.0, timeout=60):
+    '''
+    Parameters
+    ----------
+    job : DownloadJob
+        The file to fetch.
+    target_dir : str
+        The directory the file is written to under job.filename.
+    retries : int, optional
+        How many times a transient failure is retried.
+    backoff : float, optional
+        The delay, in seconds, before the first retry. It doubles on every retry.
+    timeout : float, optional
+        The socket timeout, in seconds, of each request.
+
+    Returns
+    -------
+    downloaded : bool
+        True if the file was fetched, False if a verified copy was already present.
+    '''
+    path = os.path.join(target_dir, job.filename)
+    if verify_file(path, job.size, job.md5):
+        return False
+
+    for attempt in range(retries + 1):
+        try:
+            _fetch(job, path, timeout)
+            return True
+        except Exception as error:
+            if attempt == retries or not _is_transient(error):
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+def download_files(jobs, target_dir, max_workers=4, retries=3, backoff=1.0, timeout=60):
+    '''
+    Parameters
+    ----------
+    jobs : list of DownloadJob
+        The files to fetch.
+    target_dir : str
+        The directory every file is written to.
+    max_workers : int, optional
+        The number of downloads running at once.
+    retries, backoff, timeout : optional
+        Passed on to download_job.
+
+    Returns
+    -------
+    failed : list
+        The file names that could not be downloaded.
+    '''
+    os.makedirs(target_dir, exist_ok=True)
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(download_job, job, target_dir, retries, backoff, timeout): job
+                   for job in jobs}
+        for future, job in futures.items():
+            try:
+                future.result()
+            except Exception as error:
+                print(f'Could not download {job.filename}: {error}')
+                failed.append(job.filename)
+    return failed
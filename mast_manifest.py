@@ -0,0 +1,208 @@
+import argparse
+import hashlib
+import os
+import re
+import time
+from collections import namedtuple
+
+import numpy as np
+from astropy.table import Table
+
+# Cache folder created inside the download directory
+MANIFEST_DIR = '.mast_manifest'
+
+# How long, in seconds, a manifest is used before MAST is asked again
+DEFAULT_TTL = 7 * 86400
+
+# Set to 1 to answer every query from the manifests, e.g. on a mirrored data set
+OFFLINE_ENV = 'WASP18_OFFLINE'
+
+# SPOC light-curve names: tess<timestamp>-s<sector>-<TIC>-<scid>-s_lc.fits (120 s) or
+# ...-a_fast-lc.fits (20 s)
+TESS_LC_NAME = re.compile(r'^tess(\d{13})-s(\d{4})-(\d{16})-(\d{4})-(s_lc|a_fast-lc)\.fits$')
+
+CADENCES = {'s_lc': 120, 'a_fast-lc': 20}
+
+# sector: the TESS sector; tic_id: the TESS Input Catalog value; cadence: in seconds
+ProductName = namedtuple('ProductName', ['sector', 'tic_id', 'cadence'])
+
+
+def parse_product_filename(name):
+    '''
+    Parameters
+    ----------
+    name : str
+        A MAST product file name.
+
+    Returns
+    -------
+    parsed : ProductName or None
+        The sector, TIC and cadence of a SPOC light curve, or None for any other file.
+    '''
+    match = TESS_LC_NAME.match(os.path.basename(str(name)))
+    if match is None:
+        return None
+    return ProductName(int(match.group(2)), int(match.group(3)), CADENCES[match.group(5)])
+
+
+def manifest_key(ra, dec, radius):
+    '''
+    Returns
+    -------
+    key : str
+        A hex digest of the cone query, naming its manifest file.
+    '''
+    return hashlib.sha1(repr((float(ra), float(dec), float(radius))).encode()).hexdigest()
+
+
+def is_offline():
+    '''
+    Returns
+    -------
+    offline : bool
+        True if WASP18_OFFLINE is set to 1, true or yes.
+    '''
+    return os.environ.get(OFFLINE_ENV, '').lower() in ('1', 'true', 'yes')
+
+
+def _query_mast(ra, dec, radius):
+    # Imported here so planning from the manifests never pays for astroquery
+    from astroquery.mast import Observations
+
+    obs_table = Observations.query_criteria(
+        s_ra=[float(ra) - radius, float(ra) + radius],
+        s_dec=[float(dec) - radius, float(dec) + radius],
+        calib_level=3,
+        obs_collection='TESS',
+        dataproduct_type='TIMESERIES'
+    )
+    if len(obs_table) == 0:
+        return Table()
+    return Observations.get_product_list(obs_table)
+
+
+def _light_curves(data_products):
+    # The unique SPOC light curves of a product list, with their parsed names
+    rows, names, parsed = [], set(), []
+    for index, name in enumerate(data_products['productFilename'] if len(data_products) else []):
+        product = parse_product_filename(name)
+        if product is not None and str(name) not in names:
+            names.add(str(name))
+            rows.append(index)
+            parsed.append(product)
+    if rows:
+        products = data_products[rows]
+    else:
+        products = Table({'productFilename': np.array([], dtype=str), 'dataURI': np.array([], dtype=str),
+                          'size': np.array([], dtype=np.int64)})
+    for field, dtype in zip(ProductName._fields, (np.int16, np.int64, np.int16)):
+        products[field] = np.array([getattr(product, field) for product in parsed], dtype=dtype)
+    return products
+
+
+def query_products(ra, dec, tic_id=None, radius=0.01, cache_dir=MANIFEST_DIR, ttl=DEFAULT_TTL, refresh=False,
+                   offline=None):
+    '''
+    Parameters
+    ----------
+    ra, dec : float
+        The target position, in degrees.
+    tic_id : int, optional
+        The TESS Input Catalog value of the target. Without it every light curve in
+        the search box is returned.
+    radius : float, optional
+        The half width, in degrees, of the search box, as in Bulk_TESS_lc_Query.
+    cache_dir : str, optional
+        Where the manifests are kept, one ECSV file per query.
+    ttl : float, optional
+        The age, in seconds, after which a manifest is queried again.
+    refresh : bool, optional
+        Whether to query MAST whatever the manifest's age.
+    offline : bool, optional
+        Whether to use the manifest whatever its age and never query MAST. Defaults to
+        is_offline().
+
+    Returns
+    -------
+    products : astropy.table.Table
+        The product list rows of the SPOC light curves (120 s and 20 s), with the
+        sector, tic_id and cadence parsed from their file names, ready for
+        Observations.download_products or mast_download.tess_lc_jobs. If MAST cannot
+        be reached, an expired manifest is used.
+    '''
+    offline = is_offline() if offline is None else offline
+    path = os.path.join(cache_dir, f'manifest_{manifest_key(ra, dec, radius)}.ecsv')
+    products = Table.read(path, format='ascii.ecsv') if os.path.exists(path) else None
+
+    if products is None and offline:
+        raise FileNotFoundError(f'No MAST manifest for RA {ra}, Dec {dec} in {cache_dir} while offline')
+    expired = products is None or time.time() - products.meta['created'] > ttl
+    if not offline and (refresh or expired):
+        try:
+            fresh = _light_curves(_query_mast(ra, dec, radius))
+        except Exception as error:
+            if products is None:
+                raise
+            print(f'Could not query MAST ({error}); using the manifest from '
+                  f'{time.ctime(products.meta["created"])}')
+        else:
+            products = fresh
+            products.meta.update({'created': time.time(), 'ra': float(ra), 'dec': float(dec),
+                                  'radius': float(radius)})
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write next to the final name and swap it in so a crash never leaves a partial manifest
+            tmp_path = path + '.tmp'
+            products.write(tmp_path, format='ascii.ecsv', overwrite=True)
+            os.replace(tmp_path, path)
+
+    if tic_id is not None:
+        products = products[products['tic_id'] == int(tic_id)]
+    return products
+
+
+def missing_products(products, target_dir):
+    '''
+    Parameters
+    ----------
+    products : astropy.table.Table
+        Rows from query_products.
+    target_dir : str
+        The directory the light curves are downloaded to.
+
+    Returns
+    -------
+    missing : astropy.table.Table
+        The rows whose file is absent or, when the size is known, of another size.
+        Checksums are left to mast_download.verify_file.
+    '''
+    keep = []
+    for row in products:
+        path = os.path.join(target_dir, str(row['productFilename']))
+        size = row['size'] if 'size' in products.colnames and not np.ma.is_masked(row['size']) else None
+        keep.append(not os.path.isfile(path) or (size is not None and os.path.getsize(path) != int(size)))
+    return products[np.array(keep, dtype=bool)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List the TESS light curves of a target and those not yet '
+                                                 'downloaded, from the cached MAST manifest when it is fresh.')
+    parser.add_argument('ra', type=float, help='Right Ascension, in degrees')
+    parser.add_argument('dec', type=float, help='Declination, in degrees')
+    parser.add_argument('tic_id', type=int, help='TESS Input Catalog value')
+    parser.add_argument('target_dir', help='Directory the light curves are downloaded to')
+    parser.add_argument('--radius', type=float, default=0.01, help='Half width of the search box, in degrees')
+    parser.add_argument('--cache-dir', help='Manifest folder; defaults to .mast_manifest next to target_dir')
+    parser.add_argument('--ttl', type=float, default=DEFAULT_TTL, help='Manifest lifetime, in seconds')
+    parser.add_argument('--refresh', action='store_true', help='Query MAST whatever the manifest age')
+    parser.add_argument('--offline', action='store_true', default=None, help='Never query MAST')
+    args = parser.parse_args()
+
+    cache_dir = args.cache_dir or os.path.join(os.path.dirname(os.path.abspath(args.target_dir)), MANIFEST_DIR)
+    products = query_products(args.ra, args.dec, args.tic_id, args.radius, cache_dir, args.ttl, args.refresh,
+                              args.offline)
+    missing = missing_products(products, args.target_dir)
+    missing_names = set(missing['productFilename'])
+    for row in products:
+        status = 'missing' if row['productFilename'] in missing_names else 'present'
+        print(f"s{row['sector']:04d} {row['cadence']:4d} s {status:8s}{row['productFilename']}")
+    print(f'{len(missing)} of {len(products)} light curves missing')
@@ -0,0 +1,106 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from astropy.timeseries import BoxLeastSquares, BoxLeastSquaresResults
+
+# The fields of BoxLeastSquaresResults, in the order its constructor takes them
+RESULT_FIELDS = ('objective', 'period', 'power', 'depth', 'depth_err', 'duration',
+                 'transit_time', 'depth_snr', 'log_likelihood')
+
+# Set in each worker by _attach: the shared light curve and the segment backing it
+_shared = {}
+
+
+def concatenate_results(results, sort=True):
+    '''
+    Parameters
+    ----------
+    results : list of astropy.timeseries.BoxLeastSquaresResults
+        Periodograms of the same light curve over different period grids.
+    sort : bool, optional
+        Whether to sort the merged periodogram by period.
+
+    Returns
+    -------
+    bls_result : astropy.timeseries.BoxLeastSquaresResults
+        One periodogram holding every period of the inputs.
+    '''
+    fields = [np.concatenate([result[field] for result in results]) for field in RESULT_FIELDS[1:]]
+    if sort:
+        order = np.argsort(fields[0], kind='stable')
+        fields = [field[order] for field in fields]
+    return BoxLeastSquaresResults(results[0].objective, *fields)
+
+
+def mp_context():
+    # Forked workers do not re-import the step script that started the pool
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+
+
+def _attach(name, n_rows, n_columns):
+    # Workers share the parent's resource tracker, so the parent's unlink cleans up
+    shm = shared_memory.SharedMemory(name=name)
+    data = np.ndarray((n_columns, n_rows), dtype=np.float64, buffer=shm.buf)
+    _shared['shm'] = shm
+    _shared['model'] = BoxLeastSquares(data[0], data[1], data[2] if n_columns == 3 else None)
+
+
+def _power_chunk(periods, durations, kwargs):
+    return _shared['model'].power(periods, durations, **kwargs)
+
+
+def parallel_bls_power(time, flux, periods, durations, dy=None, n_workers=None, n_chunks=None,
+                       **kwargs):
+    '''
+    Parameters
+    ----------
+    time, flux : array-like
+        The light curve.
+    periods, durations : float or array-like
+        The BLS period and duration grids. Every chunk of the period grid is searched
+        over the full duration grid.
+    dy : array-like, optional
+        The flux uncertainties.
+    n_workers : int, optional
+        The number of worker processes. Defaults to the number of CPUs.
+    n_chunks : int, optional
+        The number of period chunks. Defaults to four per worker, which keeps workers
+        busy when chunks take unequal time.
+    **kwargs
+        Passed on to BoxLeastSquares.power.
+
+    Returns
+    -------
+    bls_result : astropy.timeseries.BoxLeastSquaresResults
+        The same periodogram BoxLeastSquares(time, flux, dy).power would return, in the
+        order of the input period grid.
+    '''
+    n_workers = n_workers or os.cpu_count() or 1
+    periods = np.atleast_1d(np.asarray(periods, dtype=float))
+    if n_workers == 1 or periods.size < 2:
+        return BoxLeastSquares(time, flux, dy).power(periods, durations, **kwargs)
+
+    columns = [time, flux] if dy is None else [time, flux, dy]
+    n_rows = np.size(time)
+    chunks = np.array_split(periods, min(n_chunks or 4 * n_workers, periods.size))
+
+    # The light curve is copied once into shared memory instead of pickled to every chunk
+    shm = shared_memory.SharedMemory(create=True, size=max(len(columns) * n_rows * 8, 1))
+    try:
+        data = np.ndarray((len(columns), n_rows), dtype=np.float64, buffer=shm.buf)
+        for row, column in zip(data, columns):
+            row[:] = column
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context(),
+                                 initializer=_attach, initargs=(shm.name, n_rows, len(columns))) as pool:
+            results = list(pool.map(_power_chunk, chunks, [durations] * len(chunks),
+                                    [kwargs] * len(chunks)))
+        del data
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return concatenate_results(results, sort=False)
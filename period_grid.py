@@ -0,0 +1,228 @@
+import numpy as np
+
+from bls_cache import bls_power
+from parallel_bls import concatenate_results
+from profiling import stage
+
+# Kepler's third law in solar units: a [R_sun] = AU_RSUN * (M [M_sun] * P [yr]^2)^(1/3)
+AU_RSUN = 215.032
+DAYS_PER_YEAR = 365.25
+
+
+def transit_duration(period, stellar_radius=1.0, stellar_mass=1.0):
+    '''
+    Parameters
+    ----------
+    period : float or array-like
+        The orbital period, in days.
+    stellar_radius : float, optional
+        The stellar radius, in solar radii.
+    stellar_mass : float, optional
+        The stellar mass, in solar masses.
+
+    Returns
+    -------
+    duration : float or numpy.ndarray
+        The full duration, in days, of a central transit on a circular orbit.
+    '''
+    period = np.asarray(period, dtype=float)
+    a = AU_RSUN * (stellar_mass * (period / DAYS_PER_YEAR) ** 2) ** (1 / 3)
+    return period / np.pi * np.arcsin(np.minimum(stellar_radius / a, 1.0))
+
+
+def duration_grid(min_period, max_period, stellar_radius=1.0, stellar_mass=1.0, n_durations=6,
+                  min_fraction=0.3):
+    '''
+    Parameters
+    ----------
+    min_period, max_period : float
+        The period range, in days, the durations have to cover.
+    stellar_radius, stellar_mass : float, optional
+        The host star, in solar units.
+    n_durations : int, optional
+        The number of log-spaced durations.
+    min_fraction : float, optional
+        The shortest duration as a fraction of the central-transit duration at
+        min_period, to allow for grazing transits.
+
+    Returns
+    -------
+    durations : numpy.ndarray
+        Durations, in days, from grazing transits at min_period to central transits at
+        max_period, all shorter than min_period as BoxLeastSquares requires.
+    '''
+    shortest = min_fraction * transit_duration(min_period, stellar_radius, stellar_mass)
+    longest = min(transit_duration(max_period, stellar_radius, stellar_mass), 0.5 * min_period)
+    return np.geomspace(shortest, max(longest, shortest), n_durations)
+
+
+def frequency_grid(min_period, max_period, baseline, duty_cycle, oversample=3):
+    '''
+    Parameters
+    ----------
+    min_period, max_period : float
+        The period range, in days.
+    baseline : float
+        The time span, in days, the grid has to stay phase-coherent over.
+    duty_cycle : float
+        The transit duration divided by the period at the long end of the range, where
+        it is smallest.
+    oversample : float, optional
+        The number of grid steps per transit duration of phase drift over the baseline.
+
+    Returns
+    -------
+    periods : numpy.ndarray
+        Periods, in days and in ascending order, uniformly spaced in frequency.
+    '''
+    df = duty_cycle / (oversample * baseline)
+    n_frequencies = int(np.ceil((1 / min_period - 1 / max_period) / df)) + 1
+    return 1 / np.linspace(1 / max_period, 1 / min_period, n_frequencies)[::-1]
+
+
+def split_segments(time, max_gap=10.0):
+    '''
+    Parameters
+    ----------
+    time : numpy.ndarray
+        Sorted observation times, in days.
+    max_gap : float, optional
+        The largest gap, in days, allowed inside one segment.
+
+    Returns
+    -------
+    segments : list of slice
+        Index ranges of the contiguous observing seasons.
+    '''
+    breaks = np.flatnonzero(np.diff(time) > max_gap) + 1
+    edges = np.concatenate(([0], breaks, [time.size]))
+    return [slice(start, stop) for start, stop in zip(edges[:-1], edges[1:])]
+
+
+def coarse_search(time, flux, min_period, max_period, stellar_radius=1.0, stellar_mass=1.0,
+                  oversample=3, max_gap=10.0, cache_dir=None, n_workers=1):
+    '''
+    Parameters
+    ----------
+    time, flux : numpy.ndarray
+        The light curve.
+    min_period, max_period : float
+        The period range, in days.
+    stellar_radius, stellar_mass : float, optional
+        The host star, in solar units.
+    oversample : float, optional
+        Passed on to frequency_grid.
+    max_gap : float, optional
+        Passed on to split_segments.
+    cache_dir, n_workers : optional
+        Passed on to bls_power.
+
+    Returns
+    -------
+    periods, power : numpy.ndarray
+        The coarse period grid and the BLS power summed over every observing season.
+        The grid only has to stay coherent over the longest season rather than the whole
+        multi-year baseline, so it is far smaller than a full-resolution grid.
+    '''
+    if np.any(np.diff(time) < 0):
+        order = np.argsort(time, kind='stable')
+        time, flux = time[order], flux[order]
+
+    segments = split_segments(time, max_gap)
+    durations = duration_grid(min_period, max_period, stellar_radius, stellar_mass)
+    longest = max(time[segment][-1] - time[segment][0] for segment in segments)
+    duty_cycle = transit_duration(max_period, stellar_radius, stellar_mass) / max_period
+    periods = frequency_grid(min_period, max_period, longest, duty_cycle, oversample)
+
+    power = np.zeros(periods.size)
+    with stage('coarse_search', n_points=time.size, n_segments=len(segments), n_periods=periods.size):
+        for segment in segments:
+            if time[segment].size > 1:
+                power += bls_power(time[segment], flux[segment], periods, durations,
+                                   cache_dir=cache_dir, n_workers=n_workers).power
+    return periods, power
+
+
+def refine_peaks(time, flux, periods, power, n_peaks=5, width=3, stellar_radius=1.0,
+                 stellar_mass=1.0, oversample=3, cache_dir=None, n_workers=1):
+    '''
+    Parameters
+    ----------
+    time, flux : numpy.ndarray
+        The full light curve.
+    periods, power : numpy.ndarray
+        A coarse periodogram, as returned by coarse_search.
+    n_peaks : int, optional
+        The number of separate peaks to refine.
+    width : int, optional
+        The half-width, in coarse grid steps, of the window refined around each peak.
+    stellar_radius, stellar_mass : float, optional
+        The host star, in solar units.
+    oversample : float, optional
+        Passed on to frequency_grid.
+    cache_dir, n_workers : optional
+        Passed on to bls_power.
+
+    Returns
+    -------
+    bls_result : astropy.timeseries.BoxLeastSquaresResults
+        The full-baseline periodogram of every refined window, sorted by period.
+    '''
+    frequencies = 1 / periods
+    step = np.abs(np.diff(frequencies)).max() if periods.size > 1 else frequencies[0]
+    baseline = time.max() - time.min()
+
+    results, picked = [], []
+    with stage('refine_peaks', n_points=time.size, n_peaks=n_peaks) as record:
+        for index in np.argsort(power)[::-1]:
+            if len(picked) == n_peaks:
+                break
+            if any(abs(frequencies[index] - f) <= 2 * width * step for f in picked):
+                continue
+            picked.append(frequencies[index])
+
+            lo = 1 / (frequencies[index] + width * step)
+            hi = 1 / max(frequencies[index] - width * step, step)
+            durations = duration_grid(lo, hi, stellar_radius, stellar_mass, n_durations=4)
+            duty_cycle = transit_duration(hi, stellar_radius, stellar_mass) / hi
+            local = frequency_grid(lo, hi, baseline, duty_cycle, oversample)
+            results.append(bls_power(time, flux, local, durations, cache_dir=cache_dir,
+                                     n_workers=n_workers))
+        record.set(n_periods=sum(result.period.size for result in results))
+
+    return concatenate_results(results)
+
+
+def adaptive_bls(time, flux, min_period, max_period, stellar_radius=1.0, stellar_mass=1.0,
+                 n_peaks=5, oversample=3, max_gap=10.0, cache_dir=None, n_workers=1):
+    '''
+    Parameters
+    ----------
+    time, flux : numpy.ndarray
+        The light curve.
+    min_period, max_period : float
+        The period range, in days, of the blind search.
+    stellar_radius, stellar_mass : float, optional
+        The host star, in solar units. They set the physically plausible durations.
+    n_peaks : int, optional
+        The number of coarse peaks refined on the full baseline.
+    oversample : float, optional
+        Passed on to frequency_grid.
+    max_gap : float, optional
+        Passed on to split_segments.
+    cache_dir, n_workers : optional
+        Passed on to bls_power.
+
+    Returns
+    -------
+    periods, power : numpy.ndarray
+        The coarse periodogram.
+    bls_result : astropy.timeseries.BoxLeastSquaresResults
+        The refined periodogram around the strongest coarse peaks.
+    '''
+    periods, power = coarse_search(time, flux, min_period, max_period, stellar_radius, stellar_mass,
+                                   oversample, max_gap, cache_dir, n_workers)
+    bls_result = refine_peaks(time, flux, periods, power, n_peaks, stellar_radius=stellar_radius,
+                              stellar_mass=stellar_mass, oversample=oversample, cache_dir=cache_dir,
+                              n_workers=n_workers)
+    return periods, power, bls_result
@@ -0,0 +1,246 @@
+from collections import namedtuple
+
+import numpy as np
+
+from profiling import stage
+
+# The columns of a parameter vector
+PARAMETERS = ('baseline', 'eclipse_depth', 'atmospheric', 'atmospheric_offset', 'ellipsoidal',
+              'beaming')
+
+PhaseCurveFit = namedtuple('PhaseCurveFit', ['params', 'errors', 'chi2', 'n_points'])
+
+# Physical constants in SI units, for beaming_amplitude
+GRAVITATIONAL_CONSTANT = 6.674e-11
+SPEED_OF_LIGHT = 2.998e8
+SOLAR_MASS = 1.989e30
+JUPITER_MASS = 1.898e27
+
+
+def beaming_amplitude(period, stellar_mass, planet_mass, inclination=90.0, alpha=1.0):
+    '''
+    Parameters
+    ----------
+    period : float
+        The orbital period, in days.
+    stellar_mass : float
+        The stellar mass, in solar masses.
+    planet_mass : float
+        The planet mass, in Jupiter masses.
+    inclination : float, optional
+        The orbital inclination, in degrees.
+    alpha : float, optional
+        The beaming factor of the star in the bandpass, about 1 for a hot star in TESS.
+
+    Returns
+    -------
+    amplitude : float
+        The Doppler beaming amplitude 4 alpha K / c (Loeb & Gaudi 2003), with K the
+        radial-velocity semi-amplitude of the star on a circular orbit, as a fraction
+        of the stellar flux.
+    '''
+    m_star = stellar_mass * SOLAR_MASS
+    m_planet = planet_mass * JUPITER_MASS
+    velocity = ((2 * np.pi * GRAVITATIONAL_CONSTANT / (period * 86400)) ** (1 / 3)
+                * m_planet * np.sin(np.radians(inclination)) / (m_star + m_planet) ** (2 / 3))
+    return 4 * alpha * velocity / SPEED_OF_LIGHT
+
+
+def eclipse_visibility(phase, eclipse_phase=0.5, duration=0.1, ingress=0.0):
+    '''
+    Parameters
+    ----------
+    phase : array-like
+        The orbital phase, in cycles, with the primary transit at 0.
+    eclipse_phase : float, optional
+        The phase of mid-eclipse.
+    duration : float, optional
+        The full eclipse duration, first to fourth contact, in cycles.
+    ingress : float, optional
+        The ingress (and egress) duration, in cycles. 0 gives a box-shaped eclipse.
+
+    Returns
+    -------
+    visibility : numpy.ndarray
+        The visible fraction of the planet's day side: 0 in full eclipse, 1 outside
+        eclipse, and linear in between.
+    '''
+    distance = np.abs((np.asarray(phase, dtype=float) - eclipse_phase + 0.5) % 1 - 0.5)
+    if ingress <= 0:
+        return (distance >= 0.5 * duration).astype(float)
+    return np.clip((distance - 0.5 * duration + ingress) / ingress, 0, 1)
+
+
+class PhaseCurveModel:
+    '''
+    Phase-curve model of a folded light curve, with the transit masked:
+
+        F = baseline * (1 - ellipsoidal cos(4 pi phase) + beaming sin(2 pi phase)
+                        + visibility * (f_p - atmospheric cos(2 pi phase + atmospheric_offset)))
+
+    where f_p is set so that the flux lost at mid-eclipse is eclipse_depth. The model
+    is linear in six coefficients of fixed basis functions of phase, so the weighted
+    sums of the basis products are computed once and the chi-square of any number of
+    parameter vectors then costs 36 multiply-adds each, whatever the number of points.
+
+    Outside eclipse, beaming and the sine part of the atmospheric term have the same
+    shape, so only the eclipse separates them and fitting both gives two degenerate
+    coefficients. Pass beaming, e.g. from beaming_amplitude, to hold it fixed so the
+    offset of the atmospheric term is measured instead.
+    '''
+
+    def __init__(self, phase, flux, flux_err=None, transit_width=0.0, eclipse_phase=0.5,
+                 eclipse_duration=0.1, ingress=0.0, beaming=None):
+        '''
+        Parameters
+        ----------
+        phase : array-like
+            The orbital phase of every point, in cycles, with the primary transit at 0.
+        flux : array-like
+            The normalized flux.
+        flux_err : float or array-like, optional
+            The flux uncertainties. Defaults to the standard deviation of the flux
+            outside transit, which makes the chi-square only a relative measure.
+        transit_width : float, optional
+            The full width, in cycles, of the primary transit, which is left out.
+        eclipse_phase, eclipse_duration, ingress : float, optional
+            The secondary-eclipse geometry, in cycles, see eclipse_visibility.
+        beaming : float, optional
+            The Doppler beaming amplitude held fixed in the fit. If None it is fitted,
+            and is degenerate with the atmospheric offset.
+        '''
+        phase = np.asarray(phase, dtype=float)
+        flux = np.asarray(flux, dtype=float)
+        keep = np.isfinite(phase) & np.isfinite(flux)
+        keep &= np.abs((phase + 0.5) % 1 - 0.5) >= 0.5 * transit_width
+        if flux_err is None:
+            flux_err = np.std(flux[keep])
+        flux_err = np.broadcast_to(np.asarray(flux_err, dtype=float), flux.shape)
+        keep &= np.isfinite(flux_err) & (flux_err > 0)
+        self.eclipse_phase = eclipse_phase
+        self.eclipse_duration = eclipse_duration
+        self.ingress = ingress
+        self.beaming = beaming
+
+        with stage('phase_curve_setup', n_points=int(keep.sum())):
+            basis = self.basis(phase[keep])
+            w = flux_err[keep] ** -2.0
+            # Sufficient statistics: chi2(a) = yy - 2 a.b + a.G.a, taken about the mean
+            # flux so the sums do not cancel when chi2 is far smaller than sum(w y**2)
+            self.shift = np.average(flux[keep], weights=w) if w.size else 0.0
+            y = flux[keep] - self.shift
+            self.gram = (basis * w) @ basis.T
+            self.projection = basis @ (w * y)
+            self.yy = np.sum(w * y * y)
+        self.n_points = y.size
+
+    def basis(self, phase):
+        '''
+        Returns
+        -------
+        basis : numpy.ndarray
+            The six basis functions at each phase, shape (6, len(phase)): 1,
+            cos(4 pi phase), sin(2 pi phase), visibility and visibility times
+            cos(2 pi phase) and sin(2 pi phase).
+        '''
+        angle = 2 * np.pi * np.asarray(phase, dtype=float)
+        visibility = eclipse_visibility(phase, self.eclipse_phase, self.eclipse_duration, self.ingress)
+        return np.stack([np.ones_like(angle), np.cos(2 * angle), np.sin(angle), visibility,
+                         visibility * np.cos(angle), visibility * np.sin(angle)])
+
+    def coefficients(self, params):
+        '''
+        Parameters
+        ----------
+        params : array-like
+            One parameter vector, ordered as PARAMETERS, or a batch of shape (n, 6).
+
+        Returns
+        -------
+        coefficients : numpy.ndarray
+            The weights of the basis functions, shape (n, 6).
+        '''
+        baseline, depth, atmospheric, offset, ellipsoidal, beaming = np.atleast_2d(params).T
+        # f_p such that the planet's flux at mid-eclipse equals eclipse_depth
+        planet = depth + atmospheric * np.cos(2 * np.pi * self.eclipse_phase + offset)
+        return baseline[:, None] * np.stack([np.ones_like(baseline), -ellipsoidal, beaming, planet,
+                                             -atmospheric * np.cos(offset),
+                                             atmospheric * np.sin(offset)], axis=1)
+
+    def chi2(self, params):
+        '''
+        Parameters
+        ----------
+        params : array-like
+            A batch of parameter vectors, shape (n, 6), ordered as PARAMETERS.
+
+        Returns
+        -------
+        chi2 : numpy.ndarray
+            The chi-square of every parameter vector against the light curve.
+        '''
+        a = self.coefficients(params)
+        a[:, 0] -= self.shift
+        return self.yy - 2 * a @ self.projection + np.einsum('ni,ij,nj->n', a, self.gram, a)
+
+    def evaluate(self, params, phase):
+        '''
+        Parameters
+        ----------
+        params : array-like
+            One parameter vector, or a batch of shape (n, 6).
+        phase : array-like
+            The phases, in cycles, to evaluate the model at.
+
+        Returns
+        -------
+        flux : numpy.ndarray
+            The model flux, shape (n, len(phase)).
+        '''
+        return self.coefficients(params) @ self.basis(phase)
+
+    def fit(self):
+        '''
+        Returns
+        -------
+        fit : PhaseCurveFit
+            The least-squares parameters, ordered as PARAMETERS, with their 1-sigma
+            errors (assuming the flux errors are right), the chi-square and the number
+            of points. Being linear in the basis weights, the fit is a single solve. A
+            fixed beaming has an error of 0.
+        '''
+        if self.beaming is None:
+            a = np.linalg.solve(self.gram, self.projection)
+            a[0] += self.shift
+            covariance = np.linalg.inv(self.gram)
+        else:
+            # The beaming weight is beaming times the baseline, so solve for the other
+            # five with it moved to the data side, then once more with the new baseline
+            free = np.array([0, 1, 3, 4, 5])
+            covariance = np.zeros_like(self.gram)
+            covariance[np.ix_(free, free)] = np.linalg.inv(self.gram[np.ix_(free, free)])
+            a = np.zeros(self.projection.size)
+            a[0] = self.shift
+            for _ in range(2):
+                a[2] = self.beaming * a[0]
+                a[free] = covariance[np.ix_(free, free)] @ (self.projection - self.gram[:, 2] * a[2])[free]
+                a[0] += self.shift
+        params = self._params(a)
+
+        # Propagate the coefficient covariance through the numerical Jacobian
+        jacobian = np.empty((len(PARAMETERS), a.size))
+        for i in range(a.size):
+            step = 1e-7 * max(abs(a[i]), 1e-3)
+            shifted = a.copy()
+            shifted[i] += step
+            jacobian[:, i] = (self._params(shifted) - params) / step
+        errors = np.sqrt(np.diag(jacobian @ covariance @ jacobian.T))
+        return PhaseCurveFit(params, errors, float(self.chi2(params)[0]), self.n_points)
+
+    def _params(self, a):
+        baseline = a[0]
+        atmospheric = np.hypot(a[4], a[5]) / baseline
+        offset = np.arctan2(a[5], -a[4])
+        planet = a[3] / baseline
+        depth = planet - atmospheric * np.cos(2 * np.pi * self.eclipse_phase + offset)
+        return np.array([baseline, depth, atmospheric, offset, -a[1] / baseline, a[2] / baseline])
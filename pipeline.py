@@ -0,0 +1,457 @@
+import argparse
+import ast
+import hashlib
+import importlib
+import inspect
+import os
+import time as timer
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+
+from binning import bin_light_curve
+from bls_cache import CACHE_DIR as BLS_CACHE_DIR
+from detrend import DEFAULT_WINDOW, detrend, transit_mask
+from eclipse_search import search_secondary_eclipse
+from figures import FIGURE_DIR_ENV, FigureSet, line, scatter
+from folding import fold
+from harmonics import fit_harmonics, harmonic_periodogram
+from lc_loader import list_fits_files, load_light_curve
+from period_grid import adaptive_bls
+from phase_curve import PARAMETERS, PhaseCurveModel, beaming_amplitude
+from profiling import stage as profile_stage
+from transit_timing import fit_ephemeris, measure_duration, measure_transit_times
+
+# Cache folder created inside each target directory
+CACHE_DIR = '.pipeline_cache'
+
+# The directory of the repository's own modules, the only ones followed into stage keys
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# name: the stage; function: called as function(params, **inputs) and returns a dict of
+# arrays and scalars; inputs: the stages whose outputs it takes; params: the entries of
+# the parameter dict it reads; modules: the modules whose source it depends on;
+# fingerprint: for stages that read outside data, called as fingerprint(params) and
+# returning a string that changes with the data
+Stage = namedtuple('Stage', ['name', 'function', 'inputs', 'params', 'modules', 'fingerprint'],
+                   defaults=(None,))
+
+# WASP-18 and the search, as in steps 2-6
+DEFAULT_PARAMS = {
+    'dir_path': '.',
+    'cadence': 'lc',
+    'min_period': 0.5,
+    'max_period': 10.0,
+    'stellar_radius': 1.319,
+    'stellar_mass': 1.22,
+    'stellar_temperature': 6400.0,
+    'planet_mass': 10.4,
+    'detrend_window': DEFAULT_WINDOW,
+    'n_bins': 200,
+    'n_harmonics': 3,
+    'figure_dir': None,
+    'n_workers': None,
+}
+
+
+def ingest_stage(params):
+    time, flux = load_light_curve(params['dir_path'], cadence=params['cadence'])
+    return {'time': time, 'flux': flux}
+
+
+def fits_fingerprint(params):
+    # The names, sizes and modification times of the files, as lc_loader keys its cache
+    stats = [(name, os.stat(os.path.join(params['dir_path'], name)))
+             for name in list_fits_files(params['dir_path'])]
+    return repr([(name, stat.st_size, stat.st_mtime_ns) for name, stat in stats])
+
+
+def detrend_stage(params, ingest):
+    flux = ingest['flux']
+    if params['detrend_window']:
+        flux, _ = detrend(ingest['time'], flux, params['detrend_window'])
+    return {'flux': flux}
+
+
+def bls_stage(params, ingest, detrend):
+    time = ingest['time']
+    periods, power, bls_result = adaptive_bls(time, detrend['flux'], params['min_period'],
+                                              params['max_period'], params['stellar_radius'],
+                                              params['stellar_mass'],
+                                              cache_dir=os.path.join(params['dir_path'], BLS_CACHE_DIR),
+                                              n_workers=params['n_workers'])
+    index = np.argmax(bls_result.power)
+    period, t0, duration = bls_result.period[index], bls_result.transit_time[index], bls_result.duration[index]
+    # The grid duration can be shorter than the transit, so every later stage uses the one
+    # measured from the stacked transits, as steps 4-6 and batch_runner.py do
+    measured = measure_duration(time, detrend['flux'], period, t0, 0.25 * period)
+    if np.isfinite(measured):
+        duration = max(measured, duration)
+    return {'periods': periods, 'power': power, 'period': period, 't0': t0, 'duration': duration}
+
+
+def flatten_stage(params, ingest, bls):
+    # Detrend again with the transits and the eclipses half an orbit later masked
+    time, flux = ingest['time'], ingest['flux']
+    if params['detrend_window']:
+        width = max(1.5 * bls['duration'], 0.1)
+        masked = transit_mask(time, bls['period'], bls['t0'], width)
+        masked |= transit_mask(time, bls['period'], bls['t0'] + 0.5 * bls['period'], width)
+        flux, _ = detrend(time, flux, params['detrend_window'], mask=masked)
+    return {'flux': flux}
+
+
+def fold_stage(params, ingest, flatten, bls):
+    folded = fold(ingest['time'], flatten['flux'], bls['period'], bls['t0'])
+    return {'phase': folded.cycles, 'flux': folded.flux,
+            'raw_flux': ingest['flux'][folded.order].astype(folded.flux.dtype)}
+
+
+def transit_stage(params, fold, bls):
+    binned = bin_light_curve(fold['phase'], fold['flux'], bins=params['n_bins'], range=(-0.5, 0.5),
+                             presorted=True)
+    transit_depth = 1 - np.nanmin(binned.mean)
+    return {'centers': binned.centers, 'mean': binned.mean, 'transit_depth': transit_depth,
+            'planet_radius': params['stellar_radius'] * max(transit_depth, 0) ** 0.5}
+
+
+def eclipse_stage(params, fold, bls):
+    width = bls['duration'] / bls['period']
+    eclipse = search_secondary_eclipse(fold['phase'], fold['flux'],
+                                       width * np.array([0.5, 0.75, 1.0, 1.25, 1.5]),
+                                       primary_width=1.5 * width)
+    # Binned from 0 to 1, so the eclipse is not split at the edge of the transit binning
+    binned = bin_light_curve(fold['phase'] % 1, fold['flux'], bins=params['n_bins'], range=(0, 1))
+    return {'centers': binned.centers, 'mean': binned.mean, 'phase': eclipse.phase,
+            'duration': eclipse.duration, 'depth': eclipse.depth, 'depth_err': eclipse.depth_err,
+            'snr': eclipse.snr}
+
+
+def phase_curve_stage(params, fold, bls):
+    # On the flux before detrending, which would flatten the modulation. Beaming is held at
+    # the value the masses give, as it is degenerate with the atmospheric offset
+    period, duration = bls['period'], bls['duration']
+    beaming = beaming_amplitude(period, params['stellar_mass'], params['planet_mass'])
+    model = PhaseCurveModel(fold['phase'], fold['raw_flux'], transit_width=max(1.5 * duration, 0.1) / period,
+                            eclipse_duration=duration / period, beaming=beaming)
+    fit = model.fit()
+    binned = bin_light_curve(fold['phase'], fold['raw_flux'], bins=params['n_bins'], range=(-0.5, 0.5),
+                             presorted=True)
+    model_phase = np.linspace(-0.5, 0.5, 1000)
+    return {'params': fit.params, 'errors': fit.errors, 'chi2': fit.chi2, 'centers': binned.centers,
+            'mean': binned.mean, 'model_phase': model_phase,
+            'model_flux': model.evaluate(fit.params, model_phase)[0]}
+
+
+def timing_stage(params, ingest, flatten, bls):
+    times = measure_transit_times(ingest['time'], flatten['flux'], bls['period'], bls['t0'], bls['duration'],
+                                  n_workers=params['n_workers'] or 1)
+    ephemeris = fit_ephemeris(times)
+    return {**times._asdict(), 'period': ephemeris.period, 'period_err': ephemeris.period_err,
+            't0': ephemeris.t0, 't0_err': ephemeris.t0_err, 'residuals': ephemeris.residuals,
+            'used': ephemeris.used, 'reduced_chi2': ephemeris.reduced_chi2}
+
+
+def harmonics_stage(params, ingest, bls):
+    # On the flux before detrending, with the transits and eclipses masked
+    time, period, t0, duration = ingest['time'], bls['period'], bls['t0'], bls['duration']
+    width = max(1.5 * duration, 0.1)
+    masked = transit_mask(time, period, t0, width) | transit_mask(time, period, t0 + 0.5 * period, width)
+    periods, power = harmonic_periodogram(time, ingest['flux'], mask=masked)
+    fit = fit_harmonics(time, ingest['flux'], period, t0, params['n_harmonics'], mask=masked)
+    return {'periods': periods, 'power': power, 'modulation_period': periods[np.argmax(power)], 'cos': fit.cos,
+            'sin': fit.sin, 'cos_err': fit.cos_err, 'sin_err': fit.sin_err, 'amplitude': fit.amplitude,
+            'amplitude_err': fit.amplitude_err}
+
+
+def summary_stage(params, bls, transit, eclipse, phase_curve, timing, harmonics):
+    transit_depth, secondary_depth = transit['transit_depth'], eclipse['depth']
+    if transit_depth > 0 and secondary_depth > 0:
+        dayside_temperature = (params['stellar_temperature'] * transit_depth ** -0.5
+                               * secondary_depth ** (6 / 13))
+    else:
+        dayside_temperature = np.nan
+    summary = {'period': bls['period'], 't0': bls['t0'], 'duration': bls['duration'],
+               'transit_depth': transit_depth, 'planet_radius': transit['planet_radius'],
+               'secondary_phase': eclipse['phase'], 'secondary_depth': secondary_depth,
+               'secondary_depth_err': eclipse['depth_err'], 'dayside_temperature': dayside_temperature}
+    summary.update(zip(PARAMETERS, phase_curve['params']))
+    summary.update({'n_transits': timing['epoch'].size, 'timing_period': timing['period'],
+                    'timing_period_err': timing['period_err'], 'timing_t0': timing['t0'],
+                    'timing_t0_err': timing['t0_err'], 'modulation_period': harmonics['modulation_period']})
+    for k, (amplitude, error) in enumerate(zip(harmonics['amplitude'], harmonics['amplitude_err']), start=1):
+        summary.update({f'harmonic_{k}_amplitude': amplitude, f'harmonic_{k}_amplitude_err': error})
+    return summary
+
+
+def figures_stage(params, ingest, bls, fold, transit, eclipse, phase_curve, timing, summary):
+    # Runs after every other stage, so its worker processes fork a quiet process
+    figures = FigureSet(params['figure_dir'], headless=True)
+    figures.add('pipeline_light_curve.png', [scatter(ingest['time'], ingest['flux'], marker='.', alpha=0.5)],
+                figsize=(10, 6), xlabel='Time (BTJD)', ylabel='Normalized Flux',
+                title='Light Curve of WASP-18b (Concatenated)')
+    figures.add('pipeline_periodogram.png', [line(bls['periods'], bls['power'], color='b')], figsize=(10, 6),
+                xlabel='Period (days)', ylabel='Power', title='BLS Periodogram of WASP-18b')
+    figures.add('pipeline_transit.png',
+                [scatter(fold['phase'], fold['flux'], s=5, alpha=0.5, label='Detrended Data'),
+                 line(transit['centers'], transit['mean'], color='r', label='Binned Data')],
+                figsize=(10, 6), legend=True, xlabel='Phase', ylabel='Normalized Flux',
+                title='Primary Transit of WASP-18b', xlim=(-0.15, 0.15))
+    figures.add('pipeline_secondary_eclipse.png',
+                [scatter(fold['phase'] % 1, fold['flux'], s=5, alpha=0.5, label='Detrended Data'),
+                 line(eclipse['centers'], eclipse['mean'], color='r', label='Binned Data')],
+                figsize=(10, 6), legend=True, xlabel='Phase', ylabel='Normalized Flux',
+                title=f"Secondary Eclipse of WASP-18b (T_day = {summary['dayside_temperature']:.0f} K)",
+                xlim=(eclipse['phase'] - 0.2, eclipse['phase'] + 0.2), ylim=(1 - 2e-3, 1 + 2e-3))
+    figures.add('pipeline_phase_curve.png',
+                [scatter(phase_curve['centers'], phase_curve['mean'], s=10, label='Binned Data'),
+                 line(phase_curve['model_phase'], phase_curve['model_flux'], color='r',
+                      label='Phase-Curve Model')],
+                figsize=(10, 6), legend=True, xlabel='Phase', ylabel='Normalized Flux',
+                title='Phase Curve of WASP-18b', ylim=(1 - 1.5e-3, 1 + 1e-3))
+    used = timing['used'].astype(bool)
+    figures.add('pipeline_timing.png', [scatter(timing['epoch'][used], 1440 * timing['residuals'][used], s=10,
+                                                label='Timed Transits'),
+                                        scatter(timing['epoch'][~used], 1440 * timing['residuals'][~used], s=10,
+                                                color='r', label='Clipped')],
+                figsize=(10, 6), legend=True, xlabel='Epoch', ylabel='Observed - Calculated (minutes)',
+                title=f"Transit Timing of WASP-18b (P = {timing['period']:.7f} days)")
+    return {'files': np.array(figures.render(), dtype=str)}
+
+
+# ingest -> detrend -> BLS -> flatten -> fold -> transit, eclipse, phase curve -> summary ->
+# figures, with the transit timing running on the flattened light curve alongside the fold and the
+# harmonic periodogram on the light curve before detrending
+STAGES = (
+    Stage('ingest', ingest_stage, (), ('dir_path', 'cadence'), ('lc_loader', 'lc_store', 'fits_table'),
+          fits_fingerprint),
+    Stage('detrend', detrend_stage, ('ingest',), ('detrend_window',), ('detrend',)),
+    Stage('bls', bls_stage, ('ingest', 'detrend'),
+          ('min_period', 'max_period', 'stellar_radius', 'stellar_mass'),
+          ('period_grid', 'bls_cache', 'parallel_bls', 'transit_timing')),
+    Stage('flatten', flatten_stage, ('ingest', 'bls'), ('detrend_window',), ('detrend',)),
+    Stage('fold', fold_stage, ('ingest', 'flatten', 'bls'), (), ('folding',)),
+    Stage('transit', transit_stage, ('fold', 'bls'), ('n_bins', 'stellar_radius'), ('binning',)),
+    Stage('eclipse', eclipse_stage, ('fold', 'bls'), ('n_bins',), ('eclipse_search', 'binning')),
+    Stage('phase_curve', phase_curve_stage, ('fold', 'bls'), ('n_bins', 'stellar_mass', 'planet_mass'),
+          ('phase_curve', 'binning')),
+    Stage('timing', timing_stage, ('ingest', 'flatten', 'bls'), (), ('transit_timing', 'binning')),
+    Stage('harmonics', harmonics_stage, ('ingest', 'bls'), ('n_harmonics',), ('harmonics', 'detrend')),
+    Stage('summary', summary_stage, ('bls', 'transit', 'eclipse', 'phase_curve', 'timing', 'harmonics'),
+          ('stellar_temperature',), ()),
+    Stage('figures', figures_stage,
+          ('ingest', 'bls', 'fold', 'transit', 'eclipse', 'phase_curve', 'timing', 'summary'),
+          ('figure_dir',), ('figures',)),
+)
+
+
+def _as_artifact(outputs):
+    # What np.load gives back, so a fresh output and a cached one look the same
+    artifact = {}
+    for name, value in outputs.items():
+        value = np.asarray(value)
+        artifact[name] = value.item() if value.ndim == 0 else value
+    return artifact
+
+
+def artifact_digest(artifact):
+    '''
+    Returns
+    -------
+    digest : str
+        A hex digest of the content of a stage's outputs. Stages downstream are keyed on
+        it, so a stage that reruns but returns the same outputs leaves them cached.
+    '''
+    digest = hashlib.sha1()
+    for name in sorted(artifact):
+        value = np.ascontiguousarray(artifact[name])
+        digest.update(f'{name}:{value.dtype.str}{value.shape};'.encode())
+        digest.update(value.tobytes())
+    return digest.hexdigest()
+
+
+def module_closure(modules):
+    '''
+    Parameters
+    ----------
+    modules : iterable of str
+        Names of the repository's modules.
+
+    Returns
+    -------
+    closure : list of str
+        The modules and every repository module they import, directly or through
+        others, sorted by name. Imports are read from the source, so nothing new is
+        imported to find them.
+    '''
+    closure, queue = set(), list(modules)
+    while queue:
+        name = queue.pop()
+        path = os.path.join(MODULE_DIR, name + '.py')
+        if name in closure or not os.path.exists(path):
+            continue
+        closure.add(name)
+        with open(path, 'rb') as handle:
+            tree = ast.parse(handle.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                queue.extend(alias.name.split('.')[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                queue.append(node.module.split('.')[0])
+    return sorted(closure)
+
+
+def stage_key(stage, params, input_digests):
+    '''
+    Parameters
+    ----------
+    stage : Stage
+        The stage.
+    params : dict
+        The pipeline parameters; only the stage's own are used.
+    input_digests : dict
+        The artifact digest of every input stage.
+
+    Returns
+    -------
+    key : str
+        A hex digest of everything the stage's outputs depend on: its code and that of
+        its modules and everything they import from the repository, its parameters,
+        the content of its inputs and its fingerprint.
+    '''
+    digest = hashlib.sha1(inspect.getsource(stage.function).encode())
+    for name in module_closure(stage.modules):
+        digest.update(f'{name};'.encode())
+        with open(importlib.import_module(name).__file__, 'rb') as handle:
+            digest.update(handle.read())
+    digest.update(repr([(name, params[name]) for name in stage.params]).encode())
+    digest.update(repr([(name, input_digests[name]) for name in stage.inputs]).encode())
+    if stage.fingerprint is not None:
+        digest.update(stage.fingerprint(params).encode())
+    return digest.hexdigest()
+
+
+def _prune_cache(cache_dir, name, keep):
+    # Each stage keeps only its latest artifact; the key is a 40-character hex digest
+    for entry in os.listdir(cache_dir):
+        if (entry != keep and entry.startswith(name + '-') and entry.endswith('.npz')
+                and len(entry) == len(name) + 45):
+            try:
+                os.remove(os.path.join(cache_dir, entry))
+            except FileNotFoundError:
+                pass
+
+
+def _run_stage(stage, params, inputs, cache_dir, force):
+    key = stage_key(stage, params, {name: digest for name, (_, digest) in inputs.items()})
+    path = os.path.join(cache_dir, f'{stage.name}-{key}.npz') if cache_dir else None
+    if path and not force and os.path.exists(path):
+        with np.load(path) as data:
+            artifact = _as_artifact({name: data[name] for name in data.files if name != 'digest'})
+            digest = str(data['digest'])
+        # Files a stage wrote, e.g. figures, have to still be there
+        if all(os.path.exists(name) for name in np.atleast_1d(artifact.get('files', []))):
+            return artifact, digest, 'cached', 0.0
+
+    start = timer.perf_counter()
+    with profile_stage('pipeline_' + stage.name):
+        artifact = _as_artifact(stage.function(params, **{name: value for name, (value, _) in inputs.items()}))
+    elapsed = timer.perf_counter() - start
+    digest = artifact_digest(artifact)
+
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write next to the final name and swap it in so a crash never leaves a partial cache
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as handle:
+            np.savez(handle, digest=digest, **artifact)
+        os.replace(tmp_path, path)
+        _prune_cache(cache_dir, stage.name, os.path.basename(path))
+    return artifact, digest, 'ran', elapsed
+
+
+def run_pipeline(params=None, targets=None, force=(), stages=STAGES, max_workers=4, use_cache=True):
+    '''
+    Parameters
+    ----------
+    params : dict, optional
+        Overrides of DEFAULT_PARAMS, e.g. {'dir_path': ...}. figure_dir defaults to
+        WASP18_FIGURE_DIR, or the working directory.
+    targets : list of str, optional
+        The stages wanted; they run with everything they depend on. Defaults to all.
+    force : list of str, optional
+        Stages rerun even when their outputs are cached.
+    stages : tuple of Stage, optional
+        The dependency graph, in an order where every stage follows its inputs.
+    max_workers : int, optional
+        The number of stages run at once. Stages run on threads; the BLS and the
+        figures start their own worker processes.
+    use_cache : bool, optional
+        Whether to read and write stage outputs in the target's CACHE_DIR.
+
+    Returns
+    -------
+    artifacts : dict
+        The outputs of every stage run, by stage name.
+    report : list of (str, str, float)
+        Each stage's name, whether it 'ran' or was 'cached', and its run time in
+        seconds, in the order they finished.
+    '''
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    # Resolved here so the figures' key and recorded paths follow the directory used
+    params['figure_dir'] = os.path.abspath(params['figure_dir'] or os.environ.get(FIGURE_DIR_ENV, '.'))
+    by_name = {stage.name: stage for stage in stages}
+    cache_dir = os.path.join(params['dir_path'], CACHE_DIR) if use_cache else None
+
+    # Every stage the targets depend on
+    needed, queue = set(), list(targets or by_name)
+    while queue:
+        name = queue.pop()
+        if name not in needed:
+            needed.add(name)
+            queue.extend(by_name[name].inputs)
+    pending = [stage for stage in stages if stage.name in needed]
+
+    done, report, running = {}, [], {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            for stage in [stage for stage in pending if all(name in done for name in stage.inputs)]:
+                pending.remove(stage)
+                inputs = {name: done[name] for name in stage.inputs}
+                future = pool.submit(_run_stage, stage, params, inputs, cache_dir, stage.name in force)
+                running[future] = stage
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                artifact, digest, status, elapsed = future.result()
+                done[stage.name] = (artifact, digest)
+                report.append((stage.name, status, elapsed))
+
+    return {name: artifact for name, (artifact, _) in done.items()}, report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the step 2-6 analysis as one cached stage graph.')
+    parser.add_argument('dir_path', help='Directory holding the .fits files of the target')
+    parser.add_argument('--stages', nargs='+', choices=[stage.name for stage in STAGES],
+                        help='Stages wanted; everything they depend on runs too')
+    parser.add_argument('--force', nargs='+', default=[], choices=[stage.name for stage in STAGES],
+                        help='Stages rerun even when cached')
+    parser.add_argument('--figure-dir', help='Where the figures are written, see figures.FigureSet')
+    parser.add_argument('--workers', type=int, default=4, help='Stages run at once')
+    parser.add_argument('--no-cache', action='store_true', help='Neither read nor write cached outputs')
+    for name in ('min_period', 'max_period', 'stellar_radius', 'stellar_mass', 'stellar_temperature',
+                 'planet_mass', 'detrend_window'):
+        parser.add_argument('--' + name.replace('_', '-'), type=float, default=DEFAULT_PARAMS[name])
+    args = parser.parse_args()
+
+    params = {name: getattr(args, name) for name in ('dir_path', 'figure_dir', 'min_period', 'max_period',
+                                                     'stellar_radius', 'stellar_mass', 'stellar_temperature',
+                                                     'planet_mass', 'detrend_window')}
+    artifacts, report = run_pipeline(params, args.stages, args.force, max_workers=args.workers,
+                                     use_cache=not args.no_cache)
+    for name, status, elapsed in report:
+        print(f'{name:12s}{status:8s}{elapsed:8.2f} s')
+    for name, value in artifacts.get('summary', {}).items():
+        print(f'{name}: {value:.6g}')
@@ -0,0 +1,171 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import time as timer
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Set WASP18_PROFILE=1, or to a file path, to record every stage of a run
+PROFILE_ENV = 'WASP18_PROFILE'
+
+
+def _peak_rss_mb():
+    # The high-water RSS of this process and of its finished children, in MB
+    if resource is None:
+        return None, None
+    scale = 2 ** 20 if sys.platform == 'darwin' else 2 ** 10
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+
+def _children_cpu():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class _NullStage:
+    # Returned while profiling is off, so an instrumented stage costs one call
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **sizes):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, profiler, name, sizes):
+        self.profiler = profiler
+        self.name = name
+        self.sizes = sizes
+
+    def __enter__(self):
+        self.start = timer.perf_counter_ns()
+        self.cpu = timer.process_time()
+        self.children_cpu = _children_cpu()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        duration = timer.perf_counter_ns() - self.start
+        rss, children_rss = _peak_rss_mb()
+        args = dict(self.sizes,
+                    wall_s=duration / 1e9,
+                    cpu_s=timer.process_time() - self.cpu,
+                    children_cpu_s=_children_cpu() - self.children_cpu,
+                    peak_rss_mb=rss, children_peak_rss_mb=children_rss)
+        if exc_type is not None:
+            args['error'] = exc_type.__name__
+        self.profiler.events.append({'name': self.name, 'ph': 'X', 'ts': self.start / 1e3,
+                                     'dur': duration / 1e3, 'pid': os.getpid(),
+                                     'tid': threading.get_ident(), 'args': args})
+        return False
+
+    def set(self, **sizes):
+        '''
+        Record sizes only known inside the stage, e.g. the number of periods searched.
+        '''
+        self.sizes.update(sizes)
+
+
+class Profiler:
+    '''
+    Wall time, CPU time, peak RSS and array sizes of named pipeline stages, written as
+    a Chrome trace-event file that chrome://tracing, Perfetto or speedscope can open.
+    Stages nest, and stages recorded in worker processes can be merged in with extend.
+    '''
+
+    def __init__(self, path=None):
+        '''
+        Parameters
+        ----------
+        path : str, optional
+            The trace file written at exit. Profiling is off while it is None.
+        '''
+        self.enabled = False
+        self.path = None
+        self.events = []
+        if path:
+            self.enable(path)
+
+    def enable(self, path=None):
+        '''
+        Parameters
+        ----------
+        path : str, optional
+            The trace file written when the interpreter exits, e.g. profile.json. A
+            worker process whose events are sent back to its parent needs none.
+        '''
+        if path is not None and self.path is None:
+            atexit.register(self.write)
+        self.enabled = True
+        self.path = path or self.path
+
+    def stage(self, name, **sizes):
+        '''
+        Parameters
+        ----------
+        name : str
+            The stage, e.g. 'bls_power'.
+        **sizes
+            Array sizes and other facts to record with it, e.g. n_points=time.size.
+
+        Returns
+        -------
+        stage : context manager
+            Times the body of a with block. Its set method records more sizes.
+        '''
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name, sizes)
+
+    def extend(self, events):
+        '''
+        Parameters
+        ----------
+        events : list of dict
+            Events recorded by a worker process, e.g. a slice of its profiler.events.
+        '''
+        self.events.extend(events)
+
+    def write(self, path=None):
+        '''
+        Parameters
+        ----------
+        path : str, optional
+            Where to write the trace. Defaults to the path profiling was enabled with.
+        '''
+        path = path or self.path
+        if path is None:
+            return
+        with open(path, 'w') as handle:
+            # Sizes are often numpy scalars
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms',
+                       'otherData': {'argv': sys.argv}}, handle,
+                      default=lambda value: value.item() if hasattr(value, 'item') else str(value))
+
+
+def _path_from_env():
+    value = os.environ.get(PROFILE_ENV, '')
+    if value.lower() in ('', '0', 'false', 'no'):
+        return None
+    if value.lower() in ('1', 'true', 'yes'):
+        script = os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+        return f'{script}_profile.json'
+    return value
+
+
+# The profiler shared by every module, switched on by WASP18_PROFILE
+profiler = Profiler(_path_from_env())
+stage = profiler.stage
@@ -1,11 +1,14 @@
 from astroquery.mast import Observations
 import os
 import shutil
-import lightkurve as lk
 from matplotlib import pyplot as plt
+from lc_loader import QUALITY_MASK
+from lc_store import read_columns
+from mast_download import download_files, tess_lc_jobs
+from mast_manifest import DEFAULT_TTL, MANIFEST_DIR, query_products
 
 def Bulk_TESS_lc_Query(RA_list, DEC_list, TIC_ID_list, download_dir, host_name_list,
-                       radius=0.01):
+                       radius=0.01, parallel=False, max_workers=4, ttl=DEFAULT_TTL, refresh=False):
     '''
     Parameters
     ----------
@@ -23,6 +26,19 @@ def Bulk_TESS_lc_Query(RA_list, DEC_list, TIC_ID_list, download_dir, host_name_l
     radius : float, optional
         The radius, in degrees, in which to search around the specified RA
         and DEC values. Typically, a value of 0.01 works well.
+    parallel : bool, optional
+        If True, download the products of each target concurrently, straight into
+        its folder. Existing folders are resumed instead of skipped: files already
+        present and verified by size and checksum are kept, the rest are fetched,
+        and transient server errors are retried with backoff.
+    max_workers : int, optional
+        The number of concurrent downloads when parallel is True.
+    ttl : float, optional
+        The age, in seconds, after which a target's cached MAST query is repeated.
+        The query results are kept in a .mast_manifest folder inside download_dir,
+        and with WASP18_OFFLINE=1 they are used whatever their age.
+    refresh : bool, optional
+        If True, query MAST again for every target.
     
     Returns
     -------
@@ -38,38 +54,42 @@ def Bulk_TESS_lc_Query(RA_list, DEC_list, TIC_ID_list, download_dir, host_name_l
         try:
             os.mkdir(download_dir + '/' + str(host_name_list[index]))
         except FileExistsError:
-            print('The directory already exists! Skipping the target. If you wish to rerun the data '
-                  'available for this target, delete or rename the current directory with its name. The run will '
-                  'continue.')
-            dirs.append(download_dir + '/' + str(host_name_list[index]))
-            continue
+            if parallel:
+                dirs.append(download_dir + '/' + str(host_name_list[index]))
+            else:
+                print('The directory already exists! Skipping the target. If you wish to rerun the data '
+                      'available for this target, delete or rename the current directory with its name. The run will '
+                      'continue.')
+                dirs.append(download_dir + '/' + str(host_name_list[index]))
+                continue
 
         try:
-            obs_table = Observations.query_criteria(
-                s_ra=[(float(RA_list[index]) - radius), (float(RA_list[index]) + radius)],
-                s_dec=[(float(DEC_list[index]) - radius), (float(DEC_list[index]) + radius)],
-                calib_level=3,
-                obs_collection='TESS',
-                dataproduct_type='TIMESERIES'
-            )
-            data_products = Observations.get_product_list(obs_table)
+            data_products = query_products(RA_list[index], DEC_list[index], TIC_ID_list[index], radius,
+                                           cache_dir=download_dir + '/' + MANIFEST_DIR, ttl=ttl, refresh=refresh)
+            if len(data_products) == 0:
+                raise ValueError('No light curves')
         except:
             print('No products with the TIC ID and RA/DEC combination! Try a larger radius. There '
                   'may be no data for this target, too.')
             continue
 
+        if parallel:
+            jobs = tess_lc_jobs(data_products, TIC_ID_list[index])
+            undownloaded.extend(download_files(jobs, download_dir + '/' + str(host_name_list[index]),
+                                               max_workers=max_workers))
+            continue
+
+        # Only the target's light curves are listed, with their TIC parsed from the file name
         for indices, items in enumerate(data_products['productFilename']):
-            if str(items).endswith('s_lc.fits') == True or str(items).endswith('a_fast-lc.fits') == True:
-                if int(items[24:40]) == int(TIC_ID_list[index]):
-                    try:
-                        count += 1
-                        print(count)
-                        Observations.download_products(data_products[indices], download_dir=download_dir)
-                    except:
-                        print('There appears to be a server error! This can happen if MAST does not '
-                              'respond in time. The potentially undownloaded file(s) will appear once the run is finished')
-                        undownloaded.append(items)
-                        continue
+            try:
+                count += 1
+                print(count)
+                Observations.download_products(data_products[indices], download_dir=download_dir)
+            except:
+                print('There appears to be a server error! This can happen if MAST does not '
+                      'respond in time. The potentially undownloaded file(s) will appear once the run is finished')
+                undownloaded.append(items)
+                continue
 
         if count > 0:
             try:
@@ -121,15 +141,10 @@ Bulk_TESS_lc_Query(
     radius=0.5
 )
 
-# Example: reading light curves
-lc1 = lk.read('/Users/isaacgutierrez/Downloads/WASP-18b/tess2018234235059-s0002-0000000100100827-0121-s_lc.fits')
-lc2 = lk.read('/Users/isaacgutierrez/Downloads/WASP-18b/tess2018263035959-s0003-0000000100100827-0123-s_lc.fits')
-lc3 = lk.read('/Users/isaacgutierrez/Downloads/WASP-18b/tess2020238165205-s0029-0000000100100827-0193-a_fast-lc.fits')
-lc4 = lk.read('/Users/isaacgutierrez/Downloads/WASP-18b/tess2020238165205-s0029-0000000100100827-0193-s_lc.fits')
-lc5 = lk.read('/Users/isaacgutierrez/Downloads/WASP-18b/tess2020266004630-s0030-0000000100100827-0195-a_fast-lc.fits')
-lc6 = lk.read('/Users/isaacgutierrez/Downloads/WASP-18b/tess2020266004630-s0030-0000000100100827-0195-s_lc.fits')
-lc7 = lk.read('/Users/isaacgutierrez/Downloads/WASP-18b/tess2023237165326-s0069-0000000100100827-0264-a_fast-lc.fits')
-lc8 = lk.read('/Users/isaacgutierrez/Downloads/WASP-18b/tess2023237165326-s0069-0000000100100827-0264-s_lc.fits')
+# Example: reading a light curve. Only the plotted columns are read from the file;
+# Steps 2-6 load every sector the same way through lc_loader
+lc1 = read_columns('/Users/isaacgutierrez/Downloads/WASP-18b/tess2018234235059-s0002-0000000100100827-0121-s_lc.fits')
+good = (lc1.quality & QUALITY_MASK) == 0
 
 plt.figure(figsize=(10, 6))
-plt.plot(lc1.time, lc1.flux, label='Original LC 1', alpha=0.7)
+plt.plot(lc1.time[good], lc1.flux[good], label='Original LC 1', alpha=0.7)
@@ -1,64 +1,54 @@
 import os
 import numpy as np
-from astropy.io import fits
-import matplotlib.pyplot as plt
-import astropy.timeseries as at
+from lc_loader import load_light_curve
+from figures import FigureSet, line, scatter
+from binning import bin_light_curve
+from bls_cache import CACHE_DIR
+from detrend import detrend, transit_mask
+from period_grid import adaptive_bls
+from uncertainties import estimate_uncertainties
+
+figures = FigureSet()
 
 # Step 1: Reload the light curve
 dir_path = "/Users/isaacgutierrez/Desktop/Ampersand/Class Project/WASP-18b"
-files = [f for f in os.listdir(dir_path) if f.endswith('.fits')]
-
-flux, time = np.array([]), np.array([])
-
-for lc in files:
-    with fits.open(os.path.join(dir_path, lc)) as LC:
-        current_flux = LC[1].data['PDCSAP_FLUX']
-        current_time = LC[1].data['TIME']
-        current_quality = LC[1].data['QUALITY']
-        
-        # Masking bad data
-        valid_indices = (~np.isnan(current_flux)) & (np.bitwise_and(current_quality, 0b0101001010111111) == 0)
-        masked_flux = current_flux[valid_indices]
-        masked_time = current_time[valid_indices]
-        
-        if masked_flux.size > 0:  # Check for valid flux data
-            masked_flux /= np.median(masked_flux)
-            
-            # Concatenate data
-            flux = np.concatenate((flux, masked_flux))
-            time = np.concatenate((time, masked_time))
+time, flux = load_light_curve(dir_path, cadence='lc')
 
 # Step 2: Plot the light curve
-plt.figure(figsize=(10, 6))
-plt.scatter(time, flux, marker='.', alpha=0.7)
-plt.xlabel('Time (days)')
-plt.ylabel('Normalized Flux')
-plt.title('Light Curve of WASP-18b (Concatenated)')
-plt.show()
+figures.add('step_3_light_curve.png', [scatter(time, flux, marker='.', alpha=0.7)], figsize=(10, 6),
+            xlabel='Time (days)', ylabel='Normalized Flux',
+            title='Light Curve of WASP-18b (Concatenated)')
 
 # Step 3: Use BLS to find periodic transits
 # Define the time and flux for BLS
 time -= np.min(time)  # Normalize time
 flux_err = np.std(flux)  # Estimate flux error as standard deviation
 
-# Initialize the BLS model
-bls = at.BoxLeastSquares(time, flux)
+# Remove stellar and instrumental trends before the search; the transits are masked
+# once they are found
+raw_flux = flux
+flux, trend = detrend(time, raw_flux)
+
+# Host star properties, used for the physically plausible transit durations
+Rs = 1.319  # Stellar radius in solar radii
+Ms = 1.22  # Stellar mass in solar masses
 
-# Define the period range for search
-periods = np.linspace(0.5, 10, 10000)
-bls_result = bls.power(periods, duration=0.1)
+# Blind search over 0.5-10 days: a coarse grid uniform in frequency, sized from the
+# observing seasons, then a dense full-baseline grid around the strongest peaks
+periods, power, bls_result = adaptive_bls(time, flux, 0.5, 10, Rs, Ms,
+                                          cache_dir=os.path.join(dir_path, CACHE_DIR), n_workers=None)
 
 # Step 4: Plot the periodogram
-plt.figure(figsize=(10, 6))
-plt.plot(bls_result.period, bls_result.power, color='b')
-plt.xlabel('Period (days)')
-plt.ylabel('Power (W)')
-plt.title('BLS Periodogram of WASP-18b Light Curve (Concatenated)')
-plt.show()
+figures.add('Figure 2.png', [line(periods, power, color='b')], figsize=(10, 6),
+            xlabel='Period (days)', ylabel='Power (W)',
+            title='BLS Periodogram of WASP-18b Light Curve (Concatenated)')
 
 # Step 5: Identify the strongest period
-best_period = bls_result.period[np.argmax(bls_result.power)]
+index = np.argmax(bls_result.power)
+best_period = bls_result.period[index]
 print(f'(Best-Fit) Period: {best_period} days')
+in_transit = transit_mask(time, best_period, bls_result.transit_time[index], 1.5 * bls_result.duration[index])
+flux, trend = detrend(time, raw_flux, mask=in_transit)
 
 # Step 6: Fold the light curve at the best period
 folded_time = (time % best_period) / best_period  # Phase
@@ -70,19 +60,26 @@ folded_flux = flux[sorted_indices]
 # Bin the data to reduce noise and isolate the transit
 bin_width = 0.01  # Phase width for binning
 bins = np.arange(0, 1 + bin_width, bin_width)
-binned_flux, bin_edges = np.histogram(folded_time, bins=bins, weights=folded_flux)
-binned_counts, _ = np.histogram(folded_time, bins=bins)
-binned_flux /= binned_counts  # Average flux per bin
+binned = bin_light_curve(folded_time, folded_flux, bins=bins)  # Average flux per bin
 
 # Find the minimum flux in the binned light curve
-transit_depth = 1 - np.min(binned_flux)
+transit_depth = 1 - np.nanmin(binned.mean)
 print(f"Transit Depth: {transit_depth:.6f}")
 
 # Step 8: Calculate the planet radius
-Rs = 1.319  # Stellar radius in solar radii
 Rp = Rs * (transit_depth ** 0.5)
 print(f"Radius of Planet: {Rp:.2f} Solar Radii")
 
+# Uncertainties: block-bootstrap resamples of the residuals around the binned phase
+# curve for the intervals, and the signal re-injected at random phases for the bias
+intervals = estimate_uncertainties(time, flux, best_period, bls_result.transit_time[index],
+                                   bls_result.duration[index], stellar_radius=Rs, n_bins=100)
+for name, label, unit in [('period', 'Period', 'days'), ('transit_depth', 'Transit Depth', ''),
+                          ('planet_radius', 'Radius of Planet', 'Solar Radii')]:
+    interval = intervals[name]
+    print(f'{label}: {interval.value:.6g} (68%: {interval.lower:.6g} to {interval.upper:.6g}) {unit}, '
+          f'injection bias {interval.bias:+.2g}')
+
 a = 0.02024 * 215.032
 i = 1.45735
 b = np.cos(i) * (a / Rs)
@@ -91,4 +88,6 @@ print(f'Impact Parameter: {b}')
     #Desired results:
     #Period: 0.94 days
     #Radius: 0.11 Solar radii
-    #Impact Parameter: ~0.37
\ No newline at end of file
+    #Impact Parameter: ~0.37
+
+figures.render()
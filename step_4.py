@@ -1,50 +1,31 @@
 import os
 import numpy as np
-from astropy.io import fits
-import matplotlib.pyplot as plt
-import astropy.timeseries as at
-import lightkurve as lk
+from lc_loader import iter_sectors, load_light_curve
+from folding import fold
+from figures import FigureSet, line, scatter
+from binning import bin_light_curve
+from bls_cache import CACHE_DIR
+from detrend import detrend, flatten_sector, transit_mask
+from incremental_bls import incremental_bls_power
+from transit_timing import fit_ephemeris, measure_duration, measure_transit_times
+
+figures = FigureSet()
 
 # Step 1: Reload the light curve
 dir_path = "/Users/isaacgutierrez/Desktop/Ampersand/Class Project/WASP-18b"
-files = [f for f in os.listdir(dir_path) if f.endswith('.fits')]
-
-flux, time = np.array([]), np.array([])
-
-for lc in files:
-    with fits.open(os.path.join(dir_path, lc)) as LC:
-        current_flux = LC[1].data['PDCSAP_FLUX']
-        current_time = LC[1].data['TIME']
-        current_quality = LC[1].data['QUALITY']
-        
-        # Masking bad data
-        valid_indices = (~np.isnan(current_flux)) & (np.bitwise_and(current_quality, 0b0101001010111111) == 0)
-        masked_flux = current_flux[valid_indices]
-        masked_time = current_time[valid_indices]
-        
-        if masked_flux.size > 0:  # Check for valid flux data
-            masked_flux /= np.median(masked_flux)
-            
-            # Concatenate data
-            flux = np.concatenate((flux, masked_flux))
-            time = np.concatenate((time, masked_time))
+time, flux = load_light_curve(dir_path, cadence='lc')
 
 # Step 2: Plot the light curve
-plt.figure(figsize=(10, 6))
-plt.scatter(time, flux, marker='.', alpha=0.5)
-plt.xlabel('Time (days)')
-plt.ylabel('Normalized Flux (W/mˆ2)')
-plt.title('Light Curve of WASP-18b (Concatenated)')
-plt.show()
+figures.add('step_4_light_curve.png', [scatter(time, flux, marker='.', alpha=0.5)], figsize=(10, 6),
+            xlabel='Time (days)', ylabel='Normalized Flux (W/mˆ2)',
+            title='Light Curve of WASP-18b (Concatenated)')
 
 # Step 3: Use BLS to find periodic transits
 # Define the time and flux for BLS
-time -= np.min(time)  # Normalize time
+start_time = np.min(time)
+time -= start_time  # Normalize time
 flux_err = np.std(flux)  # Estimate flux error as standard deviation
 
-# Initialize the BLS model
-bls = at.BoxLeastSquares(time, flux)
-
 # Define the period range for search
 periods = np.linspace(0.8, 1.2, 10000)
 
@@ -52,72 +33,71 @@ periods = np.linspace(0.8, 1.2, 10000)
 # Transit duration is 5% of period, ensure it's always smaller than the period
 durations = np.minimum(periods * 0.05, periods * 0.9)
 
-bls_result = bls.power(periods, duration=durations)  # Use dynamic durations
+# Use dynamic durations on the detrended sectors; the phase-binned sums behind the
+# periodogram are kept on disk for steps 4-6, so a new sector only adds its own points
+sectors = (flatten_sector(sector) for sector in iter_sectors(dir_path, cadence='lc'))
+bls_result = incremental_bls_power(sectors, periods, durations, cache_dir=os.path.join(dir_path, CACHE_DIR))
 
 # Step 4: Plot the periodogram
-plt.figure(figsize=(10, 6))
-plt.plot(bls_result.period, bls_result.power, color='b')
-plt.xlabel('Period (days)')
-plt.ylabel('Power (W)')
-plt.title('BLS Periodogram of WASP-18b Light Curve (Concatenated)')
-plt.show()
+figures.add('step_4_periodogram.png', [line(bls_result.period, bls_result.power, color='b')],
+            figsize=(10, 6), xlabel='Period (days)', ylabel='Power (W)',
+            title='BLS Periodogram of WASP-18b Light Curve (Concatenated)')
 
 # Step 5: Identify the strongest period
-model = at.BoxLeastSquares(time, flux)
-results = model.power(periods, durations)
-index = np.argmax(results.power)
+index = np.argmax(bls_result.power)
 
 # Desired results:
 # Period: 0.94 days
 # Radius: 1.24 Jupiter radii
 # Impact Parameter: ~0.32
 
-best_period = bls_result.period[np.argmax(bls_result.power)]
+best_period = bls_result.period[index]
 print(f"Best-fit Period: {best_period:.4f} days")
 
-t0 = results.transit_time[index]
-duration = results.duration[index]
+t0 = bls_result.transit_time[index] - start_time  # The sectors are in BTJD
+duration = bls_result.duration[index]
+
+# The grid duration is a fixed 5% of the period, shorter than the transit, so the mask and
+# the timing template use the duration measured from the stacked transits of the detrended
+# light curve, as in pipeline.py and batch_runner.py
+transit_duration = measure_duration(time, detrend(time, flux)[0], best_period, t0, 0.25 * best_period)
+transit_duration = max(transit_duration, duration) if np.isfinite(transit_duration) else duration
+print(f"Transit Duration: {transit_duration:.4f} days")
+mask_width = max(1.5 * transit_duration, 0.1)
 
-lc = lk.LightCurve(time=masked_time, flux=masked_flux)
-folded_lc = lc.fold(period=best_period, epoch_time=t0)
+# Remove stellar and instrumental trends, with the transits masked so they stay whole
+flux, trend = detrend(time, flux, mask=transit_mask(time, best_period, t0, mask_width))
 
-# Shift the phase for three separate transits
-phase = folded_lc.time.value
-flux = folded_lc.flux.value
+# Time every transit on its own and fit a linear ephemeris to the mid-transit times
+transit_times = measure_transit_times(time, flux, best_period, t0, transit_duration)
+ephemeris = fit_ephemeris(transit_times)
+print(f"Ephemeris from {transit_times.epoch.size} transits: Period = {ephemeris.period:.7f} "
+      f"± {ephemeris.period_err:.7f} days, T0 = {ephemeris.t0 + start_time:.5f} ± {ephemeris.t0_err:.5f} BTJD")
 
-# Shift phases for three distinct transits
-phase_shifted_pos1 = phase + best_period  # First shift
-phase_shifted_pos2 = phase + 2 * best_period  # Second shift
+# Fold every sector at the best period, sorted by phase in days from mid-transit
+folded = fold(time, flux, best_period, t0)
+phase = folded.phase
+flux = folded.flux
 
-# Concatenate the phases for three different transits
-all_phases = np.concatenate((phase, phase_shifted_pos1, phase_shifted_pos2))
-all_fluxes = np.concatenate((flux, flux, flux))
+# The folded orbit repeated at three consecutive periods, for three distinct transits
+all_phases, all_fluxes = folded.tile(3)
 
 # Plot the three distinct transits
-plt.scatter(all_phases, all_fluxes, s=5)
-plt.xlabel('Phase (Radians)')
-plt.ylabel('Normalized Flux (W/mˆ2')
-plt.title('Three Separate Transits of WASP-18b')
-plt.xlim(-1.5 * best_period, 3 * best_period)  # Adjust x-axis to fit three transits
-plt.show()
+figures.add('step_4_transits.png', [scatter(all_phases, all_fluxes, s=5)], xlabel='Phase (Radians)',
+            ylabel='Normalized Flux (W/mˆ2', title='Three Separate Transits of WASP-18b',
+            xlim=(-1.5 * best_period, 3 * best_period))  # Adjust x-axis to fit three transits
 
 # Scale the phase to stretch transits horizontally
 scaled_phase = all_phases * 2.5  # Adjust the scale factor as needed
 
-# Plot the horizontally stretched transits
-plt.figure(figsize=(10, 6))
-plt.scatter(scaled_phase, all_fluxes, s=10, alpha=0.5, label="Raw Data")
-
 # Apply binning for clarity
-bins = np.linspace(scaled_phase.min(), scaled_phase.max(), 500)  # Define bins
-bin_indices = np.digitize(scaled_phase, bins)  # Assign phases to bins
-binned_flux = [np.mean(all_fluxes[bin_indices == i]) for i in range(len(bins))]
-plt.plot(bins, binned_flux, color='r', linewidth=1.5, label="Binned Data")
-
-# Label and format the plot
-plt.xlabel('Scaled Phase (Radians)')
-plt.ylabel('Normalized Flux (W/mˆ2')
-plt.title('(Horizontally Stretched) Transits of WASP-18b')
-plt.xlim(-1.5 * best_period * 1, 3 * best_period * 2.25)  # Adjust x-axis range based on scaling
-plt.legend()
-plt.show()
\ No newline at end of file
+binned = bin_light_curve(scaled_phase, all_fluxes, bins=500)  # Mean flux in 500 phase bins
+
+# Plot the horizontally stretched transits with the binned data
+figures.add('Figure 3.png', [scatter(scaled_phase, all_fluxes, s=10, alpha=0.5, label="Raw Data"),
+                             line(binned.centers, binned.mean, color='r', linewidth=1.5, label="Binned Data")],
+            figsize=(10, 6), legend=True, xlabel='Scaled Phase (Radians)',
+            ylabel='Normalized Flux (W/mˆ2', title='(Horizontally Stretched) Transits of WASP-18b',
+            xlim=(-1.5 * best_period * 1, 3 * best_period * 2.25))  # Adjust x-axis range based on scaling
+
+figures.render()
@@ -1,50 +1,32 @@
 import os
 import numpy as np
-from astropy.io import fits
-import matplotlib.pyplot as plt
-import astropy.timeseries as at
-import lightkurve as lk
+from lc_loader import iter_sectors, load_light_curve
+from folding import fold
+from figures import FigureSet, line, scatter
+from binning import bin_light_curve
+from eclipse_search import search_secondary_eclipse
+from bls_cache import CACHE_DIR
+from detrend import detrend, flatten_sector, transit_mask
+from incremental_bls import accumulate_sectors, iterative_bls_search
+from uncertainties import estimate_uncertainties
+
+figures = FigureSet()
 
 # Step 1: Reload the light curve
 dir_path = "/Users/isaacgutierrez/Desktop/Ampersand/Class Project/WASP-18b"
-files = [f for f in os.listdir(dir_path) if f.endswith('.fits')]
-
-flux, time = np.array([]), np.array([])
-
-for lc in files:
-    with fits.open(os.path.join(dir_path, lc)) as LC:
-        current_flux = LC[1].data['PDCSAP_FLUX']
-        current_time = LC[1].data['TIME']
-        current_quality = LC[1].data['QUALITY']
-        
-        # Masking bad data
-        valid_indices = (~np.isnan(current_flux)) & (np.bitwise_and(current_quality, 0b0101001010111111) == 0)
-        masked_flux = current_flux[valid_indices]
-        masked_time = current_time[valid_indices]
-        
-        if masked_flux.size > 0:  # Check for valid flux data
-            masked_flux /= np.median(masked_flux)
-            
-            # Concatenate data
-            flux = np.concatenate((flux, masked_flux))
-            time = np.concatenate((time, masked_time))
+time, flux = load_light_curve(dir_path, cadence='lc')
 
 # Step 2: Plot the light curve
-plt.figure(figsize=(10, 6))
-plt.scatter(time, flux, marker='.', alpha=0.5)
-plt.xlabel('Time (days)')
-plt.ylabel('Normalized Flux')
-plt.title('Light Curve of WASP-18b (Concatenated)')
-plt.show()
+figures.add('step_5_light_curve.png', [scatter(time, flux, marker='.', alpha=0.5)], figsize=(10, 6),
+            xlabel='Time (days)', ylabel='Normalized Flux',
+            title='Light Curve of WASP-18b (Concatenated)')
 
 # Step 3: Use BLS to find periodic transits
 # Define the time and flux for BLS
-time -= np.min(time)  # Normalize time
+start_time = np.min(time)
+time -= start_time  # Normalize time
 flux_err = np.std(flux)  # Estimate flux error as standard deviation
 
-# Initialize the BLS model
-bls = at.BoxLeastSquares(time, flux)
-
 # Define the period range for search
 periods = np.linspace(0.8, 1.2, 10000)
 
@@ -52,101 +34,103 @@ periods = np.linspace(0.8, 1.2, 10000)
 # Transit duration is 5% of period, ensure it's always smaller than the period
 durations = np.minimum(periods * 0.05, periods * 0.9)
 
-bls_result = bls.power(periods, duration=durations)  # Use dynamic durations
+# Use dynamic durations on the detrended sectors; the phase-binned sums behind the
+# periodogram are kept on disk for steps 4-6, so a new sector only adds its own points
+sectors = (flatten_sector(sector) for sector in iter_sectors(dir_path, cadence='lc'))
+accumulator = accumulate_sectors(sectors, periods, durations, cache_dir=os.path.join(dir_path, CACHE_DIR))
+bls_result = accumulator.power()
 
 # Step 4: Plot the periodogram
-plt.figure(figsize=(10, 6))
-plt.plot(bls_result.period, bls_result.power, color='b')
-plt.xlabel('Period (days)')
-plt.ylabel('Power')
-plt.title('BLS Periodogram')
-plt.show()
+figures.add('step_5_periodogram.png', [line(bls_result.period, bls_result.power, color='b')],
+            figsize=(10, 6), xlabel='Period (days)', ylabel='Power', title='BLS Periodogram')
 
 # Step 5: Identify the strongest period
-model = at.BoxLeastSquares(time, flux)
-results = model.power(periods, durations)
-index = np.argmax(results.power)
+index = np.argmax(bls_result.power)
 
 # Get the best period, transit time, and duration
-best_period = bls_result.period[np.argmax(bls_result.power)]
+best_period = bls_result.period[index]
 print(f"Best-fit Period: {best_period:.4f} days")
 
-t0 = results.transit_time[index]
-duration = results.duration[index]
-
-lc = lk.LightCurve(time=masked_time, flux=masked_flux)
-folded_lc = lc.fold(period=best_period, epoch_time=t0)
-
-# Shift the phase for three separate transits
-phase = folded_lc.time.value
-flux = folded_lc.flux.value
-
-# Step 1: Identify the regions of the two primary transits and mask them
-# The first primary transit is around phase 0
-# The second primary transit is around phase best_period, so around phase ~ 0.94
-mask_primary_transits = ((phase > -0.05) & (phase < 0.05)) | ((phase > best_period - 0.05) & (phase < best_period + 0.05))
+t0 = bls_result.transit_time[index] - start_time  # The sectors are in BTJD
+duration = bls_result.duration[index]
+
+# Search again with each strongest signal's transits masked, for companions or other
+# periodic signals; every search reuses the binned sums above. It takes the masked points
+# back out of the sums, so it is given the same detrended sectors, read again
+bls_time, bls_flux = np.hstack([(sector.time, sector.flux)
+                                for sector in map(flatten_sector, iter_sectors(dir_path, cadence='lc'))])
+signals = iterative_bls_search(accumulator, bls_time, bls_flux, n_signals=3)
+for number, signal in enumerate(signals[1:], start=2):
+    print(f"Signal {number}: Period {signal.period:.4f} days, Depth {signal.depth:.6f}, "
+          f"SNR {signal.depth_snr:.1f}")
+
+# The grid duration is a fixed 5% of the period, shorter than the transit, so the masks
+# below use the duration the search measured from the stacked transits
+duration = signals[0].duration
+print(f"Transit Duration: {duration:.4f} days")
+
+# Remove stellar and instrumental trends, with the transits and the eclipses half an
+# orbit later masked so neither is absorbed into the trend
+eclipses = transit_mask(time, best_period, t0 + 0.5 * best_period, 1.5 * duration)
+flux, trend = detrend(time, flux, mask=transit_mask(time, best_period, t0, 1.5 * duration) | eclipses)
+
+# Bootstrap and injection-recovery uncertainties, from the unfolded light curve
+intervals = estimate_uncertainties(time, flux, best_period, t0, duration)
+
+# Fold every sector at the best period, sorted by phase in days from mid-transit
+folded = fold(time, flux, best_period, t0)
+phase = folded.phase
+flux = folded.flux
+
+# Step 1: Identify the primary transits and mask them
+# The phase runs from -best_period / 2 to best_period / 2 with the transits at 0; mask
+# 1.5 measured durations, and never less than 0.05 days either side, so ingress and
+# egress are left out too
+primary_half_width = max(0.75 * duration, 0.05)
+mask_primary_transits = np.abs(phase) < primary_half_width
 
 # Step 2: Exclude the flux values corresponding to the primary transits
 phase_no_primary = phase[~mask_primary_transits]
 flux_no_primary = flux[~mask_primary_transits]
 
 # Step 3: Plot only the secondary transits (after excluding the two primary transits)
-plt.scatter(phase_no_primary, flux_no_primary, s=5, color='orange', alpha=0.7)
-plt.xlabel('Phase')
-plt.ylabel('Normalized Flux')
-plt.title('Secondary Transits of WASP-18b (without primary transits)')
-plt.xlim(-1.5 * best_period, 3 * best_period)  # Adjust x-axis to fit the remaining transits
-plt.show()
+figures.add('step_5_secondary_transits.png',
+            [scatter(phase_no_primary, flux_no_primary, s=5, color='orange', alpha=0.7)],
+            xlabel='Phase', ylabel='Normalized Flux',
+            title='Secondary Transits of WASP-18b (without primary transits)',
+            xlim=(-1.5 * best_period, 3 * best_period))  # Adjust x-axis to fit the remaining transits
 
 # Step 4: Optionally, adjust the scaling for the secondary transits
 scaled_phase_no_primary = phase_no_primary * 4  # Adjust the scale factor as needed
 
-# Plot the horizontally stretched secondary transits
-plt.figure(figsize=(10, 6))
-plt.scatter(scaled_phase_no_primary, flux_no_primary, s=10, alpha=0.5, label="Raw Data (Secondary Transits)")
-
 # Optional: Apply binning for clarity
-bins = np.linspace(scaled_phase_no_primary.min(), scaled_phase_no_primary.max(), 500)  # Define bins
-bin_indices = np.digitize(scaled_phase_no_primary, bins)  # Assign phases to bins
-binned_flux = [np.mean(flux_no_primary[bin_indices == i]) for i in range(len(bins))]
-plt.plot(bins, binned_flux, color='r', linewidth=1.5, label="Binned Data")
-
-# Label and format the plot
-plt.xlabel('Scaled Phase (Radians)')
-plt.ylabel('Normalized Flux (W/mˆ2)')
-plt.title('Horizontally Stretched Secondary Transits of WASP-18b')
-plt.xlim(-1.5 * best_period * 1, 2)  # Adjust x-axis range based on scaling
-plt.legend()
-plt.show()
-
-# Step 1: Identify the flux values during the secondary transit
-# We've already excluded the primary transits and are now working with secondary transits
-# We assume the secondary transit flux corresponds to flux values around phase ~0.5, phase ~1.5, etc.
-# Let's define the phase windows for the secondary transits. We expect the secondary transit around phase ~0.5.
-# Adjust based on your results, if needed.
-# Define phase window for secondary transit (e.g., phase ~0.5 ± 0.05)
-mask_secondary_transits = ((phase_no_primary > 0.45) & (phase_no_primary < 0.55)) | \
-                         ((phase_no_primary > 1.45) & (phase_no_primary < 1.55))
-
-# Extract flux values during the secondary transit
-secondary_transit_flux = flux_no_primary[mask_secondary_transits]
-
-# Step 2: Calculate the out-of-transit baseline flux
-# Baseline flux is calculated from the data that doesn't fall within the secondary transit phase windows
-mask_out_of_transit = ~mask_secondary_transits
-out_of_transit_flux = flux_no_primary[mask_out_of_transit]
-
-# Step 3: Calculate the baseline flux (average of the out-of-transit flux)
-baseline_flux = np.mean(out_of_transit_flux)
-
-# Step 4: Calculate the mean flux during the secondary transit
-secondary_transit_mean_flux = np.mean(secondary_transit_flux)
-
-# Step 5: Calculate the secondary transit depth
-secondary_depth = 1 - (secondary_transit_mean_flux / baseline_flux)
-
-# Output the secondary transit depth
-print(f"Secondary Transit Depth: {secondary_depth:.4f}")
+binned = bin_light_curve(scaled_phase_no_primary, flux_no_primary, bins=500)  # Mean flux in 500 phase bins
+
+# Plot the horizontally stretched secondary transits with the binned data
+figures.add('Figure 4.png',
+            [scatter(scaled_phase_no_primary, flux_no_primary, s=10, alpha=0.5,
+                     label="Raw Data (Secondary Transits)"),
+             line(binned.centers, binned.mean, color='r', linewidth=1.5, label="Binned Data")],
+            figsize=(10, 6), legend=True, xlabel='Scaled Phase (Radians)',
+            ylabel='Normalized Flux (W/mˆ2)', title='Horizontally Stretched Secondary Transits of WASP-18b',
+            xlim=(-1.5 * best_period * 1, 2))  # Adjust x-axis range based on scaling
+
+# Step 1: Search the primary-masked folded data for the secondary eclipse
+# Every phase offset over the whole orbit and a range of durations around the transit
+# duration are scanned at once, so an eccentric orbit's eclipse is found too. Windows
+# reaching into the masked primary are left out, so its ingress and egress cannot pass
+# for an eclipse
+eclipse = search_secondary_eclipse(phase_no_primary / best_period, flux_no_primary,
+                                   duration / best_period * np.array([0.5, 0.75, 1.0, 1.25, 1.5]),
+                                   primary_width=2 * primary_half_width / best_period)
+
+# Output the secondary transit depth. The depth and its 68% interval both come from the
+# uncertainty engine's measurement, so the interval is around the value reported; the
+# search above gives the eclipse phase
+depth = intervals['secondary_depth']
+print(f"Secondary Eclipse Phase: {eclipse.phase:.3f} (SNR {eclipse.snr:.1f})")
+print(f"Secondary Transit Depth: {depth.value:.6f} (68%: {depth.lower:.6f} to {depth.upper:.6f}), "
+      f"injection bias {depth.bias:+.2g}")
 
 # Given values
 R_sun = 6.96e8  # Solar radius in meters
@@ -154,8 +138,13 @@ R_jupiter = 7.1492e7  # Jupiter radius in meters
 R_star = 1.378 * R_sun  # Star radius in meters (WASP-18)
 R_planet = 1.2 * R_jupiter  # Planet radius in meters (WASP-18b)
 T_star = 6400  # Star temperature in K (WASP-18)
-delta_F = 0.0011  # Secondary eclipse depth
+delta_F = depth.value  # Measured secondary eclipse depth
 
 # Calculate the dayside temperature of the planet
 T_planet = T_star * (R_star / R_planet) * (delta_F)**(6/13)
-print(f'Temperature of WASP-18b (Day-Side) (K): {T_planet}')
\ No newline at end of file
+
+# The temperature rises with the depth, so the depth interval maps onto its interval
+T_lower, T_upper = T_star * (R_star / R_planet) * np.maximum([depth.lower, depth.upper], 0) ** (6 / 13)
+print(f'Temperature of WASP-18b (Day-Side) (K): {T_planet:.0f} (68%: {T_lower:.0f} to {T_upper:.0f})')
+
+figures.render()
@@ -1,51 +1,34 @@
 # Just edit this to show primary and secondary transits. Explain phase modulations (whatever that means)
 import os
 import numpy as np
-from astropy.io import fits
-import matplotlib.pyplot as plt
-import astropy.timeseries as at
-import lightkurve as lk
+from lc_loader import iter_sectors, load_light_curve
+from folding import bin_sectors, fold
+from figures import FigureSet, line, scatter
+from binning import bin_light_curve
+from bls_cache import CACHE_DIR
+from detrend import detrend, flatten_sector, transit_mask
+from harmonics import fit_harmonics, harmonic_periodogram
+from incremental_bls import incremental_bls_power
+from phase_curve import PARAMETERS, PhaseCurveModel, beaming_amplitude
+from transit_timing import measure_duration
+
+figures = FigureSet()
 
 # Step 1: Reload the light curve
 dir_path = "/Users/isaacgutierrez/Desktop/Ampersand/Class Project/WASP-18b"
-files = [f for f in os.listdir(dir_path) if f.endswith('.fits')]
-
-flux, time = np.array([]), np.array([])
-
-for lc in files:
-    with fits.open(os.path.join(dir_path, lc)) as LC:
-        current_flux = LC[1].data['PDCSAP_FLUX']
-        current_time = LC[1].data['TIME']
-        current_quality = LC[1].data['QUALITY']
-        
-        # Masking bad data
-        valid_indices = (~np.isnan(current_flux)) & (np.bitwise_and(current_quality, 0b0101001010111111) == 0)
-        masked_flux = current_flux[valid_indices]
-        masked_time = current_time[valid_indices]
-        
-        if masked_flux.size > 0:  # Check for valid flux data
-            masked_flux /= np.median(masked_flux)
-            
-            # Concatenate data
-            flux = np.concatenate((flux, masked_flux))
-            time = np.concatenate((time, masked_time))
+time, flux = load_light_curve(dir_path, cadence='lc')
 
 # Step 2: Plot the light curve
-plt.figure(figsize=(10, 6))
-plt.scatter(time, flux, marker='.', alpha=0.5)
-plt.xlabel('Time (days)')
-plt.ylabel('Normalized Flux')
-plt.title('Light Curve of WASP-18b (Concatenated)')
-plt.show()
+figures.add('step_6_light_curve.png', [scatter(time, flux, marker='.', alpha=0.5)], figsize=(10, 6),
+            xlabel='Time (days)', ylabel='Normalized Flux',
+            title='Light Curve of WASP-18b (Concatenated)')
 
 # Step 3: Use BLS to find periodic transits
 # Define the time and flux for BLS
-time -= np.min(time)  # Normalize time
+start_time = np.min(time)
+time -= start_time  # Normalize time
 flux_err = np.std(flux)  # Estimate flux error as standard deviation
 
-# Initialize the BLS model
-bls = at.BoxLeastSquares(time, flux)
-
 # Define the period range for search
 periods = np.linspace(0.8, 1.2, 10000)
 
@@ -53,70 +36,100 @@ periods = np.linspace(0.8, 1.2, 10000)
 # Transit duration is 5% of period, ensure it's always smaller than the period
 durations = np.minimum(periods * 0.05, periods * 0.9)
 
-bls_result = bls.power(periods, duration=durations)  # Use dynamic durations
+# Use dynamic durations on the detrended sectors; the phase-binned sums behind the
+# periodogram are kept on disk for steps 4-6, so a new sector only adds its own points
+sectors = (flatten_sector(sector) for sector in iter_sectors(dir_path, cadence='lc'))
+bls_result = incremental_bls_power(sectors, periods, durations, cache_dir=os.path.join(dir_path, CACHE_DIR))
 
 # Step 4: Plot the periodogram
-plt.figure(figsize=(10, 6))
-plt.plot(bls_result.period, bls_result.power, color='b')
-plt.xlabel('Period (days)')
-plt.ylabel('Power (W)')
-plt.title('BLS Periodogram')
-plt.show()
+figures.add('step_6_periodogram.png', [line(bls_result.period, bls_result.power, color='b')],
+            figsize=(10, 6), xlabel='Period (days)', ylabel='Power (W)', title='BLS Periodogram')
 
 # Step 5: Identify the strongest period
-model = at.BoxLeastSquares(time, flux)
-results = model.power(periods, durations)
-index = np.argmax(results.power)
+index = np.argmax(bls_result.power)
 
 # Desired results:
 # Period: 0.94 days
 # Radius: 1.24 Jupiter radii
 # Impact Parameter: ~0.32
-best_period = bls_result.period[np.argmax(bls_result.power)]
+best_period = bls_result.period[index]
 print(f"Best-fit Period: {best_period:.4f} days")
-t0 = results.transit_time[index]
-duration = results.duration[index]
-
-lc = lk.LightCurve(time=masked_time, flux=masked_flux)
-folded_lc = lc.fold(period=best_period, epoch_time=t0)
-
-# Shift the phase for three separate transits
-phase = folded_lc.time.value
-flux = folded_lc.flux.value
-
-# Shift phases for three distinct transits
-phase_shifted_pos1 = phase + best_period  # First shift
-phase_shifted_pos2 = phase + 2 * best_period  # Second shift
-
-# Concatenate the phases for three different transits
-all_phases = np.concatenate((phase, phase_shifted_pos1, phase_shifted_pos2))
-all_fluxes = np.concatenate((flux, flux, flux))
+t0 = bls_result.transit_time[index] - start_time  # The sectors are in BTJD
+duration = bls_result.duration[index]
+
+# The grid duration is a fixed 5% of the period, shorter than the transit, so the masks
+# use the duration measured from the stacked transits of the detrended light curve, as in
+# pipeline.py and batch_runner.py
+transit_duration = measure_duration(time, detrend(time, flux)[0], best_period, t0, 0.25 * best_period)
+transit_duration = max(transit_duration, duration) if np.isfinite(transit_duration) else duration
+print(f"Transit Duration: {transit_duration:.4f} days")
+mask_width = max(1.5 * transit_duration, 0.1)
+
+# Phase modulations: a two-harmonic periodogram of the flux with the transits and the
+# eclipses masked, so a signal at P and P / 2 (ellipsoidal variation and beaming) shows
+# as one peak, then the amplitude at each harmonic of the orbit
+in_eclipse = (transit_mask(time, best_period, t0, mask_width)
+              | transit_mask(time, best_period, t0 + 0.5 * best_period, mask_width))
+modulation_periods, modulation_power = harmonic_periodogram(time, flux, mask=in_eclipse)
+print(f"Strongest Modulation Period: {modulation_periods[np.argmax(modulation_power)]:.4f} days")
+harmonics = fit_harmonics(time, flux, best_period, t0, n_harmonics=3, mask=in_eclipse)
+for k in range(3):
+    print(f'Harmonic {k + 1} (P/{k + 1}): cos {harmonics.cos[k]:.3g} +/- {harmonics.cos_err[k]:.2g}, '
+          f'sin {harmonics.sin[k]:.3g} +/- {harmonics.sin_err[k]:.2g}, '
+          f'amplitude {harmonics.amplitude[k]:.3g} +/- {harmonics.amplitude_err[k]:.2g}')
+figures.add('step_6_harmonic_periodogram.png', [line(modulation_periods, modulation_power, color='b')],
+            figsize=(10, 6), xlabel='Period (days)', ylabel='Power', xscale='log',
+            title='Two-Harmonic Periodogram of WASP-18b Outside Transit and Eclipse')
+
+# Fold every sector at the best period, sorted by phase in days from mid-transit
+folded = fold(time, flux, best_period, t0)
+phase = folded.phase
+flux = folded.flux
+
+# Fit the phase curve outside transit: atmospheric (reflection and thermal) modulation,
+# ellipsoidal variation, Doppler beaming and the secondary-eclipse depth. It is fitted to
+# the flux before detrending, because a detrending window this close to the orbital
+# period would flatten the modulation too. The eclipse is taken to be at phase 0.5 and
+# as long as the measured transit. Outside eclipse beaming looks just like a shifted
+# atmospheric term, so it is held at the value WASP-18 (1.22 solar masses) and
+# WASP-18b (10.4 Jupiter masses) give
+orbital_phase = folded.cycles
+phase_curve = PhaseCurveModel(orbital_phase, flux, transit_width=mask_width / best_period,
+                              eclipse_duration=transit_duration / best_period,
+                              beaming=beaming_amplitude(best_period, 1.22, 10.4))
+phase_curve_fit = phase_curve.fit()
+for name, value, error in zip(PARAMETERS, phase_curve_fit.params, phase_curve_fit.errors):
+    print(f'{name}: {value:.6g} (fixed)' if name == 'beaming' else f'{name}: {value:.6g} +/- {error:.2g}')
+
+model_phase = np.linspace(-0.5, 0.5, 1000)
+# Binned one sector at a time as the sectors are read, in their own BTJD time system
+binned_phase_curve = bin_sectors(iter_sectors(dir_path, cadence='lc'), best_period, t0 + start_time, bins=200)
+figures.add('step_6_phase_curve.png',
+            [scatter(binned_phase_curve.centers, binned_phase_curve.mean, s=10, label='Binned Data'),
+             line(model_phase, phase_curve.evaluate(phase_curve_fit.params, model_phase)[0], color='r',
+                  label='Phase-Curve Model')],
+            figsize=(10, 6), legend=True, xlabel='Phase', ylabel='Normalized Flux',
+            title='Phase Curve of WASP-18b', ylim=(1 - 1.5e-3, 1 + 1e-3))
+
+# The folded orbit repeated at three consecutive periods, for three distinct transits
+all_phases, all_fluxes = folded.tile(3)
 
 # Plot the three distinct transits
-plt.scatter(all_phases, all_fluxes, s=5)
-plt.xlabel('Phase (Radians)')
-plt.ylabel('Normalized Flux (W/mˆ2')
-plt.title('Three Separate Transits of WASP-18b')
-plt.xlim(-1.5 * best_period, 3 * best_period)  # Adjust x-axis to fit three transits
-plt.show()
+figures.add('step_6_transits.png', [scatter(all_phases, all_fluxes, s=5)], xlabel='Phase (Radians)',
+            ylabel='Normalized Flux (W/mˆ2', title='Three Separate Transits of WASP-18b',
+            xlim=(-1.5 * best_period, 3 * best_period))  # Adjust x-axis to fit three transits
 
 # Scale the phase to stretch transits horizontally
 scaled_phase = all_phases * 2.5  # Adjust the scale factor as needed
 
-# Plot the horizontally stretched transits
-plt.figure(figsize=(10, 6))
-plt.scatter(scaled_phase, all_fluxes, s=10, alpha=0.5, label="Raw Data")
-
 # Optional: Apply binning for clarity
-bins = np.linspace(scaled_phase.min(), scaled_phase.max(), 500)  # Define bins
-bin_indices = np.digitize(scaled_phase, bins)  # Assign phases to bins
-binned_flux = [np.mean(all_fluxes[bin_indices == i]) for i in range(len(bins))]
-plt.plot(bins, binned_flux, color='r', linewidth=1.5, label="Binned Data")
-
-# Label and format the plot
-plt.xlabel('Scaled Phase (Radians)')
-plt.ylabel('Normalized Flux (W/mˆ2')
-plt.title('(Horizontally Stretched) Transits of WASP-18b')
-plt.xlim(-1, 5.8)  # Adjust x-axis range based on scaling
-plt.legend()
-plt.show()
\ No newline at end of file
+binned = bin_light_curve(scaled_phase, all_fluxes, bins=500)  # Mean flux in 500 phase bins
+
+# Plot the horizontally stretched transits with the binned data
+figures.add('Figure 5.png', [scatter(scaled_phase, all_fluxes, s=10, alpha=0.5, label="Raw Data"),
+                             line(binned.centers, binned.mean, color='r', linewidth=1.5, label="Binned Data")],
+            figsize=(10, 6), legend=True, xlabel='Scaled Phase (Radians)',
+            ylabel='Normalized Flux (W/mˆ2', title='(Horizontally Stretched) Transits of WASP-18b',
+            xlim=(-1, 5.8))  # Adjust x-axis range based on scaling
+
+figures.render()
@@ -0,0 +1,74 @@
+import threading
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from mast_download import DownloadJob, download_job
+
+BODY = bytes(range(256)) * 64
+
+
+class StandIn(BaseHTTPRequestHandler):
+    # A local stand-in for the MAST download endpoint. /flaky answers 503 once,
+    # /missing always 404 and /dropped cuts its first body in half, then serves ranges
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get('Range')))
+        count = sum(path == self.path for path, _ in self.requests)
+        if self.path == '/missing' or (self.path == '/flaky' and count == 1):
+            self.send_error(404 if self.path == '/missing' else 503)
+            return
+
+        start = 0
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(BODY) - 1}/{len(BODY)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(BODY) - start))
+        self.end_headers()
+        if self.path == '/dropped' and count == 1:
+            self.wfile.write(BODY[:len(BODY) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(BODY[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    StandIn.requests = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_retries_503(server, tmp_path):
+    job = DownloadJob(server + '/flaky', 'flaky.bin', len(BODY))
+    assert download_job(job, str(tmp_path), backoff=0, timeout=5)
+    assert (tmp_path / 'flaky.bin').read_bytes() == BODY
+    assert len(StandIn.requests) == 2
+
+
+def test_404_fails_fast(server, tmp_path):
+    job = DownloadJob(server + '/missing', 'missing.bin', len(BODY))
+    with pytest.raises(urllib.error.HTTPError):
+        download_job(job, str(tmp_path), backoff=0, timeout=5)
+    assert len(StandIn.requests) == 1
+    assert not (tmp_path / 'missing.bin').exists()
+
+
+def test_resumes_dropped_body(server, tmp_path):
+    job = DownloadJob(server + '/dropped', 'dropped.bin', len(BODY))
+    assert download_job(job, str(tmp_path), backoff=0, timeout=5)
+    assert (tmp_path / 'dropped.bin').read_bytes() == BODY
+    assert StandIn.requests == [('/dropped', None), ('/dropped', f'bytes={len(BODY) // 2}-')]
@@ -0,0 +1,278 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from binning import bin_light_curve
+from parallel_bls import mp_context
+from period_grid import split_segments
+from profiling import stage
+
+# One entry per transit with enough data: the epoch number counted from t0, the
+# mid-transit time and depth with their 1-sigma errors, and the points fitted
+TransitTimes = namedtuple('TransitTimes', ['epoch', 'mid_time', 'mid_time_err', 'depth', 'depth_err',
+                                           'n_points'])
+
+# The linear ephemeris mid_time = t0 + period * epoch; residuals are observed minus
+# calculated for every transit, used marks the transits kept by the clipping, and
+# reduced_chi2 is that of the used ones
+Ephemeris = namedtuple('Ephemeris', ['period', 'period_err', 't0', 't0_err', 'residuals', 'used',
+                                     'reduced_chi2'])
+
+
+def _no_transits():
+    return TransitTimes(*(np.empty(0) for _ in TransitTimes._fields))
+
+
+def transit_template(time, flux, period, t0, duration, n_bins=100):
+    '''
+    Parameters
+    ----------
+    time, flux : numpy.ndarray
+        The detrended light curve.
+    period, t0, duration : float
+        The transit ephemeris, in days.
+    n_bins : int, optional
+        The number of bins across the template, which spans one duration either side
+        of mid-transit.
+
+    Returns
+    -------
+    offsets, deficit : numpy.ndarray
+        The stacked transit as the fractional flux deficit at each offset, in days,
+        from mid-transit. The baseline is the median outside the transit and the
+        deficit is 0 beyond 0.75 durations, so noise there does not pull the fits.
+        The offsets are measured from the centroid of the deficit.
+    '''
+    dt = (time - t0) / period
+    dt = (dt - np.floor(dt + 0.5)) * period
+    near = np.abs(dt) < duration
+    binned = bin_light_curve(dt[near], flux[near], bins=n_bins, range=(-duration, duration))
+    outside = np.abs(binned.centers) > 0.75 * duration
+    baseline = np.nanmedian(binned.mean[outside]) if np.any(outside & (binned.count > 0)) else 1.0
+    deficit = np.nan_to_num(1 - binned.mean / baseline)
+    deficit[outside] = 0.0
+    # Centered on its deficit centroid, so an error in t0 does not offset every time
+    weight = np.clip(deficit, 0, None)
+    center = np.sum(weight * binned.centers) / np.sum(weight) if np.sum(weight) > 0 else 0.0
+    return binned.centers - center, deficit
+
+
+def measure_duration(time, flux, period, t0, max_duration, n_bins=100, threshold=0.2):
+    '''
+    Parameters
+    ----------
+    time, flux : array-like
+        The detrended light curve.
+    period, t0 : float
+        The transit ephemeris, in days.
+    max_duration : float
+        The longest duration measured, in days. The stacked transit is binned over
+        one max_duration either side of mid-transit and its baseline is the median
+        beyond half of that, so it has to exceed the transit duration.
+    n_bins : int, optional
+        The number of bins across the stacked transit.
+    threshold : float, optional
+        The fraction of the deepest binned deficit that counts as in transit.
+
+    Returns
+    -------
+    duration : float
+        The full width, in days, of the run of bins around the deepest one whose flux
+        deficit stays above threshold times the deepest, or NaN if there is no
+        deficit. Unlike a BLS duration it is not tied to a grid, so it is suited to
+        sizing the masks around transits and eclipses.
+    '''
+    time = np.asarray(time, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    dt = (time - t0) / period
+    dt = (dt - np.floor(dt + 0.5)) * period
+    near = np.abs(dt) < max_duration
+    binned = bin_light_curve(dt[near], flux[near], bins=n_bins, range=(-max_duration, max_duration))
+    outside = (np.abs(binned.centers) > 0.5 * max_duration) & (binned.count > 0)
+    if not np.any(outside):
+        return np.nan
+    deficit = 1 - binned.mean / np.nanmedian(binned.mean[outside])
+
+    # The deepest bin in the inner half, then the bins either side while they stay deep
+    inner = np.flatnonzero((np.abs(binned.centers) <= 0.5 * max_duration) & np.isfinite(deficit))
+    if not inner.size or np.nanmax(deficit[inner]) <= 0:
+        return np.nan
+    deepest = inner[np.nanargmax(deficit[inner])]
+    above = np.nan_to_num(deficit, nan=0.0) > threshold * deficit[deepest]
+    first, last = deepest, deepest
+    while first > 0 and above[first - 1]:
+        first -= 1
+    while last < n_bins - 1 and above[last + 1]:
+        last += 1
+    return (last - first + 1) * (binned.edges[1] - binned.edges[0])
+
+
+def _fit_epochs(time, flux, period, t0, duration, offsets, deficit, shifts, min_points):
+    # Every transit of one sector at once: the points of each epoch are padded into one
+    # row, and for every trial shift of the template the baseline and depth of all rows
+    # come from closed-form weighted least squares
+    epoch = np.round((time - t0) / period).astype(np.int64)
+    dt = time - t0 - epoch * period
+    near = np.abs(dt) < duration + np.max(np.abs(shifts))
+    epoch, dt, flux = epoch[near], dt[near], flux[near]
+    if epoch.size == 0:
+        return _no_transits()
+
+    epochs, start, count = np.unique(epoch, return_index=True, return_counts=True)
+    column = np.arange(count.max())
+    valid = column < count[:, None]
+    index = np.minimum(start[:, None] + column, epoch.size - 1)
+    x = np.where(valid, dt[index], 0.0)
+    w = valid.astype(float)
+
+    # Enough points in each half of the transit and in the baseline around it
+    inside = valid & (np.abs(x) < 0.5 * duration)
+    enough = ((np.sum(inside & (x < 0), axis=1) >= min_points // 2)
+              & (np.sum(inside & (x >= 0), axis=1) >= min_points // 2)
+              & (np.sum(valid & ~inside, axis=1) >= min_points // 2))
+    if not np.any(enough):
+        return _no_transits()
+    epochs, count, x, w, valid = epochs[enough], count[enough], x[enough], w[enough], valid[enough]
+    y = np.where(valid, flux[index[enough]], 0.0)
+
+    s = count.astype(float)
+    y -= (np.sum(y, axis=1) / s)[:, None] * w
+    sy, syy = np.sum(y, axis=1), np.sum(y * y, axis=1)
+    rss = np.empty((epochs.size, shifts.size))
+    slope = np.empty_like(rss)
+    determinant = np.empty_like(rss)
+    for k, shift in enumerate(shifts):
+        d = np.interp(x - shift, offsets, deficit, left=0.0, right=0.0) * w
+        sd, sdd, syd = np.sum(d, axis=1), np.sum(d * d, axis=1), np.sum(d * y, axis=1)
+        determinant[:, k] = s * sdd - sd ** 2
+        with np.errstate(invalid='ignore', divide='ignore'):
+            slope[:, k] = (s * syd - sd * sy) / determinant[:, k]
+        intercept = (sy - slope[:, k] * sd) / s
+        rss[:, k] = syy - intercept * sy - slope[:, k] * syd
+
+    # The vertex of a parabola through the best shift and its neighbours
+    rows = np.arange(epochs.size)
+    best = np.clip(np.nanargmin(np.where(np.isfinite(rss), rss, np.inf), axis=1), 1, shifts.size - 2)
+    before, peak, after = rss[rows, best - 1], rss[rows, best], rss[rows, best + 1]
+    step = shifts[1] - shifts[0]
+    curvature = (before - 2 * peak + after) / (2 * step ** 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        offset = np.where(curvature > 0, 0.5 * (before - after) / (before - 2 * peak + after), np.nan)
+        variance = peak / (s - 3)
+        mid_time_err = np.sqrt(variance / curvature)
+        depth_err = np.sqrt(variance * s / determinant[rows, best]) * deficit.max()
+    # A minimum at the edge of the shift grid, or no minimum, is no measurement
+    offset[np.abs(offset) > 1] = np.nan
+    mid_time = t0 + epochs * period + shifts[best] + offset * step
+    depth = -slope[rows, best] * deficit.max()
+    return TransitTimes(epochs, mid_time, mid_time_err, depth, depth_err, count)
+
+
+def measure_transit_times(time, flux, period, t0, duration, n_shifts=61, max_shift=0.25, template_bins=100,
+                          min_points=10, max_gap=0.5, n_workers=1):
+    '''
+    Parameters
+    ----------
+    time, flux : array-like
+        The detrended light curve, in days, e.g. with transit_mask keeping the
+        transits out of the trend.
+    period, t0, duration : float
+        The transit ephemeris, e.g. from the BLS.
+    n_shifts : int, optional
+        The number of trial mid-transit times per epoch.
+    max_shift : float, optional
+        The largest offset searched from the predicted mid-transit time, in durations.
+    template_bins : int, optional
+        Passed on to transit_template as n_bins.
+    min_points : int, optional
+        Epochs with fewer points in either half of the transit, or in the baseline
+        around it, are skipped.
+    max_gap : float, optional
+        Gaps longer than this, in days, split the light curve into the segments
+        (sectors and orbits) fitted in parallel. It must exceed 2 durations so no
+        transit is split.
+    n_workers : int, optional
+        The number of worker processes the segments are spread over.
+
+    Returns
+    -------
+    times : TransitTimes
+        The mid-transit time and depth of every covered transit, sorted by epoch. Each
+        epoch fits the stacked transit_template scaled in depth over a grid of shifts,
+        with a parabolic refinement of the best one, so there is no per-transit
+        optimizer; the errors come from the curvature of the chi-square.
+    '''
+    order = np.argsort(time, kind='stable')
+    time = np.asarray(time, dtype=float)[order]
+    flux = np.asarray(flux, dtype=float)[order]
+    use = np.isfinite(time) & np.isfinite(flux)
+    time, flux = time[use], flux[use]
+
+    offsets, deficit = transit_template(time, flux, period, t0, duration, template_bins)
+    shifts = np.linspace(-max_shift, max_shift, n_shifts) * duration
+    segments = split_segments(time, max_gap) if time.size else []
+    tasks = [(time[segment], flux[segment], period, t0, duration, offsets, deficit, shifts, min_points)
+             for segment in segments]
+
+    with stage('transit_timing', n_points=time.size, n_segments=len(segments), n_workers=n_workers) as record:
+        if n_workers > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context()) as pool:
+                parts = list(pool.map(_fit_epochs, *zip(*tasks)))
+        else:
+            parts = [_fit_epochs(*task) for task in tasks]
+        parts = [part for part in parts if part.epoch.size]
+        if parts:
+            times = TransitTimes(*(np.concatenate(field) for field in zip(*parts)))
+            # An epoch split by a short max_gap is kept where it has more points
+            order = np.lexsort((-times.n_points, times.epoch))
+            first = np.concatenate(([True], np.diff(times.epoch[order]) != 0))
+            times = TransitTimes(*(field[order][first] for field in times))
+        else:
+            times = _no_transits()
+        record.set(n_epochs=times.epoch.size)
+    return times
+
+
+def fit_ephemeris(times, clip=5.0, max_iterations=5):
+    '''
+    Parameters
+    ----------
+    times : TransitTimes
+        The measured transits, e.g. from measure_transit_times.
+    clip : float, optional
+        Transits further than this many errors from the ephemeris are left out of the
+        next iteration. The errors are scaled up by the reduced chi-square when it
+        exceeds 1.
+    max_iterations : int, optional
+        The largest number of fit and clip rounds.
+
+    Returns
+    -------
+    ephemeris : Ephemeris
+        The weighted least-squares period and mid-transit time at epoch 0, with their
+        errors, also scaled up by the reduced chi-square when it exceeds 1.
+    '''
+    epoch = np.asarray(times.epoch, dtype=float)
+    mid_time, error = np.asarray(times.mid_time), np.asarray(times.mid_time_err)
+    valid = np.isfinite(mid_time) & np.isfinite(error) & (error > 0)
+    used = valid.copy()
+    if np.count_nonzero(used) < 2:
+        raise ValueError('At least two timed transits are needed for an ephemeris')
+
+    for _ in range(max_iterations):
+        weight = np.where(used, 1 / np.where(valid, error, 1.0) ** 2, 0.0)
+        design = np.stack([np.ones_like(epoch), epoch], axis=1)
+        covariance = np.linalg.inv(design.T @ (weight[:, None] * design))
+        t0, period = covariance @ (design.T @ (weight * np.where(valid, mid_time, 0.0)))
+        residuals = mid_time - (t0 + period * epoch)
+        n_used = np.count_nonzero(used)
+        reduced_chi2 = np.sum(weight * np.where(used, residuals, 0.0) ** 2) / max(n_used - 2, 1)
+        scale = max(reduced_chi2, 1.0)
+        kept = valid & (np.abs(residuals) < clip * error * np.sqrt(scale))
+        if np.array_equal(kept, used) or np.count_nonzero(kept) < 2:
+            break
+        used = kept
+
+    return Ephemeris(period, np.sqrt(covariance[1, 1] * scale), t0, np.sqrt(covariance[0, 0] * scale),
+                     residuals, used, reduced_chi2)
@@ -0,0 +1,280 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from binning import bin_light_curve
+from bls_cache import bls_power
+from eclipse_search import search_secondary_eclipse
+from parallel_bls import mp_context
+from profiling import stage
+
+QUANTITIES = ('period', 't0', 'duration', 'transit_depth', 'planet_radius', 'secondary_depth',
+              'dayside_temperature')
+
+# value: measured on the data; lower, upper and std: the block-bootstrap spread around
+# it; bias and scatter: median and spread of recovered - injected over the
+# injection-recovery trials
+Interval = namedtuple('Interval', ['value', 'lower', 'upper', 'std', 'bias', 'scatter'])
+
+# Set in each worker by _attach: the shared arrays and the measurement settings
+_shared = {}
+
+
+def measure(time, flux, period, t0, duration, stellar_radius=1.0, stellar_temperature=None, n_bins=200,
+            window=10):
+    '''
+    Parameters
+    ----------
+    time, flux : numpy.ndarray
+        The light curve, sorted by time.
+    period, t0, duration : float
+        The transit ephemeris the search starts from, in days.
+    stellar_radius : float, optional
+        The stellar radius, in solar radii.
+    stellar_temperature : float, optional
+        The stellar effective temperature, in K. Without it the day-side temperature
+        is NaN.
+    n_bins : int, optional
+        The number of phase bins the transit depth is read from.
+    window : int, optional
+        The BLS searches period +- window resolution elements, where one element is
+        period * duration / baseline.
+
+    Returns
+    -------
+    values : dict
+        Every quantity of QUANTITIES, measured as Steps 3 and 5 do: a local BLS for the
+        period, mid-transit time and duration, the deepest binned phase for the transit
+        depth and planet radius (in solar radii), and search_secondary_eclipse for the
+        secondary depth. t0 is the transit nearest the given t0. The period and t0 are
+        refined below the BLS grid spacing, which is far coarser than their errors.
+    '''
+    baseline = time[-1] - time[0]
+    half_width = window * period * duration / baseline
+    periods = np.linspace(period - half_width, period + half_width, 4 * window + 1)
+    bls_result = bls_power(time, flux, periods, duration * np.array([0.75, 1.0, 1.25]))
+    index = np.argmax(bls_result.power)
+    period = bls_result.period[index]
+    duration = bls_result.duration[index]
+    t0 += ((bls_result.transit_time[index] - t0) / period + 0.5) % 1 * period - 0.5 * period
+
+    # The vertex of a parabola through the peak and its neighbours
+    if 0 < index < periods.size - 1:
+        before, peak, after = bls_result.power[index - 1:index + 2]
+        curvature = before - 2 * peak + after
+        if curvature < 0:
+            period += 0.5 * (before - after) / curvature * (periods[1] - periods[0])
+
+    # The centroid of the flux deficit in a window wider than the transit
+    phase = (time - t0) / period
+    phase -= np.floor(phase + 0.5)
+    near = np.abs(phase) < 0.75 * duration / period
+    deficit = 1 - flux[near] / np.median(flux[~near])
+    if np.sum(deficit) > 0:
+        t0 += period * np.sum(deficit * phase[near]) / np.sum(deficit)
+        phase = (time - t0) / period
+        phase -= np.floor(phase + 0.5)
+    binned = bin_light_curve(phase, flux, bins=n_bins, range=(-0.5, 0.5))
+    transit_depth = 1 - np.nanmin(binned.mean)
+    eclipse = search_secondary_eclipse(phase, flux, duration / period * np.array([0.5, 0.75, 1.0, 1.25, 1.5]),
+                                       primary_width=1.5 * duration / period)
+
+    if stellar_temperature is not None and transit_depth > 0 and eclipse.depth > 0:
+        dayside_temperature = stellar_temperature * transit_depth ** -0.5 * eclipse.depth ** (6 / 13)
+    else:
+        dayside_temperature = np.nan
+    return {
+        'period': period,
+        't0': t0,
+        'duration': duration,
+        'transit_depth': transit_depth,
+        'planet_radius': stellar_radius * max(transit_depth, 0) ** 0.5,
+        'secondary_depth': eclipse.depth,
+        'dayside_temperature': dayside_temperature,
+    }
+
+
+def _block_indices(n, block_size, rng):
+    # A circular moving-block resample: whole blocks keep correlated noise together
+    starts = rng.integers(0, n, -(-n // block_size))
+    return ((starts[:, None] + np.arange(block_size)).ravel() % n)[:n]
+
+
+def _attach(name, n_rows, centers, means, settings):
+    shm = shared_memory.SharedMemory(name=name)
+    _shared['shm'] = shm
+    _shared['data'] = np.ndarray((3, n_rows), dtype=np.float64, buffer=shm.buf)
+    _shared['signal'] = (centers, means)
+    _shared['settings'] = settings
+
+
+def _trial(kind, seed):
+    # One bootstrap resample or one injection at a random phase, measured like the data
+    time, model, residual = _shared['data']
+    centers, means = _shared['signal']
+    settings = dict(_shared['settings'])
+    rng = np.random.default_rng(seed)
+
+    if kind == 'bootstrap':
+        flux = model + residual[_block_indices(residual.size, settings.pop('block_size'), rng)]
+        shift = 0.0
+    else:
+        settings.pop('block_size')
+        # Move the measured signal to a new phase, away from where it was removed
+        shift = rng.uniform(0.1, 0.9)
+        phase = (time - settings['t0']) / settings['period'] - shift
+        flux = residual + np.interp(phase - np.floor(phase + 0.5), centers, means, period=1.0)
+        settings['t0'] += shift * settings['period']
+
+    try:
+        return kind, shift, measure(time, flux, **settings)
+    except ValueError:
+        return kind, shift, None
+
+
+def _spread(samples, previous, tol, min_samples):
+    # The standard deviation of every quantity, and whether it has stopped changing
+    std = {}
+    for name in QUANTITIES:
+        values = np.array([sample[name] for sample in samples], dtype=float)
+        values = values[np.isfinite(values)]
+        std[name] = np.std(values) if values.size else np.nan
+    if len(samples) < min_samples or previous is None:
+        return std, False
+    stable = all(abs(std[name] - previous[name]) <= tol * previous[name]
+                 for name in QUANTITIES if np.isfinite(std[name]) and previous[name] > 0)
+    return std, stable
+
+
+def estimate_uncertainties(time, flux, period, t0, duration, stellar_radius=1.0, stellar_temperature=None,
+                           n_bins=200, confidence=0.68, n_bootstrap=1000, n_injections=200, min_samples=50,
+                           tol=0.05, block_size=None, n_workers=None, seed=0):
+    '''
+    Parameters
+    ----------
+    time, flux : array-like
+        The light curve.
+    period, t0, duration : float
+        The BLS ephemeris, in days.
+    stellar_radius, stellar_temperature, n_bins : optional
+        Passed on to measure.
+    confidence : float, optional
+        The probability covered by the bootstrap interval, e.g. 0.68 for 1 sigma.
+    n_bootstrap, n_injections : int, optional
+        The largest number of bootstrap resamples and injection-recovery trials. Either
+        may be 0.
+    min_samples : int, optional
+        Trials of one kind run before its convergence is checked.
+    tol : float, optional
+        A kind stops once a round of trials changes no quantity's standard deviation
+        by more than this fraction.
+    block_size : int, optional
+        Points per bootstrap block. Defaults to one transit duration of data, so noise
+        correlated on transit time scales is resampled together.
+    n_workers : int, optional
+        The number of worker processes. Defaults to the number of CPUs.
+    seed : int, optional
+        Seed of the resamples and injections.
+
+    Returns
+    -------
+    intervals : dict
+        An Interval for every quantity of QUANTITIES.
+
+    The measured signal is modeled by the binned phase curve, and the residuals around
+    it are resampled in blocks (bootstrap) or kept as they are while the signal is
+    re-injected at a random phase (injection-recovery). The light curve is copied once
+    into shared memory for the workers.
+    '''
+    order = np.argsort(time, kind='stable')
+    time = np.asarray(time, dtype=float)[order]
+    flux = np.asarray(flux, dtype=float)[order]
+    settings = {'period': period, 't0': t0, 'duration': duration, 'stellar_radius': stellar_radius,
+                'stellar_temperature': stellar_temperature, 'n_bins': n_bins}
+    values = measure(time, flux, **settings)
+
+    phase = (time - t0) / period
+    binned = bin_light_curve(phase - np.floor(phase + 0.5), flux, bins=n_bins, range=(-0.5, 0.5))
+    filled = binned.count > 0
+    centers, means = binned.centers[filled], binned.mean[filled]
+    model = np.interp(phase - np.floor(phase + 0.5), centers, means, period=1.0)
+    truth = measure(time, model, **settings)
+    if block_size is None:
+        block_size = max(int(duration / np.median(np.diff(time))), 1)
+    settings['block_size'] = block_size
+
+    n_workers = n_workers or os.cpu_count() or 1
+    round_size = max(2 * n_workers, 8)
+    seeds = np.random.default_rng(seed)
+    samples = {'bootstrap': [], 'injection': []}
+    limits = {'bootstrap': n_bootstrap, 'injection': n_injections}
+    spread = {'bootstrap': None, 'injection': None}
+    done = {kind: limit == 0 for kind, limit in limits.items()}
+
+    shm = shared_memory.SharedMemory(create=True, size=max(3 * time.size * 8, 1))
+    try:
+        data = np.ndarray((3, time.size), dtype=np.float64, buffer=shm.buf)
+        data[0], data[1], data[2] = time, model, flux - model
+        initargs = (shm.name, time.size, centers, means, settings)
+        pool = None
+        if n_workers > 1:
+            pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context(),
+                                       initializer=_attach, initargs=initargs)
+        else:
+            _attach(*initargs)
+
+        with stage('uncertainties', n_points=time.size, n_workers=n_workers) as record:
+            while not all(done.values()):
+                tasks = [(kind, int(seeds.integers(2 ** 63)))
+                         for kind in samples if not done[kind]
+                         for _ in range(min(round_size, limits[kind] - len(samples[kind])))]
+                if pool is None:
+                    results = [_trial(*task) for task in tasks]
+                else:
+                    futures = [pool.submit(_trial, *task) for task in tasks]
+                    wait(futures)
+                    results = [future.result() for future in futures]
+
+                for kind, shift, result in results:
+                    if result is None:
+                        continue
+                    if kind == 'injection':
+                        injected = dict(truth, t0=truth['t0'] + shift * truth['period'])
+                        result = {name: result[name] - injected[name] for name in QUANTITIES}
+                    samples[kind].append(result)
+
+                for kind in samples:
+                    if done[kind]:
+                        continue
+                    spread[kind], stable = _spread(samples[kind], spread[kind], tol, min_samples)
+                    done[kind] = stable or len(samples[kind]) >= limits[kind]
+            record.set(n_bootstrap=len(samples['bootstrap']), n_injections=len(samples['injection']))
+        if pool is not None:
+            pool.shutdown()
+        del data
+    finally:
+        _shared.clear()
+        shm.close()
+        shm.unlink()
+
+    tail = 50 * (1 - confidence)
+    intervals = {}
+    for name in QUANTITIES:
+        # NaN samples, e.g. every temperature without a stellar temperature, are dropped
+        bootstrap = np.array([sample[name] for sample in samples['bootstrap']], dtype=float)
+        bootstrap = bootstrap[np.isfinite(bootstrap)]
+        recovery = np.array([sample[name] for sample in samples['injection']], dtype=float)
+        recovery = recovery[np.isfinite(recovery)]
+        if bootstrap.size:
+            # Percentile widths about the bootstrap median, placed around the measured value
+            lower, middle, upper = np.percentile(bootstrap, [tail, 50, 100 - tail])
+            lower, upper = values[name] - (middle - lower), values[name] + (upper - middle)
+            std = np.std(bootstrap)
+        else:
+            lower = upper = std = np.nan
+        bias, scatter = (np.median(recovery), np.std(recovery)) if recovery.size else (np.nan, np.nan)
+        intervals[name] = Interval(values[name], lower, upper, std, bias, scatter)
+    return intervals